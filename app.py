@@ -6,9 +6,14 @@ LINE 團購接龍機器人
 import os
 import re
 import json
+import time
 import sqlite3
 import logging
 import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime
 
 from flask import Flask, request, abort
@@ -47,10 +52,13 @@ line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
-claude_client = Anthropic(api_key=ANTHROPIC_API_KEY) if ANTHROPIC_API_KEY else None
+# 不在 SDK 內自動重試：每次呼叫都有自己的時限，失敗交給斷路器（ai_client）統計
+claude_client = Anthropic(api_key=ANTHROPIC_API_KEY, max_retries=0) if ANTHROPIC_API_KEY else None
 
 # ── 品項解析正規表示式
 ITEM_NUM_RE = re.compile(r'^\s*[（(]?(\d+)[）)\.\、\)]\s*(.*)')
+PRICE_RE = re.compile(r'(\d+)\s*元')
+PRICE_TIER_RE = re.compile(r'(\d+)\s*[包份組盒袋]\s*(\d+)\s*元')
 
 HELP_TEXT = """📖 團購指令說明
 ━━━━━━━━━━━━━━
@@ -74,8 +82,10 @@ HELP_TEXT = """📖 團購指令說明
 退出 N 名字　　　取消指定人的訂單
 列表　　　　　　　查看所有下單狀況
 列表 N　　　　　 查看指定團購
+列表 N 頁M　　　 查看指定團購的第 M 頁
 我的訂單　　　　　查看自己的訂單
-統計　　　　　　　AI 智能訂單統計
+我的訂單 全部　　 查看所有群組的訂單紀錄（限私訊）
+統計　　　　　　　訂單統計（附 AI 點評）
 團購說明　　　　　顯示本說明
 
 【AI 智能理解】
@@ -94,6 +104,86 @@ HELP_TEXT = """📖 團購指令說明
 品名下單自動比對所有進行中團購"""
 
 
+# ══════════════════════════════════════════
+# 資料庫連線（每個執行緒共用一條連線）
+# ══════════════════════════════════════════
+
+# 每條新連線只套用一次的 PRAGMA
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # 讀寫互不阻塞
+    "PRAGMA synchronous=NORMAL",    # WAL 模式下 NORMAL 已足夠安全
+    "PRAGMA busy_timeout=5000",     # 多執行緒 / 多 worker 寫入時等待鎖
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",      # 約 8MB page cache
+)
+
+_db_local = threading.local()
+_db_stats_lock = threading.Lock()
+db_stats = {"connects": 0}
+
+
+def _open_conn(path):
+    """開新連線並套用 PRAGMA"""
+    conn = sqlite3.connect(path, timeout=5.0)
+    for pragma in DB_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"[db] {pragma} 失敗: {e}")
+    with _db_stats_lock:
+        db_stats["connects"] += 1
+    return conn
+
+
+def get_conn():
+    """取得目前執行緒的 SQLite 連線
+    同一執行緒重複使用同一條連線；DB_PATH 改變時（如測試切換檔案）自動重開。
+    呼叫端不需要 close()，寫入後記得 commit()。
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and _db_local.path == DB_PATH:
+        return conn
+    if conn is not None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    conn = _open_conn(DB_PATH)
+    _db_local.conn = conn
+    _db_local.path = DB_PATH
+    return conn
+
+
+@contextmanager
+def write_txn():
+    """寫入交易：BEGIN IMMEDIATE 先取得寫鎖，讓「讀取 → 檢查 → 寫入」不被其他執行緒 / worker 插隊
+    正常結束 commit，例外 rollback；巢狀呼叫時沿用外層交易。
+    """
+    conn = get_conn()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def close_conn():
+    """關閉目前執行緒的連線（背景執行緒結束前呼叫）"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        _db_local.conn = None
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
 # ══════════════════════════════════════════
 # 資料庫
 # ══════════════════════════════════════════
@@ -108,7 +198,7 @@ def init_db():
         except OSError as e:
             logger.warning(f"[startup] 無法建立 {db_dir}: {e}，改用當前目錄")
             DB_PATH = "tuangou.db"
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
 
     c.execute("""
@@ -150,20 +240,30 @@ def init_db():
         )
     """)
 
-    # 遷移：為已存在的 DB 加入新欄位
+    conn.commit()
+    run_migrations(conn)
+
+
+# ══════════════════════════════════════════
+# 資料庫遷移（以 PRAGMA user_version 記錄版本）
+# ══════════════════════════════════════════
+
+def _has_column(c, table, col):
+    c.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == col for row in c.fetchall())
+
+
+def _migrate_group_buys_columns(c):
+    """group_buys 加入 buy_num / max_quantity（舊版 DB）"""
     for col, col_def in [('buy_num', 'INTEGER DEFAULT 1'), ('max_quantity', 'INTEGER')]:
-        try:
+        if not _has_column(c, 'group_buys', col):
             c.execute(f"ALTER TABLE group_buys ADD COLUMN {col} {col_def}")
-        except Exception:
-            pass
 
-    # 遷移：items 表加入 max_quantity 欄位
-    try:
-        c.execute("ALTER TABLE items ADD COLUMN max_quantity INTEGER")
-    except Exception:
-        pass
 
-    # 遷移：將 group_buys.max_quantity 複製到其所有 items
+def _migrate_items_max_quantity(c):
+    """items 加入 max_quantity，並把 group_buys.max_quantity 複製到其所有 items"""
+    if not _has_column(c, 'items', 'max_quantity'):
+        c.execute("ALTER TABLE items ADD COLUMN max_quantity INTEGER")
     c.execute("""
         UPDATE items SET max_quantity = (
             SELECT gb.max_quantity FROM group_buys gb
@@ -171,26 +271,379 @@ def init_db():
         ) WHERE max_quantity IS NULL
     """)
 
-    conn.commit()
-    conn.close()
+
+def _migrate_hot_lookup_indexes(c):
+    """熱門查詢的索引：進行中團購、品項查詢、訂單查詢 / 數量加總"""
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_group_buys_group_status
+        ON group_buys (group_id, status, buy_num)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_items_buy_item
+        ON items (group_buy_id, item_num)
+    """)
+    # 含 quantity → SUM(quantity) 只需掃索引
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_buy_item_user
+        ON orders (group_buy_id, item_num, user_name, quantity)
+    """)
+
+
+def _migrate_items_ordered_total(c):
+    """items 加入 ordered_total（已訂數量彙總），由現有訂單回填"""
+    if not _has_column(c, 'items', 'ordered_total'):
+        c.execute("ALTER TABLE items ADD COLUMN ordered_total INTEGER NOT NULL DEFAULT 0")
+    _rebuild_item_totals(c)
+
+
+def _migrate_catalog_generations(c):
+    """每個群組一個世代號，開團 / 結團 / 取消時遞增，讓各 worker 的目錄快取失效"""
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_generations (
+            group_id    TEXT    PRIMARY KEY,
+            generation  INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+
+def _migrate_report_jobs(c):
+    """結團後的 AI 點評背景工作（持久化，worker 重啟後可繼續）"""
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            id               INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id         TEXT    NOT NULL,
+            group_buy_id     INTEGER NOT NULL,
+            status           TEXT    NOT NULL DEFAULT 'pending',
+            attempts         INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at  REAL    NOT NULL DEFAULT 0,
+            updated_at       REAL    NOT NULL DEFAULT 0,
+            last_error       TEXT,
+            created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_report_jobs_status
+        ON report_jobs (status, next_attempt_at)
+    """)
+
+
+def _migrate_buy_versions(c):
+    """每個團購一個版本號，訂單寫入 / 退出 / 結團時遞增，讓各 worker 的列表渲染快取失效"""
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS buy_versions (
+            group_buy_id  INTEGER PRIMARY KEY,
+            version       INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+
+def _migrate_user_order_index(c):
+    """我的訂單：(user_id, group_buy_id) 同時支援「團購內依 user_id」與「跨團購依 user_id」查詢"""
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_user_buy
+        ON orders (user_id, group_buy_id, item_num)
+    """)
+
+
+def _migrate_order_events(c):
+    """訂單事件帳本 order_events（append-only）與重播快照 order_snapshots
+    既有訂單依 id 順序補一筆 add 事件、已結團的團購補一筆 close 事件，重播結果與現有 orders 相同。
+    """
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS order_events (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_buy_id   INTEGER NOT NULL,
+            kind           TEXT    NOT NULL,
+            item_num       INTEGER,
+            user_id        TEXT,
+            user_name      TEXT,
+            quantity       INTEGER,
+            registered_by  TEXT,
+            created_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_events_buy
+        ON order_events (group_buy_id, id)
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS order_snapshots (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_buy_id   INTEGER NOT NULL,
+            last_event_id  INTEGER NOT NULL,
+            state          TEXT    NOT NULL,
+            created_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_snapshots_buy
+        ON order_snapshots (group_buy_id, last_event_id)
+    """)
+    c.execute("""
+        INSERT INTO order_events (group_buy_id, kind, item_num, user_id, user_name, quantity, registered_by, created_at)
+        SELECT group_buy_id, 'add', item_num, user_id, user_name, quantity, registered_by, created_at
+        FROM orders ORDER BY id
+    """)
+    c.execute("""
+        INSERT INTO order_events (group_buy_id, kind)
+        SELECT id, 'close' FROM group_buys WHERE status = 'closed' ORDER BY id
+    """)
+
+
+# (版本, 說明, 函式)；只能往後加，不要修改已發布的版本
+MIGRATIONS = [
+    (1, "group_buys 加入 buy_num / max_quantity", _migrate_group_buys_columns),
+    (2, "items 加入 max_quantity", _migrate_items_max_quantity),
+    (3, "熱門查詢索引", _migrate_hot_lookup_indexes),
+    (4, "items 加入 ordered_total", _migrate_items_ordered_total),
+    (5, "目錄快取世代號 catalog_generations", _migrate_catalog_generations),
+    (6, "結團 AI 點評背景工作 report_jobs", _migrate_report_jobs),
+    (7, "列表渲染快取版本號 buy_versions", _migrate_buy_versions),
+    (8, "我的訂單索引 orders (user_id, group_buy_id)", _migrate_user_order_index),
+    (9, "訂單事件帳本 order_events / order_snapshots", _migrate_order_events),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(conn):
+    """依序套用尚未執行的遷移，每個版本一個交易
+    多個 worker 同時啟動時以 BEGIN IMMEDIATE 排隊，進交易後再確認一次版本。
+    """
+    for version, desc, func in MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            c = conn.cursor()
+            func(c)
+            c.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+            logger.info(f"[migrate] v{version} {desc}")
+        except Exception:
+            conn.rollback()
+            raise
 
 
 # ══════════════════════════════════════════
-# 資料庫輔助函式
+# 團購目錄快取（進行中團購 + 品項，每個群組一筆）
 # ══════════════════════════════════════════
 
-def get_active_buys(group_id):
-    """取得群組中所有進行中的團購，ORDER BY buy_num"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", "256"))
+
+
+class ItemMatcher:
+    """批次下單用的品項比對索引（品名 + price_info 的單字 / 雙字倒排索引）
+    find(search) 與逐一 `search in name or search in price_info` 結果相同：
+    回傳依團購、品項順序第一個符合的 (buy, item)，但只需驗證含有最稀有雙字的候選品項。
+    """
+
+    __slots__ = ("entries", "texts", "postings")
+
+    def __init__(self, entries):
+        self.entries = entries   # [(buy row, item row), ...]，依 buy_num、item_num 排序
+        self.texts = []          # [(name, price_info), ...]，與 entries 對應
+        self.postings = {}       # {單字或雙字: [entries 位置, ...]}（遞增）
+        for pos, (_, item) in enumerate(entries):
+            name, info = item[3], item[4] or ""
+            self.texts.append((name, info))
+            grams = set()
+            for s in (name, info):
+                grams.update(s)
+                grams.update(s[i:i + 2] for i in range(len(s) - 1))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(pos)
+
+    def find(self, search):
+        if not search:
+            return self.entries[0] if self.entries else None
+        if len(search) == 1:
+            candidates = self.postings.get(search, ())
+        else:
+            candidates = None
+            for i in range(len(search) - 1):
+                posting = self.postings.get(search[i:i + 2])
+                if posting is None:
+                    return None
+                if candidates is None or len(posting) < len(candidates):
+                    candidates = posting
+        for pos in candidates:
+            name, info = self.texts[pos]
+            if search in name or search in info:
+                return self.entries[pos]
+        return None
+
+
+class GroupCatalog:
+    """群組目錄快照：進行中團購、各團購品項、解析好的價格階梯與限量"""
+
+    __slots__ = ("generation", "buys", "items", "tiers", "limits", "_matcher")
+
+    def __init__(self, generation, buys, items):
+        self.generation = generation
+        self.buys = buys      # [group_buys row, ...]，依 buy_num 排序
+        self.items = items    # {buy_id: [items row, ...]}
+        self.tiers = {}       # {buy_id: {item_num: ((qty, price), ...)}}
+        self.limits = {}      # {buy_id: {item_num: max_quantity or None}}
+        for buy_id, rows in items.items():
+            self.tiers[buy_id] = {item[2]: _price_tiers(item[4] or item[3]) for item in rows}
+            self.limits[buy_id] = {item[2]: item[5] for item in rows}
+        self._matcher = None
+
+    @property
+    def matcher(self):
+        """品項比對索引（第一次批次下單時才建立，隨快照一起失效）"""
+        if self._matcher is None:
+            self._matcher = ItemMatcher(
+                [(buy, item) for buy in self.buys for item in self.items.get(buy[0], ())]
+            )
+        return self._matcher
+
+
+def bump_catalog_generation(c, group_id):
+    """群組的團購或品項有變動（需在寫入交易中呼叫）"""
     c.execute(
-        'SELECT * FROM group_buys WHERE group_id=? AND status="open" ORDER BY buy_num',
+        """INSERT INTO catalog_generations (group_id, generation) VALUES (?, 1)
+           ON CONFLICT(group_id) DO UPDATE SET generation = generation + 1""",
         (group_id,),
     )
-    rows = c.fetchall()
-    conn.close()
+    catalog_cache.invalidate(group_id)
+
+
+def bump_buy_version(c, buy_id):
+    """團購的訂單或狀態有變動（需在寫入交易中呼叫，與變動一起提交）"""
+    c.execute(
+        """INSERT INTO buy_versions (group_buy_id, version) VALUES (?, 1)
+           ON CONFLICT(group_buy_id) DO UPDATE SET version = version + 1""",
+        (buy_id,),
+    )
+
+
+def get_buy_version(buy_id):
+    row = get_conn().execute(
+        "SELECT version FROM buy_versions WHERE group_buy_id=?", (buy_id,)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+class CatalogCache:
+    """每個群組的目錄快取（LRU）
+    讀取時比對 DB 中的世代號，其他 worker 開團 / 結團後也會自動重新載入。
+    品項建立後不會再變動，get_items / get_item_name 可直接使用快取中的品項。
+    """
+
+    def __init__(self, max_groups=CATALOG_CACHE_SIZE):
+        self.max_groups = max_groups
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (DB_PATH, group_id) → GroupCatalog
+        self._buy_entries = {}          # (DB_PATH, buy_id) → 含該團購的 GroupCatalog
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, group_id):
+        key = (DB_PATH, group_id)
+        row = get_conn().execute(
+            "SELECT generation FROM catalog_generations WHERE group_id=?", (group_id,)
+        ).fetchone()
+        generation = row[0] if row else 0
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.generation == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self._load(group_id, generation)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            for buy_id in entry.items:
+                self._buy_entries[(DB_PATH, buy_id)] = entry
+            while len(self._entries) > self.max_groups:
+                _, evicted = self._entries.popitem(last=False)
+                self._forget_buys(evicted)
+        return entry
+
+    def _load(self, group_id, generation):
+        c = get_conn().cursor()
+        c.execute(
+            'SELECT * FROM group_buys WHERE group_id=? AND status="open" ORDER BY buy_num',
+            (group_id,),
+        )
+        buys = c.fetchall()
+        items = {buy[0]: [] for buy in buys}
+        if buys:
+            marks = ",".join("?" * len(buys))
+            c.execute(
+                f"""SELECT id, group_buy_id, item_num, name, price_info, max_quantity
+                    FROM items WHERE group_buy_id IN ({marks}) ORDER BY group_buy_id, item_num""",
+                [buy[0] for buy in buys],
+            )
+            for item in c.fetchall():
+                items[item[1]].append(item)
+        return GroupCatalog(generation, buys, items)
+
+    def _forget_buys(self, entry):
+        for buy_id in entry.items:
+            self._buy_entries.pop((DB_PATH, buy_id), None)
+
+    def _for_buy(self, buy_id, field):
+        with self._lock:
+            entry = self._buy_entries.get((DB_PATH, buy_id))
+        return getattr(entry, field).get(buy_id) if entry is not None else None
+
+    def items_for(self, buy_id):
+        """快取中的品項（沒有則回傳 None，由呼叫端查 DB）"""
+        return self._for_buy(buy_id, "items")
+
+    def tiers_for(self, buy_id):
+        """快取中已解析的價格階梯 {item_num: tiers}（沒有則回傳 None）"""
+        return self._for_buy(buy_id, "tiers")
+
+    def limits_for(self, buy_id):
+        """快取中的品項限量 {item_num: max_quantity or None}（沒有則回傳 None）"""
+        return self._for_buy(buy_id, "limits")
+
+    def invalidate(self, group_id):
+        with self._lock:
+            entry = self._entries.pop((DB_PATH, group_id), None)
+            if entry is not None:
+                self._forget_buys(entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buy_entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"groups": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+catalog_cache = CatalogCache()
+
+
+def get_catalog(group_id):
+    """取得群組目錄快照（進行中團購 + 品項 + 價格階梯）"""
+    return catalog_cache.get(group_id)
+
+
+# ══════════════════════════════════════════
+# 資料庫輔助函式
+# ══════════════════════════════════════════
+
+def get_active_buys(group_id):
+    """取得群組中所有進行中的團購，ORDER BY buy_num（經目錄快取）"""
     # cols: id, group_id, title, description, creator_id, creator_name, status, created_at, buy_num, max_quantity
-    return rows
+    return list(get_catalog(group_id).buys)
 
 
 def get_active_buy(group_id, buy_num=None):
@@ -199,84 +652,79 @@ def get_active_buy(group_id, buy_num=None):
     buy_num=None + 只有1個 → 回傳那個
     buy_num=None + 0或多個 → 回傳 None
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    buys = get_catalog(group_id).buys
     if buy_num is not None:
-        c.execute(
-            'SELECT * FROM group_buys WHERE group_id=? AND status="open" AND buy_num=?',
-            (group_id, buy_num),
-        )
-        row = c.fetchone()
-        conn.close()
-        return row
-    else:
-        c.execute(
-            'SELECT * FROM group_buys WHERE group_id=? AND status="open"',
-            (group_id,),
-        )
-        rows = c.fetchall()
-        conn.close()
-        if len(rows) == 1:
-            return rows[0]
-        return None
+        return next((b for b in buys if b[8] == buy_num), None)
+    if len(buys) == 1:
+        return buys[0]
+    return None
     # cols: id, group_id, title, description, creator_id, creator_name, status, created_at, buy_num, max_quantity
 
 
 def get_items(group_buy_id):
-    """取得團購的所有品項"""
-    conn = sqlite3.connect(DB_PATH)
+    """取得團購的所有品項（品項開團後不變，優先使用目錄快取）"""
+    cached = catalog_cache.items_for(group_buy_id)
+    if cached is not None:
+        return list(cached)
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT * FROM items WHERE group_buy_id=? ORDER BY item_num", (group_buy_id,))
+    c.execute(
+        "SELECT id, group_buy_id, item_num, name, price_info, max_quantity FROM items WHERE group_buy_id=? ORDER BY item_num",
+        (group_buy_id,),
+    )
     rows = c.fetchall()
-    conn.close()
     # cols: id, group_buy_id, item_num, name, price_info, max_quantity
     return rows
 
 
 def get_orders(group_buy_id):
     """取得團購的所有訂單"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT * FROM orders WHERE group_buy_id=? ORDER BY item_num, id", (group_buy_id,))
     rows = c.fetchall()
-    conn.close()
     # cols: id, group_buy_id, item_num, user_id, user_name, quantity, registered_by, created_at
     return rows
 
 
 def get_item_name(group_buy_id, item_num):
     """取得指定品項的名稱"""
-    conn = sqlite3.connect(DB_PATH)
+    cached = catalog_cache.items_for(group_buy_id)
+    if cached is not None:
+        return next((item[3] for item in cached if item[2] == item_num), None)
+    conn = get_conn()
     c = conn.cursor()
     c.execute(
         "SELECT name FROM items WHERE group_buy_id=? AND item_num=?",
         (group_buy_id, item_num),
     )
     row = c.fetchone()
-    conn.close()
     return row[0] if row else None
 
 
+def item_tiers(item):
+    """品項的價格階梯：目錄快取已解析就直接使用，否則解析 price_info"""
+    cached = catalog_cache.tiers_for(item[1])
+    tiers = cached.get(item[2]) if cached is not None else None
+    return tiers if tiers is not None else _price_tiers(item[4] or item[3])
+
+
 def extract_price(price_info):
     """從品項文字中提取單價（取第一個 N元 的 N，供 AI 統計用）"""
     if not price_info:
         return None
-    m = re.search(r'(\d+)\s*元', price_info)
+    m = PRICE_RE.search(price_info)
     return int(m.group(1)) if m else None
 
 
-def extract_price_tiers(price_info):
-    """從品項文字中提取所有價格階梯 [(quantity, price), ...]
-    例如 '220元／2包420元' → [(1, 220), (2, 420)]
-    例如 '一包 200 元 2包 300 元' → [(1, 200), (2, 300)]
-    """
-    if not price_info:
-        return []
+@lru_cache(maxsize=4096)
+def _price_tiers(price_info):
+    """解析價格階梯（依 price_info 快取，同一品項文字只解析一次），回傳 tuple"""
     tiers = []
     tier_prices = set()
 
     # 先掃描整段文字，找出所有 "N包M元" 階梯價（N >= 2）
-    for m in re.finditer(r'(\d+)\s*[包份組盒袋]\s*(\d+)\s*元', price_info):
+    for m in PRICE_TIER_RE.finditer(price_info):
         qty = int(m.group(1))
         price = int(m.group(2))
         if qty >= 2:
@@ -284,14 +732,24 @@ def extract_price_tiers(price_info):
             tier_prices.add(price)
 
     # 再找所有 "M元" 作為單價候選（排除已被階梯價使用的金額）
-    for m in re.finditer(r'(\d+)\s*元', price_info):
+    for m in PRICE_RE.finditer(price_info):
         price = int(m.group(1))
         if price not in tier_prices:
             if not any(t[0] == 1 for t in tiers):
                 tiers.append((1, price))
             break  # 取第一個作為單價
 
-    return sorted(tiers, key=lambda t: t[0])
+    return tuple(sorted(tiers, key=lambda t: t[0]))
+
+
+def extract_price_tiers(price_info):
+    """從品項文字中提取所有價格階梯 [(quantity, price), ...]
+    例如 '220元／2包420元' → [(1, 220), (2, 420)]
+    例如 '一包 200 元 2包 300 元' → [(1, 200), (2, 300)]
+    """
+    if not price_info:
+        return []
+    return list(_price_tiers(price_info))
 
 
 def extract_item_limit(price_info):
@@ -306,15 +764,73 @@ def calculate_amount(price_info, quantity):
     """根據價格階梯計算最佳金額
     例如 '220元／2包420元', qty=2 → 420（不是 440）
     """
-    tiers = extract_price_tiers(price_info)
-    if not tiers:
+    if not price_info:
         return None
+    return amount_for_tiers(_price_tiers(price_info), quantity)
+
 
-    # 貪心法：優先使用大包裝
-    tiers_desc = sorted(tiers, key=lambda t: t[0], reverse=True)
+# 最低金額表上限（份數）；超過時改用貪心法，避免單筆異常數量吃掉記憶體
+PRICE_TABLE_MAX_QTY = 10000
+
+
+class PriceTable:
+    """單一價格階梯組合的最低金額表（完全背包 DP），依查詢的最大份數往上擴充
+    best[q] = 剛好買 q 份的最低金額。
+    沒有單價階梯時，不足最小包裝的零頭 r 依最小階梯平均價計（與原本算法相同），
+    所以 best[q] = min(exact[q - r] + int(r * 最小階梯平均價))，r < 最小包裝份數。
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.has_unit = any(t[0] == 1 for t in tiers)
+        self.exact = [0]   # 剛好用階梯組出 q 份的最低金額（組不出來為 None）
+        self.best = [0]
+        self._lock = threading.Lock()
+
+    def _extend(self, quantity):
+        exact, best = self.exact, self.best
+        small_qty, small_price = self.tiers[0]
+        for q in range(len(exact), quantity + 1):
+            cost = None
+            for tier_qty, tier_price in self.tiers:
+                if tier_qty <= q and exact[q - tier_qty] is not None:
+                    candidate = exact[q - tier_qty] + tier_price
+                    if cost is None or candidate < cost:
+                        cost = candidate
+            exact.append(cost)
+
+            if self.has_unit:
+                best.append(cost)
+                continue
+            best_q = None
+            for r in range(0, min(small_qty, q + 1)):
+                base = exact[q - r]
+                if base is None:
+                    continue
+                candidate = base + int(r * small_price / small_qty)
+                if best_q is None or candidate < best_q:
+                    best_q = candidate
+            best.append(best_q)
+
+    def amount(self, quantity):
+        if quantity >= len(self.best):
+            with self._lock:
+                if quantity >= len(self.best):
+                    self._extend(quantity)
+        return self.best[quantity]
+
+
+@lru_cache(maxsize=1024)
+def _price_table(tiers):
+    """同一組價格階梯共用一張金額表"""
+    return PriceTable(tiers)
+
+
+def _greedy_amount(tiers, quantity):
+    """貪心法：優先使用大包裝（僅用於超過金額表上限的份數）"""
     remaining = quantity
     total = 0
-    for tier_qty, tier_price in tiers_desc:
+    for tier_qty, tier_price in reversed(tiers):
         if remaining >= tier_qty:
             count = remaining // tier_qty
             total += count * tier_price
@@ -331,6 +847,51 @@ def calculate_amount(price_info, quantity):
     return total
 
 
+def amount_for_tiers(tiers, quantity):
+    """用已解析的價格階梯計算最低金額（查表，不再解析文字）"""
+    if not tiers:
+        return None
+    if quantity < 0 or quantity > PRICE_TABLE_MAX_QTY:
+        return _greedy_amount(tiers, quantity)
+    return _price_table(tuple(tiers)).amount(quantity)
+
+
+def resolve_item(group_id, item_num):
+    """一次查詢所有 active buys 中的品項 item_num
+    回傳 (buy_row, item_name, err_msg)，規則同 resolve_buy_for_item
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    # LEFT JOIN：沒有該品項的團購也會回傳（name 為 NULL），用來區分「無團購」與「無品項」
+    c.execute(
+        """SELECT gb.*, i.name FROM group_buys gb
+           LEFT JOIN items i ON i.group_buy_id = gb.id AND i.item_num = ?
+           WHERE gb.group_id=? AND gb.status='open'
+           ORDER BY gb.buy_num, i.id""",
+        (item_num, group_id),
+    )
+    rows = c.fetchall()
+    if not rows:
+        return (None, None, None)
+
+    matched = []  # [(buy_row, item_name)]
+    seen = set()
+    for row in rows:
+        buy, name = row[:-1], row[-1]
+        if name is None or buy[0] in seen:
+            continue
+        seen.add(buy[0])
+        matched.append((buy, name))
+
+    if len(matched) == 1:
+        return (matched[0][0], matched[0][1], None)
+    elif len(matched) > 1:
+        hints = [f"  團購{buy[8]}：{name}" for buy, name in matched]
+        return (None, None, f"⚠️ 多個團購都有品項【{item_num}】，請用品名下單：\n" + '\n'.join(hints))
+    else:
+        return (None, None, f"⚠️ 沒有品項【{item_num}】，請確認編號。")
+
+
 def resolve_buy_for_item(group_id, item_num):
     """搜尋所有 active buys，找哪個有 item_num
     回傳 (buy_row, err_msg)
@@ -339,191 +900,829 @@ def resolve_buy_for_item(group_id, item_num):
     無匹配 → (None, "沒有品項【N】")
     無團購 → (None, None)
     """
-    buys = get_active_buys(group_id)
-    if not buys:
-        return (None, None)
-
-    matched = []
-    for buy in buys:
-        buy_id = buy[0]
-        name = get_item_name(buy_id, item_num)
-        if name:
-            matched.append(buy)
-
-    if len(matched) == 1:
-        return (matched[0], None)
-    elif len(matched) > 1:
-        hints = []
-        for buy in matched:
-            buy_num = buy[8]
-            name = get_item_name(buy[0], item_num)
-            hints.append(f"  團購{buy_num}：{name}")
-        return (None, f"⚠️ 多個團購都有品項【{item_num}】，請用品名下單：\n" + '\n'.join(hints))
-    else:
-        return (None, f"⚠️ 沒有品項【{item_num}】，請確認編號。")
+    buy, _, err = resolve_item(group_id, item_num)
+    return (buy, err)
 
 
 def check_item_progress(buy_id, item_num):
     """檢查品項的限量進度
     回傳進度字串（如 📊 【1】已訂 X/Y 份）或 None
     """
-    conn = sqlite3.connect(DB_PATH)
+    # 目錄快取知道品項不限量 → 不需查詢
+    limits = catalog_cache.limits_for(buy_id)
+    if limits is not None and limits.get(item_num) is None:
+        return None
+
+    conn = get_conn()
     c = conn.cursor()
     c.execute(
-        'SELECT max_quantity FROM items WHERE group_buy_id=? AND item_num=?',
+        'SELECT max_quantity, ordered_total FROM items WHERE group_buy_id=? AND item_num=?',
         (buy_id, item_num),
     )
     row = c.fetchone()
     if not row or row[0] is None:
-        conn.close()
         return None
 
-    max_qty = row[0]
+    max_qty, total = row
+
+    if total >= max_qty:
+        return f"🔴 【{item_num}】已額滿"
+    remaining = max_qty - total
+    return f"📊 【{item_num}】已訂 {total}/{max_qty} 份（剩餘 {remaining} 份）"
+
+
+def _rebuild_item_totals(c):
+    """依 orders 重算所有品項的 ordered_total"""
+    c.execute("""
+        UPDATE items SET ordered_total = COALESCE((
+            SELECT SUM(o.quantity) FROM orders o
+            WHERE o.group_buy_id = items.group_buy_id AND o.item_num = items.item_num
+        ), 0)
+    """)
+
+
+def check_item_totals(repair=False):
+    """一致性檢查：比對 items.ordered_total 與訂單實際加總
+    回傳有落差的品項 [(group_buy_id, item_num, stored, actual), ...]
+    repair=True 時在同一交易內重算所有品項
+    """
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT group_buy_id, item_num, ordered_total, actual FROM (
+                SELECT i.group_buy_id, i.item_num, i.ordered_total,
+                       COALESCE((SELECT SUM(o.quantity) FROM orders o
+                                 WHERE o.group_buy_id = i.group_buy_id AND o.item_num = i.item_num), 0) AS actual
+                FROM items i
+            ) WHERE ordered_total != actual
+        """)
+        drift = c.fetchall()
+        for buy_id, item_num, stored, actual in drift:
+            logger.warning(f"[totals] 團購 {buy_id} 品項 {item_num}：記錄 {stored}，實際 {actual}")
+        if repair and drift:
+            _rebuild_item_totals(c)
+    return drift
+
+
+def _all_items_full(c, buy_id):
+    """所有品項都有限量且都已額滿（讀 ordered_total，不需加總訂單）"""
     c.execute(
-        'SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE group_buy_id=? AND item_num=?',
-        (buy_id, item_num),
+        """SELECT COUNT(*),
+                  COALESCE(SUM(max_quantity IS NULL), 0),
+                  COALESCE(SUM(ordered_total < max_quantity), 0)
+           FROM items WHERE group_buy_id=?""",
+        (buy_id,),
     )
-    total = c.fetchone()[0]
-    conn.close()
+    n_items, n_unlimited, n_open = c.fetchone()
+    return bool(n_items) and not n_unlimited and not n_open
+
+
+def check_auto_close(buy_id, group_id):
+    """檢查是否所有限量品項都已額滿，若是則自動結團
+    - 若有任何品項 max_quantity IS NULL → 不自動結團
+    - 所有品項都有限量且都額滿 → 結團
+    回傳結團公告字串，或 None（未額滿，或已被其他請求結團）
+    """
+    # 先在交易外快速排除（絕大多數下單都不會額滿）；目錄快取中有不限量品項就不必查詢
+    limits = catalog_cache.limits_for(buy_id)
+    if limits is not None and (not limits or None in limits.values()):
+        return None
+    if not _all_items_full(get_conn().cursor(), buy_id):
+        return None
+
+    # 交易內重新確認並以條件式更新結團，同時額滿的兩筆下單只有一筆會公告
+    with write_txn() as conn:
+        c = conn.cursor()
+        if not _all_items_full(c, buy_id):
+            return None
+        c.execute("UPDATE group_buys SET status='closed' WHERE id=? AND status='open'", (buy_id,))
+        if c.rowcount == 0:
+            return None
+        record_order_event(c, buy_id, "auto_close")
+        bump_catalog_generation(c, group_id)
+        bump_buy_version(c, buy_id)
+
+    buy_list = format_buy_list(buy_id, show_label=True)
+    return f"\n\n🔒 所有限量品項已額滿，自動結團！\n\n{buy_list}"
+
+
+def render_item_block(item, item_orders):
+    """渲染單一品項的列表區塊，回傳 (lines, 小計份數, 小計金額)"""
+    item_num = item[2]
+    price_info = item[4] or item[3]
+    item_max_qty = item[5]  # max_quantity
+    tiers = item_tiers(item)  # 目錄快取中已解析好
+
+    # 品項標題（含限量標示）
+    lines = []
+    item_header = f"【{item_num}】"
+    info_lines = price_info.split('\n')
+    if item_max_qty:
+        item_header += f"{info_lines[0]}（限量 {item_max_qty} 份）"
+    else:
+        item_header += info_lines[0]
+    lines.append(item_header)
+    for extra in info_lines[1:]:
+        lines.append(f"　　{extra}")
+
+    subtotal = 0
+    item_amount = 0
+    if item_orders:
+        for o in item_orders:
+            name = o[4] or "（未知）"
+            qty = o[5]
+            subtotal += qty
+            person_amount = amount_for_tiers(tiers, qty)
+            if person_amount:
+                lines.append(f"   👤 {name} x{qty}　💰{person_amount}元")
+                item_amount += person_amount
+            else:
+                lines.append(f"   👤 {name} x{qty}")
+        item_amount_str = f"　💰{item_amount}元" if item_amount else ""
+        if item_max_qty:
+            remaining = item_max_qty - subtotal
+            lines.append(f"   小計：{subtotal}/{item_max_qty} 份（剩餘 {remaining} 份）{item_amount_str}")
+        else:
+            lines.append(f"   小計：{subtotal} 份{item_amount_str}")
+    else:
+        lines.append("   （尚無人下單）")
+
+    lines.append("")
+    return lines, subtotal, item_amount
+
+
+def format_list_summary(total_orders, total_amount):
+    """列表結尾的總計行"""
+    summary = f"共 {total_orders} 份訂單"
+    if total_amount:
+        summary += f"　💰總金額：{total_amount} 元"
+    return summary
+
+
+def format_buy_list(buy_id, show_label=False):
+    """格式化單一團購訂單列表（依團購版本號快取，見 render_cache）"""
+    return cached_render(buy_id, ("list", show_label), lambda: _render_buy_list(buy_id, show_label))
+
+
+def _render_buy_list(buy_id, show_label=False):
+    """格式化單一團購訂單列表（不經快取）"""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT title, buy_num FROM group_buys WHERE id=?', (buy_id,))
+    buy_row = c.fetchone()
+    if not buy_row:
+        return ""
+
+    title = buy_row[0]
+    buy_num = buy_row[1]
+
+    items = get_items(buy_id)
+    orders = get_orders(buy_id)
+
+    # 按品項分組訂單
+    orders_by_item = {}
+    for o in orders:
+        orders_by_item.setdefault(o[2], []).append(o)
+
+    label = f"[團購{buy_num}] " if show_label else ""
+    lines = [f"🛒 {label}{title}", "────────────────"]
+    total_orders = 0
+    total_amount = 0
+
+    for item in items:
+        block, subtotal, item_amount = render_item_block(item, orders_by_item.get(item[2], []))
+        lines.extend(block)
+        total_orders += subtotal
+        total_amount += item_amount
+
+    lines.append("────────────────")
+    lines.append(format_list_summary(total_orders, total_amount))
+
+    return '\n'.join(lines)
+
+
+# ══════════════════════════════════════════
+# 訂單事件帳本（order_events 為真實來源，orders 是投影）
+# ══════════════════════════════════════════
+
+ORDER_SNAPSHOT_INTERVAL = int(os.environ.get("ORDER_SNAPSHOT_INTERVAL", "500"))
+ORDER_SNAPSHOT_KEEP = int(os.environ.get("ORDER_SNAPSHOT_KEEP", "2"))   # 每個團購保留最近幾份快照
+
+# orders: {(item_num, user_name): [user_id, quantity, registered_by, seq]}，seq 為建立該筆訂單的事件 id
+LedgerState = namedtuple("LedgerState", ["orders", "closed", "last_event_id"])
+
+
+def record_order_event(c, buy_id, kind, item_num=None, user_id=None, user_name=None,
+                       quantity=None, registered_by=None):
+    """附加一筆訂單事件（需在寫入交易中呼叫，與 orders 投影的變動一起提交）
+    kind：add（加 quantity 份）/ set（改成 quantity 份）/ cancel / close / auto_close
+    """
+    c.execute(
+        """INSERT INTO order_events (group_buy_id, kind, item_num, user_id, user_name, quantity, registered_by)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (buy_id, kind, item_num, user_id, user_name, quantity, registered_by),
+    )
+    event_id = c.lastrowid
+    _maybe_snapshot(c, buy_id)
+    return event_id
+
+
+def _latest_snapshot(c, buy_id, upto=None):
+    """回傳 (last_event_id, state dict) 或 None"""
+    if upto is None:
+        c.execute(
+            """SELECT last_event_id, state FROM order_snapshots WHERE group_buy_id=?
+               ORDER BY last_event_id DESC LIMIT 1""",
+            (buy_id,),
+        )
+    else:
+        c.execute(
+            """SELECT last_event_id, state FROM order_snapshots WHERE group_buy_id=? AND last_event_id<=?
+               ORDER BY last_event_id DESC LIMIT 1""",
+            (buy_id, upto),
+        )
+    row = c.fetchone()
+    return (row[0], json.loads(row[1])) if row else None
+
+
+def _maybe_snapshot(c, buy_id):
+    """上次快照之後累積 ORDER_SNAPSHOT_INTERVAL 筆事件就再存一份快照，讓重播的事件數有上限"""
+    c.execute(
+        """SELECT COUNT(*) FROM order_events WHERE group_buy_id=? AND id > (
+               SELECT COALESCE(MAX(last_event_id), 0) FROM order_snapshots WHERE group_buy_id=?)""",
+        (buy_id, buy_id),
+    )
+    if c.fetchone()[0] >= ORDER_SNAPSHOT_INTERVAL:
+        take_order_snapshot(c, buy_id)
+
+
+def take_order_snapshot(c, buy_id):
+    """重播到最新事件並存成快照（需在寫入交易中呼叫）；沒有新事件時不存"""
+    state = replay_order_events(c, buy_id)
+    c.execute(
+        "SELECT COALESCE(MAX(last_event_id), 0) FROM order_snapshots WHERE group_buy_id=?", (buy_id,)
+    )
+    if state.last_event_id <= c.fetchone()[0]:
+        return None
+    payload = {
+        "closed": state.closed,
+        "orders": [[num, name, *row] for (num, name), row in state.orders.items()],
+    }
+    c.execute(
+        "INSERT INTO order_snapshots (group_buy_id, last_event_id, state) VALUES (?, ?, ?)",
+        (buy_id, state.last_event_id, json.dumps(payload, ensure_ascii=False)),
+    )
+    # 重播只需要最新的快照，較舊的刪掉，避免快照表無限成長
+    c.execute(
+        """DELETE FROM order_snapshots WHERE group_buy_id=? AND id NOT IN (
+               SELECT id FROM order_snapshots WHERE group_buy_id=? ORDER BY last_event_id DESC LIMIT ?)""",
+        (buy_id, buy_id, ORDER_SNAPSHOT_KEEP),
+    )
+    return state.last_event_id
+
+
+def replay_order_events(c, buy_id, upto=None):
+    """從最近的快照開始重播事件，回傳 LedgerState
+    upto 指定時只重播到該事件 id（含），用於還原到過去的狀態。
+    """
+    orders = {}
+    closed = False
+    last_event_id = 0
+    snapshot = _latest_snapshot(c, buy_id, upto)
+    if snapshot is not None:
+        last_event_id, state = snapshot
+        closed = state["closed"]
+        for num, name, user_id, qty, registered_by, seq in state["orders"]:
+            orders[(num, name)] = [user_id, qty, registered_by, seq]
+
+    sql = """SELECT id, kind, item_num, user_id, user_name, quantity, registered_by
+             FROM order_events WHERE group_buy_id=? AND id>?"""
+    args = [buy_id, last_event_id]
+    if upto is not None:
+        sql += " AND id<=?"
+        args.append(upto)
+    c.execute(sql + " ORDER BY id", args)
+    for event_id, kind, item_num, user_id, user_name, qty, registered_by in c:
+        last_event_id = event_id
+        key = (item_num, user_name)
+        if kind == "add":
+            row = orders.get(key)
+            if row is None:
+                orders[key] = [user_id, qty, registered_by, event_id]
+            else:
+                row[1] += qty
+        elif kind == "set":
+            row = orders.get(key)
+            if row is None:
+                orders[key] = [user_id, qty, registered_by, event_id]
+            else:
+                row[1] = qty
+        elif kind == "cancel":
+            orders.pop(key, None)
+        elif kind in ("close", "auto_close"):
+            closed = True
+    return LedgerState(orders, closed, last_event_id)
+
+
+def _projection_rows(c, buy_id):
+    c.execute(
+        "SELECT item_num, user_name, user_id, quantity, registered_by FROM orders WHERE group_buy_id=?",
+        (buy_id,),
+    )
+    return {(num, name): (user_id, qty, registered_by) for num, name, user_id, qty, registered_by in c.fetchall()}
+
+
+def rebuild_orders(c, buy_id, state=None):
+    """由事件帳本重建團購的 orders 與 ordered_total（需在寫入交易中呼叫）"""
+    if state is None:
+        state = replay_order_events(c, buy_id)
+    c.execute("DELETE FROM orders WHERE group_buy_id=?", (buy_id,))
+    c.executemany(
+        """INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity, registered_by)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        [(buy_id, num, row[0], name, row[1], row[2])
+         for (num, name), row in sorted(state.orders.items(), key=lambda kv: kv[1][3])],
+    )
+    c.execute("""
+        UPDATE items SET ordered_total = COALESCE((
+            SELECT SUM(o.quantity) FROM orders o
+            WHERE o.group_buy_id = items.group_buy_id AND o.item_num = items.item_num
+        ), 0) WHERE group_buy_id=?
+    """, (buy_id,))
+    bump_buy_version(c, buy_id)
+
+
+def check_order_projection(repair=False):
+    """一致性檢查：比對 orders 與事件帳本重播的結果
+    回傳有落差的團購 id list；repair=True 時在同一交易內由帳本重建這些團購的 orders
+    """
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT group_buy_id FROM order_events UNION SELECT DISTINCT group_buy_id FROM orders")
+        drift = []
+        for (buy_id,) in c.fetchall():
+            state = replay_order_events(c, buy_id)
+            expected = {key: (row[0], row[1], row[2]) for key, row in state.orders.items()}
+            if expected != _projection_rows(c, buy_id):
+                logger.warning(f"[ledger] 團購 {buy_id} 的 orders 與事件帳本不一致")
+                drift.append(buy_id)
+                if repair:
+                    rebuild_orders(c, buy_id, state)
+    return drift
+
+
+def revert_order_events(buy_id, event_ids):
+    """撤銷指定的訂單事件（例如一次錯誤的 AI 下單），其他人的訂單與之後的正常操作不受影響
+    只重算這些事件影響到的 (品項, 下單名字)：略過被撤銷的事件重播，與目前狀態的差異
+    以補償事件（set / cancel）附加在帳本後面，帳本不刪改。
+    增加的份數與下單一樣要佔用限量（adjust_item_total），額度不足時整批不還原。
+    回傳 (err_msg, 補償事件數, 自動結團公告或 None)：err_msg 非 None 表示未寫入
+    """
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT status, group_id FROM group_buys WHERE id=?", (buy_id,))
+        row = c.fetchone()
+        if not row or row[0] != 'open':
+            return "⚠️ 此團購已結團，無法還原。", 0, None
+        group_id = row[1]
+
+        reverted = set(event_ids)
+        marks = ",".join("?" * len(reverted))
+        c.execute(
+            f"""SELECT DISTINCT item_num, user_name FROM order_events
+                WHERE group_buy_id=? AND id IN ({marks}) AND kind IN ('add', 'set', 'cancel')""",
+            (buy_id, *reverted),
+        )
+        compensations = []   # (kind, item_num, user_id, user_name, quantity, registered_by)
+        deltas = {}          # item_num → 份數變化
+        for item_num, user_name in c.fetchall():
+            c.execute(
+                """SELECT id, kind, user_id, quantity, registered_by FROM order_events
+                   WHERE group_buy_id=? AND item_num=? AND user_name IS ? ORDER BY id""",
+                (buy_id, item_num, user_name),
+            )
+            current = desired = None   # [user_id, quantity, registered_by]
+            for event_id, kind, user_id, qty, registered_by in c.fetchall():
+                current = _apply_key_event(current, kind, user_id, qty, registered_by)
+                if event_id not in reverted:
+                    desired = _apply_key_event(desired, kind, user_id, qty, registered_by)
+            if desired is None and current is not None:
+                compensations.append(("cancel", item_num, current[0], user_name, None, None))
+            elif desired is not None and (current is None or current[1] != desired[1]):
+                compensations.append(("set", item_num, desired[0], user_name, desired[1], desired[2]))
+            else:
+                continue
+            old_qty = current[1] if current else 0
+            new_qty = desired[1] if desired else 0
+            deltas[item_num] = deltas.get(item_num, 0) + new_qty - old_qty
+
+        # 先佔用限量；任一品項額度不足就把已佔用的退回，整批不寫入
+        reserved = []
+        for item_num, delta in sorted(deltas.items()):
+            if not adjust_item_total(c, buy_id, item_num, delta):
+                for num, d in reserved:
+                    adjust_item_total(c, buy_id, num, -d)
+                c.execute(
+                    "SELECT name, max_quantity, ordered_total FROM items WHERE group_buy_id=? AND item_num=?",
+                    (buy_id, item_num),
+                )
+                name, max_qty, total = c.fetchone()
+                return f"⚠️ 【{item_num}】{name} 剩餘 {max_qty - total} 份，無法還原 {delta} 份", 0, None
+            reserved.append((item_num, delta))
+
+        for kind, item_num, user_id, user_name, qty, registered_by in compensations:
+            record_order_event(c, buy_id, kind, item_num, user_id, user_name, qty, registered_by)
+        if compensations:
+            rebuild_orders(c, buy_id)
+
+    # 還原後可能剛好補滿限量
+    auto_close = check_auto_close(buy_id, group_id) if compensations else None
+    return None, len(compensations), auto_close
+
+
+def _apply_key_event(row, kind, user_id, qty, registered_by):
+    """單一 (品項, 下單名字) 的事件套用（與 replay_order_events 相同規則）"""
+    if kind == "cancel":
+        return None
+    if row is None:
+        return [user_id, qty, registered_by]
+    return [row[0], row[1] + qty if kind == "add" else qty, row[2]]
+
+
+# ══════════════════════════════════════════
+# 訂單統計（本地計算：SQL GROUP BY + 價格階梯）
+# ══════════════════════════════════════════
+
+ItemStat = namedtuple("ItemStat", ["item_num", "name", "quantity", "amount", "buyers"])
+PersonStat = namedtuple("PersonStat", ["name", "lines", "quantity", "amount"])  # lines: [(item_num, qty, amount), ...]
+BuyStats = namedtuple("BuyStats", ["items", "people", "quantity", "amount"])
+
+
+def compute_buy_stats(buy_id, items=None):
+    """計算團購的品項統計、人員統計與總計
+    每人每品項的金額依該品項的價格階梯計算（與 format_buy_list 相同）。
+    """
+    if items is None:
+        items = get_items(buy_id)
+    c = get_conn().cursor()
+    c.execute(
+        """SELECT user_name, item_num, SUM(quantity) FROM orders WHERE group_buy_id=?
+           GROUP BY user_name, item_num ORDER BY MIN(id)""",
+        (buy_id,),
+    )
+    rows = c.fetchall()
+
+    tiers = {item[2]: item_tiers(item) for item in items}
+    item_totals = {}   # item_num → [quantity, amount, buyers]
+    people = {}        # name → [lines, quantity, amount]（依第一筆下單順序）
+    for user_name, item_num, qty in rows:
+        name = user_name or "（未知）"
+        amount = amount_for_tiers(tiers.get(item_num, ()), qty) or 0
+        totals = item_totals.setdefault(item_num, [0, 0, 0])
+        totals[0] += qty
+        totals[1] += amount
+        totals[2] += 1
+        person = people.setdefault(name, [[], 0, 0])
+        person[0].append((item_num, qty, amount))
+        person[1] += qty
+        person[2] += amount
+
+    item_stats = []
+    for item in items:
+        qty, amount, buyers = item_totals.get(item[2], (0, 0, 0))
+        item_stats.append(ItemStat(item[2], item[3], qty, amount, buyers))
+    person_stats = [PersonStat(name, sorted(p[0]), p[1], p[2]) for name, p in people.items()]
+    return BuyStats(
+        item_stats,
+        person_stats,
+        sum(p.quantity for p in person_stats),
+        sum(p.amount for p in person_stats),
+    )
+
+
+def format_stats_report(title, buy_num, stats, show_label=False):
+    """格式化本地統計報告（品項統計 / 人員統計 / 總計）"""
+    label = f"[團購{buy_num}] " if show_label else ""
+    lines = [f"📊 {label}{title} 訂單統計", "━━━━━━━━━━━━━━", "【品項統計】"]
+    for item in stats.items:
+        if not item.quantity:
+            lines.append(f"【{item.item_num}】{item.name}：尚無人下單")
+            continue
+        amount_str = f"　💰{item.amount}元" if item.amount else ""
+        lines.append(f"【{item.item_num}】{item.name}：{item.quantity} 份（{item.buyers} 人）{amount_str}")
+
+    lines += ["", "【人員統計】"]
+    for person in stats.people:
+        bought = "、".join(f"【{num}】x{qty}" for num, qty, _ in person.lines)
+        amount_str = f"　💰{person.amount}元" if person.amount else ""
+        lines.append(f"👤 {person.name}：{bought}{amount_str}")
+
+    lines += ["", "━━━━━━━━━━━━━━"]
+    total = f"共 {stats.quantity} 份，{len(stats.people)} 人"
+    if stats.amount:
+        total += f"　💰總金額：{stats.amount} 元"
+    lines.append(total)
+    return '\n'.join(lines)
+
+
+
+# ══════════════════════════════════════════
+# 通用快取（TTL + LRU）
+# ══════════════════════════════════════════
+
+class _Flight:
+    """同一個 key 正在載入中的查詢，其他執行緒等它的結果"""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """有上限的 TTL + LRU 快取
+    - 結果為 None 視為查詢失敗，只快取 negative_ttl 秒（避免一直重打失敗的 API）
+    - 同一個 key 同時有多個執行緒查詢時只載入一次（single-flight），其他執行緒等結果
+    - loader 拋出例外時不快取，例外會傳給所有等待中的呼叫端
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()   # key → (expires_at, value)
+        self._inflight = {}          # key → _Flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+        with self._lock:
+            self._inflight.pop(key, None)
+            if flight.error is None:
+                ttl = self.ttl if flight.value is not None else self.negative_ttl
+                if ttl > 0:
+                    self._data[key] = (time.monotonic() + ttl, flight.value)
+                    self._data.move_to_end(key)
+                    while len(self._data) > self.maxsize:
+                        self._data.popitem(last=False)
+        flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "saved": self.hits + self.coalesced,   # 省下的載入次數
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            }
+
+
+# ══════════════════════════════════════════
+# 列表分頁（逐頁產生，每頁只查該頁品項的訂單）
+# ══════════════════════════════════════════
 
-    if total >= max_qty:
-        return f"🔴 【{item_num}】已額滿"
-    remaining = max_qty - total
-    return f"📊 【{item_num}】已訂 {total}/{max_qty} 份（剩餘 {remaining} 份）"
+LINE_MESSAGE_LIMIT = 5000   # LINE 單則文字訊息上限（字元）
+LINE_MAX_MESSAGES = 5       # 一次 reply 最多 5 則訊息
+LIST_PAGE_ITEMS = int(os.environ.get("LIST_PAGE_ITEMS", "10"))
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "512"))
+RENDER_CACHE_TTL = float(os.environ.get("RENDER_CACHE_TTL", "600"))
 
+# 列表渲染結果，key = (DB_PATH, buy_id, 版本號, 渲染參數)
+# 版本號存在 DB（buy_versions），與訂單變動在同一交易遞增，其他 worker 寫入後 key 自然換掉；
+# 舊版本的項目不會再被讀到，由 LRU / TTL 淘汰。
+render_cache = TTLCache(RENDER_CACHE_SIZE, RENDER_CACHE_TTL)
 
-def check_auto_close(buy_id, group_id):
-    """檢查是否所有限量品項都已額滿，若是則自動結團
-    - 若有任何品項 max_quantity IS NULL → 不自動結團
-    - 所有品項都有限量且都額滿 → 結團
-    回傳結團公告字串，或 None
-    """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
 
-    # 取所有品項的 max_quantity
-    c.execute('SELECT item_num, max_quantity FROM items WHERE group_buy_id=?', (buy_id,))
-    items = c.fetchall()
-    if not items:
-        conn.close()
-        return None
+def cached_render(buy_id, variant, render):
+    """先讀版本號再渲染：渲染看到的資料只會比版本號新，不會把舊資料存到新版本下"""
+    key = (DB_PATH, buy_id, get_buy_version(buy_id), variant)
+    return render_cache.get_or_load(key, render)
 
-    # 若有任何品項無限量 → 不自動結團
-    if any(item[1] is None for item in items):
-        conn.close()
-        return None
 
-    # 逐品項檢查是否額滿
-    all_full = True
-    for item_num, max_qty in items:
-        c.execute(
-            'SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE group_buy_id=? AND item_num=?',
-            (buy_id, item_num),
-        )
-        total = c.fetchone()[0]
-        if total < max_qty:
-            all_full = False
-            break
 
-    if all_full:
-        c.execute("UPDATE group_buys SET status='closed' WHERE id=?", (buy_id,))
-        conn.commit()
-        conn.close()
+def get_items_page(buy_id, offset, limit):
+    """取得團購某一段品項（目錄快取有就切片，否則 LIMIT/OFFSET 查詢）"""
+    cached = catalog_cache.items_for(buy_id)
+    if cached is not None:
+        return list(cached[offset:offset + limit])
+    c = get_conn().cursor()
+    c.execute(
+        """SELECT id, group_buy_id, item_num, name, price_info, max_quantity FROM items
+           WHERE group_buy_id=? ORDER BY item_num LIMIT ? OFFSET ?""",
+        (buy_id, limit, offset),
+    )
+    return c.fetchall()
 
-        buy_list = format_buy_list(buy_id, show_label=True)
-        return f"\n\n🔒 所有限量品項已額滿，自動結團！\n\n{buy_list}"
+
+def list_page_count(buy_id):
+    """團購列表的總頁數（至少 1 頁）"""
+    cached = catalog_cache.items_for(buy_id)
+    if cached is not None:
+        n_items = len(cached)
     else:
-        conn.close()
-        return None
+        c = get_conn().cursor()
+        c.execute("SELECT COUNT(*) FROM items WHERE group_buy_id=?", (buy_id,))
+        n_items = c.fetchone()[0]
+    return max(1, -(-n_items // LIST_PAGE_ITEMS))
 
 
-def format_buy_list(buy_id, show_label=False):
-    """格式化單一團購訂單列表"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT title, buy_num FROM group_buys WHERE id=?', (buy_id,))
-    buy_row = c.fetchone()
-    conn.close()
-    if not buy_row:
-        return ""
+def list_totals(buy_id):
+    """整團的 (總份數, 總金額)，供最後一頁的總計行使用（依團購版本號快取）
+    金額依每筆訂單的份數套用價格階梯，所以依 (品項, 份數) 分組：只回傳彙總列，不載入訂單明細。
+    """
+    return cached_render(buy_id, ("totals",), lambda: _compute_list_totals(buy_id))
 
-    title = buy_row[0]
-    buy_num = buy_row[1]
 
-    items = get_items(buy_id)
-    orders = get_orders(buy_id)
+def _compute_list_totals(buy_id):
+    c = get_conn().cursor()
+    c.execute(
+        "SELECT item_num, quantity, COUNT(*) FROM orders WHERE group_buy_id=? GROUP BY item_num, quantity",
+        (buy_id,),
+    )
+    tiers = {item[2]: item_tiers(item) for item in get_items(buy_id)}
+    total_orders = 0
+    total_amount = 0
+    for item_num, qty, n in c.fetchall():
+        total_orders += qty * n
+        total_amount += (amount_for_tiers(tiers.get(item_num, ()), qty) or 0) * n
+    return total_orders, total_amount
 
-    # 按品項分組訂單
+
+def _render_page_block(buy_id, page):
+    """第 page 頁的品項區塊，回傳 (lines, 小計份數, 小計金額)；只查這一頁品項範圍內的訂單"""
+    items = get_items_page(buy_id, (page - 1) * LIST_PAGE_ITEMS, LIST_PAGE_ITEMS)
     orders_by_item = {}
-    for o in orders:
-        orders_by_item.setdefault(o[2], []).append(o)
+    if items:
+        c = get_conn().cursor()
+        c.execute(
+            "SELECT * FROM orders WHERE group_buy_id=? AND item_num BETWEEN ? AND ? ORDER BY item_num, id",
+            (buy_id, items[0][2], items[-1][2]),
+        )
+        for o in c.fetchall():
+            orders_by_item.setdefault(o[2], []).append(o)
 
-    label = f"[團購{buy_num}] " if show_label else ""
-    lines = [f"🛒 {label}{title}", "────────────────"]
+    lines = []
     total_orders = 0
     total_amount = 0
-    has_price = False
-
     for item in items:
-        item_num = item[2]
-        price_info = item[4] or item[3]
-        item_max_qty = item[5]  # max_quantity
+        block, subtotal, item_amount = render_item_block(item, orders_by_item.get(item[2], []))
+        lines.extend(block)
+        total_orders += subtotal
+        total_amount += item_amount
+    return lines, total_orders, total_amount
 
-        # 品項標題（含限量標示）
-        item_header = f"【{item_num}】"
-        info_lines = price_info.split('\n')
-        if item_max_qty:
-            item_header += f"{info_lines[0]}（限量 {item_max_qty} 份）"
-        else:
-            item_header += info_lines[0]
-        lines.append(item_header)
-        for extra in info_lines[1:]:
-            lines.append(f"　　{extra}")
 
-        item_orders = orders_by_item.get(item_num, [])
-        if item_orders:
-            subtotal = 0
-            item_amount = 0
-            for o in item_orders:
-                name = o[4] or "（未知）"
-                qty = o[5]
-                subtotal += qty
-                person_amount = calculate_amount(price_info, qty)
-                if person_amount:
-                    lines.append(f"   👤 {name} x{qty}　💰{person_amount}元")
-                    item_amount += person_amount
-                else:
-                    lines.append(f"   👤 {name} x{qty}")
-            total_orders += subtotal
-            item_amount_str = ""
-            if item_amount:
-                total_amount += item_amount
-                has_price = True
-                item_amount_str = f"　💰{item_amount}元"
-            if item_max_qty:
-                remaining = item_max_qty - subtotal
-                lines.append(f"   小計：{subtotal}/{item_max_qty} 份（剩餘 {remaining} 份）{item_amount_str}")
-            else:
-                lines.append(f"   小計：{subtotal} 份{item_amount_str}")
-        else:
-            lines.append("   （尚無人下單）")
+def render_list_page(buy, page, pages, show_label=False, next_hint=True):
+    """渲染團購列表的第 page 頁（buy 為 group_buys 列，依團購版本號快取）
+    只查這一頁品項範圍內的訂單；最後一頁的總計用 list_totals 的彙總查詢。只有一頁時輸出與 format_buy_list 相同。
+    """
+    return cached_render(
+        buy[0], ("page", page, pages, show_label, next_hint),
+        lambda: _render_list_page(buy, page, pages, show_label, next_hint),
+    )
 
-        lines.append("")
 
-    lines.append("────────────────")
-    summary = f"共 {total_orders} 份訂單"
-    if has_price:
-        summary += f"　💰總金額：{total_amount} 元"
-    lines.append(summary)
+def _render_list_page(buy, page, pages, show_label, next_hint):
+    buy_id, title, buy_num = buy[0], buy[2], buy[8]
+    block, page_orders, page_amount = _render_page_block(buy_id, page)
 
+    label = f"[團購{buy_num}] " if show_label else ""
+    header = f"🛒 {label}{title}"
+    if pages > 1:
+        header += f"（第 {page}/{pages} 頁）"
+    lines = [header, "────────────────", *block, "────────────────"]
+    if page < pages:
+        if next_hint:
+            lines.append(f"➡️ 下一頁請輸入「列表 {buy_num} 頁{page + 1}」")
+    elif pages == 1:
+        lines.append(format_list_summary(page_orders, page_amount))
+    else:
+        lines.append(format_list_summary(*list_totals(buy_id)))
     return '\n'.join(lines)
 
 
+def iter_list_pages(buys, show_label=False):
+    """依序逐頁產生 (buy, page, pages, text)；呼叫端停止迭代後就不再查詢"""
+    for buy in buys:
+        pages = list_page_count(buy[0])
+        for page in range(1, pages + 1):
+            yield buy, page, pages, render_list_page(buy, page, pages, show_label, next_hint=False)
+
+
+def pack_list_pages(buys, show_label=False):
+    """把列表頁面依序裝進最多 LINE_MAX_MESSAGES 則訊息
+    單頁超過上限時依換行切開；放不下的頁面不渲染，最後一則附上「列表 N 頁M」接續提示。
+    """
+    limit = LINE_MESSAGE_LIMIT - 100  # 保留接續提示的空間
+    messages = []
+    current = ""
+    for buy, page, pages, text in iter_list_pages(buys, show_label):
+        for chunk in split_message(text, limit):
+            if current and len(current) + 2 + len(chunk) <= limit:
+                current += "\n\n" + chunk
+                continue
+            if current:
+                if len(messages) + 1 == LINE_MAX_MESSAGES:
+                    messages.append(current + f"\n\n⋯ 還有更多品項，請輸入「列表 {buy[8]} 頁{page}」繼續查看")
+                    return messages
+                messages.append(current)
+            current = chunk
+    messages.append(current)
+    return messages
+
+
+def split_message(text, limit=LINE_MESSAGE_LIMIT):
+    """依換行把過長的文字切成多段，每段不超過 limit 字元"""
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = []
+    size = 0
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and size + 1 + len(line) > limit:
+            chunks.append('\n'.join(current))
+            current, size = [], 0
+        size += len(line) + (1 if current else 0)
+        current.append(line)
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+def reply_messages(reply):
+    """把回覆（字串或字串清單）切成最多 LINE_MAX_MESSAGES 則、每則不超過上限的訊息"""
+    parts = [reply] if isinstance(reply, str) else reply
+    chunks = [chunk for part in parts for chunk in split_message(part)]
+    if len(chunks) > LINE_MAX_MESSAGES:
+        notice = "\n\n⋯（訊息過長，其餘內容未顯示）"
+        chunks = chunks[:LINE_MAX_MESSAGES]
+        chunks[-1] = chunks[-1][:LINE_MESSAGE_LIMIT - len(notice)] + notice
+    return chunks
+
 # ══════════════════════════════════════════
 # 通用輔助函式
 # ══════════════════════════════════════════
 
-def get_user_name(event, group_id, user_id):
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "2048"))
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "600"))
+PROFILE_NEGATIVE_TTL = float(os.environ.get("PROFILE_NEGATIVE_TTL", "60"))
+
+# LINE 顯示名稱快取，key = (group_id, user_id)
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_NEGATIVE_TTL)
+
+
+def _fetch_user_name(event, group_id, user_id):
     try:
         if event.source.type == "group":
             profile = line_bot_api.get_group_member_profile(group_id, user_id)
@@ -534,6 +1733,13 @@ def get_user_name(event, group_id, user_id):
         return None
 
 
+def get_user_name(event, group_id, user_id):
+    """取得 LINE 顯示名稱（經 profile_cache，失敗時回傳 None）"""
+    return profile_cache.get_or_load(
+        (group_id, user_id), lambda: _fetch_user_name(event, group_id, user_id)
+    )
+
+
 def source_id(event):
     src = event.source
     if src.type == "group":
@@ -648,32 +1854,30 @@ def cmd_open(group_id, user_id, user_name, text):
             for item_num in item_limits:
                 item_limits[item_num] = global_limit
 
-    # 計算 buy_num = 群組內最大 buy_num + 1
+    # 計算 buy_num = 群組內最大 buy_num + 1（與寫入同一交易，避免同時開團拿到相同編號）
     existing_buys = get_active_buys(group_id)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "SELECT COALESCE(MAX(buy_num), 0) FROM group_buys WHERE group_id=?",
-        (group_id,),
-    )
-    max_num = c.fetchone()[0]
-    buy_num = max_num + 1
-
-    # group_buys.max_quantity 不再使用，設為 None
-    c.execute(
-        "INSERT INTO group_buys (group_id, title, description, creator_id, creator_name, buy_num, max_quantity) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (group_id, title, full_text, user_id, user_name, buy_num, None),
-    )
-    buy_id = c.lastrowid
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT COALESCE(MAX(buy_num), 0) FROM group_buys WHERE group_id=?",
+            (group_id,),
+        )
+        max_num = c.fetchone()[0]
+        buy_num = max_num + 1
 
-    for item_num, name, price_info in items_list:
+        # group_buys.max_quantity 不再使用，設為 None
         c.execute(
-            "INSERT INTO items (group_buy_id, item_num, name, price_info, max_quantity) VALUES (?, ?, ?, ?, ?)",
-            (buy_id, item_num, name, price_info, item_limits.get(item_num)),
+            "INSERT INTO group_buys (group_id, title, description, creator_id, creator_name, buy_num, max_quantity) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (group_id, title, full_text, user_id, user_name, buy_num, None),
         )
+        buy_id = c.lastrowid
 
-    conn.commit()
-    conn.close()
+        for item_num, name, price_info in items_list:
+            c.execute(
+                "INSERT INTO items (group_buy_id, item_num, name, price_info, max_quantity) VALUES (?, ?, ?, ?, ?)",
+                (buy_id, item_num, name, price_info, item_limits.get(item_num)),
+            )
+        bump_catalog_generation(c, group_id)
 
     # 多團購時顯示標籤
     other_buys = [b for b in existing_buys]  # existing_buys 是開團前的 active buys
@@ -713,34 +1917,84 @@ def cmd_open(group_id, user_id, user_name, text):
     return '\n'.join(lines)
 
 
-def cmd_order(group_id, user_id, user_name, text, target_buy=None, skip_auto_close=False):
-    """下單：+N / +N 數量 / +N 名字 / +N 名字 數量"""
-    # 解析指令
-    m = re.match(r'\+(\d+)(?:\s+(.*))?$', text)
-    if not m:
-        return None
-    item_num = int(m.group(1))
-    rest = m.group(2).strip() if m.group(2) else ""
+def adjust_item_total(c, buy_id, item_num, delta):
+    """調整品項已訂數量 ordered_total（需在寫入交易中呼叫）
+    delta > 0 且超過限量時不更新，回傳 False；其餘回傳 True
+    """
+    if delta == 0:
+        return True
+    c.execute(
+        """UPDATE items SET ordered_total = ordered_total + ?
+           WHERE group_buy_id=? AND item_num=?
+             AND (? < 0 OR max_quantity IS NULL OR ordered_total + ? <= max_quantity)""",
+        (delta, buy_id, item_num, delta, delta),
+    )
+    return c.rowcount > 0
 
-    # 決定目標團購
-    if target_buy:
-        active = target_buy
+
+def reserve_order(c, buy_id, item_num, item_name, user_id, order_name, quantity, explicit_qty, registered_by):
+    """在呼叫端的寫入交易（write_txn）中檢查限量並寫入訂單
+    限量檢查與寫入在同一交易內完成，併發下單不會超賣。
+    回傳 (err_msg, existing, total)：err_msg 非 None 表示未寫入
+    """
+    # 交易內再確認一次團購仍在進行中（可能剛被自動結團）
+    c.execute("SELECT status FROM group_buys WHERE id=?", (buy_id,))
+    status_row = c.fetchone()
+    if not status_row or status_row[0] != 'open':
+        return "⚠️ 此團購已結團，無法再下單。", None, 0
+
+    # 查詢是否已有同品項同名的訂單
+    c.execute(
+        "SELECT id, quantity FROM orders WHERE group_buy_id=? AND item_num=? AND user_name=?",
+        (buy_id, item_num, order_name),
+    )
+    existing = c.fetchone()
+
+    # 計算 delta（新增量）
+    old_qty = existing[1] if existing else 0
+    if explicit_qty:
+        new_qty = quantity
     else:
-        active, err = resolve_buy_for_item(group_id, item_num)
-        if err:
-            return err
-        if not active:
-            return None  # 沒有進行中的團購，靜默
+        new_qty = old_qty + quantity
+    delta = new_qty - old_qty
 
-    buy_id = active[0]
-    buy_num = active[8]
+    # per-item 限量檢查：條件式更新 ordered_total，額度不足時不會更新任何列
+    if not adjust_item_total(c, buy_id, item_num, delta):
+        c.execute(
+            'SELECT max_quantity, ordered_total FROM items WHERE group_buy_id=? AND item_num=?',
+            (buy_id, item_num),
+        )
+        item_row = c.fetchone()
+        if not item_row or item_row[0] is None:
+            return f"⚠️ 沒有品項【{item_num}】，請確認編號。", existing, old_qty
+        item_max_qty, current_item_total = item_row
+        remaining = item_max_qty - current_item_total
+        if remaining <= 0:
+            return f"⚠️ 【{item_num}】{item_name} 已額滿（限量 {item_max_qty} 份）", existing, old_qty
+        return f"⚠️ 【{item_num}】{item_name} 剩餘 {remaining} 份，無法再加 {delta} 份", existing, old_qty
 
-    # 確認品項存在
-    item_name = get_item_name(buy_id, item_num)
-    if not item_name:
-        return f"⚠️ 沒有品項【{item_num}】，請確認編號。"
+    if existing:
+        c.execute("UPDATE orders SET quantity=? WHERE id=?", (new_qty, existing[0]))
+        total = new_qty
+    else:
+        c.execute(
+            "INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity, registered_by) VALUES (?, ?, ?, ?, ?, ?)",
+            (buy_id, item_num, user_id, order_name, quantity, registered_by),
+        )
+        total = quantity
+    record_order_event(c, buy_id, "set" if explicit_qty else "add", item_num,
+                       user_id, order_name, quantity, registered_by)
+    bump_buy_version(c, buy_id)
+    return None, existing, total
+
+
+QTY_RE = re.compile(r'^(\d+)\s*[份個包組盒袋條]?$')
 
-    # 解析 rest：數量 / 名字 / 名字 數量
+
+def parse_order_rest(rest, user_name):
+    """解析 +N 後面的文字：數量 / 名字 / 名字 數量
+    回傳 (order_name, quantity, explicit_qty, registered_by)
+    """
     order_name = user_name or "（未知）"
     quantity = 1
     explicit_qty = False  # 是否明確指定數量
@@ -748,7 +2002,7 @@ def cmd_order(group_id, user_id, user_name, text, target_buy=None, skip_auto_clo
 
     if rest:
         # 嘗試判斷：純數字 或 數字+單位(份/個/包/組/盒/袋/條) → 數量
-        qty_m = re.match(r'^(\d+)\s*[份個包組盒袋條]?$', rest)
+        qty_m = QTY_RE.match(rest)
         if qty_m:
             quantity = int(qty_m.group(1))
             explicit_qty = True
@@ -756,7 +2010,7 @@ def cmd_order(group_id, user_id, user_name, text, target_buy=None, skip_auto_clo
             # 名字 [數量]
             parts = rest.rsplit(None, 1)
             if len(parts) == 2:
-                qty_m2 = re.match(r'^(\d+)\s*[份個包組盒袋條]?$', parts[1])
+                qty_m2 = QTY_RE.match(parts[1])
                 if qty_m2:
                     order_name = parts[0]
                     quantity = int(qty_m2.group(1))
@@ -769,69 +2023,67 @@ def cmd_order(group_id, user_id, user_name, text, target_buy=None, skip_auto_clo
                 order_name = rest
                 registered_by = user_name
 
-    if quantity < 1:
-        return "⚠️ 數量必須大於 0"
+    return order_name, quantity, explicit_qty, registered_by
 
-    # 查詢是否已有同品項同名的訂單
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, quantity FROM orders WHERE group_buy_id=? AND item_num=? AND user_name=?",
-        (buy_id, item_num, order_name),
-    )
-    existing = c.fetchone()
 
-    # 計算 delta（新增量）
-    old_qty = existing[1] if existing else 0
-    if explicit_qty:
-        new_qty = quantity
-    else:
-        new_qty = old_qty + quantity
-    delta = new_qty - old_qty
+# 一筆待寫入的訂單：buy 為 group_buys row
+OrderLine = namedtuple(
+    "OrderLine",
+    ["buy", "item_num", "item_name", "order_name", "quantity", "explicit_qty", "registered_by"],
+)
 
-    # per-item 限量檢查
-    c.execute(
-        'SELECT max_quantity FROM items WHERE group_buy_id=? AND item_num=?',
-        (buy_id, item_num),
-    )
-    item_row = c.fetchone()
-    item_max_qty = item_row[0] if item_row else None
 
-    if item_max_qty is not None and delta > 0:
-        c.execute(
-            'SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE group_buy_id=? AND item_num=?',
-            (buy_id, item_num),
-        )
-        current_item_total = c.fetchone()[0]
-        if current_item_total + delta > item_max_qty:
-            conn.close()
-            remaining = item_max_qty - current_item_total
-            if remaining <= 0:
-                return f"⚠️ 【{item_num}】{item_name} 已額滿（限量 {item_max_qty} 份）"
-            else:
-                return f"⚠️ 【{item_num}】{item_name} 剩餘 {remaining} 份，無法再加 {delta} 份"
+def format_order_result(line, existing, total, multi):
+    """下單成功的回覆（多團購時加上 [團購N] 標籤）"""
+    label = f"[團購{line.buy[8]}] " if multi else ""
+    if line.explicit_qty and existing:
+        return f"✅ {label}{line.order_name}【{line.item_num}】{line.item_name} → {total} 份"
+    return f"✅ {label}{line.order_name}【{line.item_num}】{line.item_name} +{line.quantity}份（共 {total} 份）"
 
-    if existing:
-        c.execute("UPDATE orders SET quantity=? WHERE id=?", (new_qty, existing[0]))
-        total = new_qty
+
+def cmd_order(group_id, user_id, user_name, text, target_buy=None, skip_auto_close=False):
+    """下單：+N / +N 數量 / +N 名字 / +N 名字 數量"""
+    # 解析指令
+    m = re.match(r'\+(\d+)(?:\s+(.*))?$', text)
+    if not m:
+        return None
+    item_num = int(m.group(1))
+    rest = m.group(2).strip() if m.group(2) else ""
+
+    # 決定目標團購（resolve_item 已一併查出品名）
+    if target_buy:
+        active = target_buy
+        item_name = get_item_name(active[0], item_num)
     else:
-        c.execute(
-            "INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity, registered_by) VALUES (?, ?, ?, ?, ?, ?)",
-            (buy_id, item_num, user_id, order_name, quantity, registered_by),
-        )
-        total = quantity
+        active, item_name, err = resolve_item(group_id, item_num)
+        if err:
+            return err
+        if not active:
+            return None  # 沒有進行中的團購，靜默
 
-    conn.commit()
-    conn.close()
+    buy_id = active[0]
+
+    # 確認品項存在
+    if not item_name:
+        return f"⚠️ 沒有品項【{item_num}】，請確認編號。"
+
+    order_name, quantity, explicit_qty, registered_by = parse_order_rest(rest, user_name)
+
+    if quantity < 1:
+        return "⚠️ 數量必須大於 0"
+
+    with write_txn() as conn:
+        err, existing, total = reserve_order(
+            conn.cursor(), buy_id, item_num, item_name,
+            user_id, order_name, quantity, explicit_qty, registered_by,
+        )
+    if err:
+        return err
 
     # 多團購時顯示標籤
     multi = len(get_active_buys(group_id)) > 1
-    label = f"[團購{buy_num}] " if multi else ""
-
-    if explicit_qty and existing:
-        result = f"✅ {label}{order_name}【{item_num}】{item_name} → {total} 份"
-    else:
-        result = f"✅ {label}{order_name}【{item_num}】{item_name} +{quantity}份（共 {total} 份）"
+    line = OrderLine(active, item_num, item_name, order_name, quantity, explicit_qty, registered_by)
+    result = format_order_result(line, existing, total, multi)
 
     # 品項限量進度
     progress = check_item_progress(buy_id, item_num)
@@ -847,68 +2099,141 @@ def cmd_order(group_id, user_id, user_name, text, target_buy=None, skip_auto_clo
     return result
 
 
+# ── 批次下單引擎：cmd_order_multi / cmd_batch_order 共用
+BATCH_ORDER_MODE = os.environ.get("BATCH_ORDER_MODE", "partial")  # partial：能下的先下；all：全部成功才寫入
+
+
+def resolve_catalog_item(catalog, item_num):
+    """同 resolve_item，但直接查目錄快照（批次下單時不必每個品項各查一次 DB）
+    回傳 (buy_row, item_name, err_msg)
+    """
+    if not catalog.buys:
+        return (None, None, None)
+    matched = []
+    for buy in catalog.buys:
+        for item in catalog.items.get(buy[0], ()):
+            if item[2] == item_num:
+                matched.append((buy, item[3]))
+                break
+    if len(matched) == 1:
+        return (matched[0][0], matched[0][1], None)
+    elif len(matched) > 1:
+        hints = [f"  團購{buy[8]}：{name}" for buy, name in matched]
+        return (None, None, f"⚠️ 多個團購都有品項【{item_num}】，請用品名下單：\n" + '\n'.join(hints))
+    return (None, None, f"⚠️ 沒有品項【{item_num}】，請確認編號。")
+
+
+def apply_order_lines(user_id, entries, multi, mode=None):
+    """在單一寫入交易中套用多筆訂單
+    entries 依輸入順序，每筆是 OrderLine 或無法下單的提示字串（如找不到品項）。
+    整批持有同一個寫鎖：限量檢查看得到同批前面的訂單，也不會被其他人插隊。
+    mode="partial" 失敗的項目略過、其餘照常寫入；mode="all" 任一項失敗就整批不寫入。
+    回傳 (回覆行 list, 有寫入訂單的 buy_id set)
+    """
+    mode = mode or BATCH_ORDER_MODE
+    results = []
+    failed = []
+    written = []     # [(OrderLine, existing, total), ...]
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute("SAVEPOINT batch_order")
+        for entry in entries:
+            if isinstance(entry, str):
+                err = entry
+            elif entry.quantity < 1:
+                err = "⚠️ 數量必須大於 0"
+            else:
+                err, existing, total = reserve_order(
+                    c, entry.buy[0], entry.item_num, entry.item_name, user_id,
+                    entry.order_name, entry.quantity, entry.explicit_qty, entry.registered_by,
+                )
+            if err:
+                failed.append(err)
+                results.append(err)
+            else:
+                written.append((entry, existing, total))
+                results.append((entry, existing, total))
+        if failed and mode == "all":
+            c.execute("ROLLBACK TO batch_order")
+            c.execute("RELEASE batch_order")
+            return ["⚠️ 批次下單未完成，以下項目有問題，這次全部沒有下單："] + failed, set()
+        c.execute("RELEASE batch_order")
+
+    # 品項限量進度：每個品項只在最後一筆後面顯示一次
+    last_line = {}
+    for i, result in enumerate(results):
+        if not isinstance(result, str):
+            last_line[(result[0].buy[0], result[0].item_num)] = i
+    lines = []
+    for i, result in enumerate(results):
+        if isinstance(result, str):
+            lines.append(result)
+            continue
+        line, existing, total = result
+        text = format_order_result(line, existing, total, multi)
+        if last_line[(line.buy[0], line.item_num)] == i:
+            progress = check_item_progress(line.buy[0], line.item_num)
+            if progress:
+                text += f"\n{progress}"
+        lines.append(text)
+    return lines, {line.buy[0] for line, _, _ in written}
+
+
+def finish_batch(group_id, lines, affected_buys):
+    """批次下單完成後，統一檢查自動結團並組成單一回覆"""
+    for bid in sorted(affected_buys):
+        auto_close = check_auto_close(bid, group_id)
+        if auto_close:
+            lines.append(auto_close)
+    return '\n'.join(lines) if lines else None
+
+
 def cmd_order_multi(group_id, user_id, user_name, text, target_buy=None):
     """多品項下單：+1 +3 +5 名字"""
     # 提取所有 +N
     item_nums = [int(x) for x in re.findall(r'\+(\d+)', text)]
+    if not item_nums:
+        return None
 
-    # 提取名字（去除所有 +N 後的剩餘文字）
+    # 提取名字（去除所有 +N 後的剩餘文字），所有品項共用
     rest = re.sub(r'\+\d+', '', text).strip()
+    order_name, quantity, explicit_qty, registered_by = parse_order_rest(rest, user_name)
 
-    results = []
-    affected_buys = set()
+    catalog = get_catalog(group_id)
+    entries = []
     for item_num in item_nums:
-        # 組合 order_text 給 cmd_order
-        if rest:
-            order_text = f"+{item_num} {rest}"
-        else:
-            order_text = f"+{item_num}"
-
-        order_result = cmd_order(group_id, user_id, user_name, order_text, target_buy=target_buy, skip_auto_close=True)
-        if order_result is None:
-            return None
-        results.append(order_result)
-
-        # 追蹤受影響的團購（用於自動結團檢查）
         if target_buy:
-            affected_buys.add(target_buy[0])
+            buy, item_name = target_buy, get_item_name(target_buy[0], item_num)
         else:
-            buy, _ = resolve_buy_for_item(group_id, item_num)
-            if buy:
-                affected_buys.add(buy[0])
-
-    # 檢查所有涉及的團購是否需要自動結團
-    for bid in affected_buys:
-        auto_close = check_auto_close(bid, group_id)
-        if auto_close:
-            results.append(auto_close)
+            buy, item_name, err = resolve_catalog_item(catalog, item_num)
+            if err:
+                entries.append(err)
+                continue
+            if not buy:
+                return None  # 沒有進行中的團購，靜默
+        if not item_name:
+            entries.append(f"⚠️ 沒有品項【{item_num}】，請確認編號。")
+            continue
+        entries.append(OrderLine(buy, item_num, item_name, order_name, quantity, explicit_qty, registered_by))
 
-    return '\n'.join(results) if results else None
+    lines, affected_buys = apply_order_lines(user_id, entries, multi=len(catalog.buys) > 1)
+    return finish_batch(group_id, lines, affected_buys)
 
 
 def cmd_batch_order(group_id, user_id, user_name, text):
     """批次下單：Name|item×qty、item×qty 或 Name item×qty、... 或 item×qty、..."""
-    # 搜尋所有 active buys 的品項
-    buys = get_active_buys(group_id)
-    if not buys:
+    # 搜尋所有 active buys 的品項（比對索引隨目錄快取一起保存）
+    catalog = get_catalog(group_id)
+    if not catalog.buys:
         return None
 
-    all_items = []  # [(buy_row, item_row), ...]
-    for buy in buys:
-        for item in get_items(buy[0]):
-            all_items.append((buy, item))
-
-    if not all_items:
+    matcher = catalog.matcher
+    if not matcher.entries:
         return None
 
     def find_match(search):
         """在所有團購品項中找匹配（子字串比對），回傳 (buy, item)"""
-        for buy, item in all_items:
-            item_name = item[3]
-            price_info = item[4] or ""
-            if search in item_name or search in price_info:
-                return (buy, item)
-        return None
+        return matcher.find(search)
 
     # 處理換行：Name\nItem+qty 視同 Name|Item+qty
     if '\n' in text and '|' not in text:
@@ -934,10 +2259,8 @@ def cmd_batch_order(group_id, user_id, user_name, text):
     # 解析每個品項：以 、 或 , 分隔
     item_entries = re.split(r'[、,]\s*', items_text)
 
-    results = []
-    success_count = 0
+    entries = []     # OrderLine 或提示字串，依輸入順序
     detected_proxy = None  # 從第一個 entry 偵測到的代訂人名
-    affected_buys = set()
 
     for entry in item_entries:
         entry = entry.strip()
@@ -981,38 +2304,39 @@ def cmd_batch_order(group_id, user_id, user_name, text):
             detected_proxy = proxy_name
 
         if not matched:
-            results.append(f"⚠️ 找不到品項「{search_name}」")
+            entries.append(f"⚠️ 找不到品項「{search_name}」")
             continue
 
         matched_buy, matched_item = matched
-        item_num = matched_item[2]
 
-        # 決定下單用的名字
+        # 決定下單用的名字（數量一律視為指定數量）
         effective_proxy = proxy_name or detected_proxy
         if effective_proxy and not registered_by:
-            order_text = f"+{item_num} {effective_proxy} {qty}"
-        elif registered_by:
-            order_text = f"+{item_num} {order_name} {qty}"
+            line_name, line_by = effective_proxy, user_name
+        elif registered_by and order_name:
+            line_name, line_by = order_name, user_name
         else:
-            order_text = f"+{item_num} {qty}"
+            line_name, line_by = user_name or "（未知）", None
+        entries.append(OrderLine(matched_buy, matched_item[2], matched_item[3], line_name, qty, True, line_by))
 
-        order_result = cmd_order(group_id, user_id, user_name, order_text, target_buy=matched_buy, skip_auto_close=True)
-        if order_result:
-            results.append(order_result)
-            success_count += 1
-            affected_buys.add(matched_buy[0])
-
-    # 沒有任何成功的訂單 → 回傳 None，讓 NLU 接手
-    if success_count == 0:
+    # 沒有任何比對到品項的項目 → 回傳 None，讓 NLU 接手
+    if not any(isinstance(entry, OrderLine) for entry in entries):
         return None
 
-    # 批次下單完成後，統一檢查自動結團
-    for bid in affected_buys:
-        auto_close = check_auto_close(bid, group_id)
-        if auto_close:
-            results.append(auto_close)
+    lines, affected_buys = apply_order_lines(user_id, entries, multi=len(catalog.buys) > 1)
+    return finish_batch(group_id, lines, affected_buys)
 
-    return '\n'.join(results)
+
+def _delete_order(c, buy_id, item_num, order_id):
+    """刪除一筆訂單並扣回品項的 ordered_total（需在寫入交易中呼叫）"""
+    c.execute("SELECT quantity, user_id, user_name FROM orders WHERE id=?", (order_id,))
+    row = c.fetchone()
+    if not row:
+        return
+    c.execute("DELETE FROM orders WHERE id=?", (order_id,))
+    adjust_item_total(c, buy_id, item_num, -row[0])
+    record_order_event(c, buy_id, "cancel", item_num, row[1], row[2])
+    bump_buy_version(c, buy_id)
 
 
 def cmd_cancel_order(group_id, user_id, user_name, text):
@@ -1023,8 +2347,8 @@ def cmd_cancel_order(group_id, user_id, user_name, text):
     item_num = int(m.group(1))
     target_name = m.group(2)
 
-    # 用 resolve_buy_for_item 找到品項所在的 buy
-    active, err = resolve_buy_for_item(group_id, item_num)
+    # 用 resolve_item 找到品項所在的 buy 與品名
+    active, item_name, err = resolve_item(group_id, item_num)
     if err:
         return err
     if not active:
@@ -1033,11 +2357,10 @@ def cmd_cancel_order(group_id, user_id, user_name, text):
     buy_id = active[0]
 
     # 確認品項存在
-    item_name = get_item_name(buy_id, item_num)
     if not item_name:
         return f"⚠️ 沒有品項【{item_num}】"
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
 
     if target_name:
@@ -1048,11 +2371,9 @@ def cmd_cancel_order(group_id, user_id, user_name, text):
         )
         row = c.fetchone()
         if not row:
-            conn.close()
             return f"⚠️ 找不到 {target_name} 在【{item_num}】{item_name} 的訂單"
-        c.execute("DELETE FROM orders WHERE id=?", (row[0],))
-        conn.commit()
-        conn.close()
+        with write_txn():
+            _delete_order(c, buy_id, item_num, row[0])
         return f"❌ 已取消 {target_name}【{item_num}】{item_name} 的訂單"
     else:
         # 退出自己的訂單（用 user_name 比對）
@@ -1063,100 +2384,144 @@ def cmd_cancel_order(group_id, user_id, user_name, text):
         )
         row = c.fetchone()
         if not row:
-            conn.close()
             return f"⚠️ 你沒有在【{item_num}】{item_name} 下單"
-        c.execute("DELETE FROM orders WHERE id=?", (row[0],))
-        conn.commit()
-        conn.close()
+        with write_txn():
+            _delete_order(c, buy_id, item_num, row[0])
         return f"❌ 已取消【{item_num}】{item_name} 的訂單"
 
 
-def cmd_list(group_id, buy_num=None):
-    """列表：查看所有下單狀況"""
+def cmd_list(group_id, buy_num=None, page=None):
+    """列表：查看所有下單狀況（品項多時分頁，一次最多回 LINE_MAX_MESSAGES 則）
+    page 指定時只渲染該頁（列表 N 頁M）。
+    """
     if buy_num is not None:
         # 指定團購編號
         active = get_active_buy(group_id, buy_num)
         if not active:
             return f"⚠️ 沒有團購{buy_num}，或已結團。"
-        return format_buy_list(active[0], show_label=True)
-
-    buys = get_active_buys(group_id)
-    if not buys:
-        return "目前沒有進行中的團購。"
+        buys = [active]
+        show_label = True
+    else:
+        buys = get_active_buys(group_id)
+        if not buys:
+            return "目前沒有進行中的團購。"
+        show_label = len(buys) > 1
+
+    if page is not None:
+        if len(buys) > 1:
+            return f"⚠️ 目前有多個團購，請指定團購編號，例如「列表 1 頁{page}」"
+        buy = buys[0]
+        pages = list_page_count(buy[0])
+        if not 1 <= page <= pages:
+            return f"⚠️ 團購{buy[8]} 的列表只有 {pages} 頁。"
+        return render_list_page(buy, page, pages, show_label)
+
+    messages = pack_list_pages(buys, show_label)
+    return messages[0] if len(messages) == 1 else messages
+
+
+MY_ORDERS_ALL_LIMIT = int(os.environ.get("MY_ORDERS_ALL_LIMIT", "20"))
+
+# 一次查出使用者在指定團購的所有訂單（含代訂）與品項名稱；
+# 每團購內先列自己的訂單、再列代訂，各自依品項編號排序。
+# CROSS JOIN 固定由 group_buys 帶出團購，再以 (user_id, group_buy_id) 索引查訂單，
+# 訂單很多的使用者也不會去掃他所有的歷史訂單
+MY_ORDERS_SQL = """
+    SELECT gb.id, gb.title, gb.buy_num, gb.status, gb.created_at,
+           o.item_num, i.name, o.user_name, o.quantity, o.registered_by
+    FROM group_buys gb
+    CROSS JOIN orders o ON o.group_buy_id = gb.id AND o.user_id = ?
+    LEFT JOIN items i ON i.group_buy_id = o.group_buy_id AND i.item_num = o.item_num
+    WHERE {where}
+    ORDER BY {order}, o.registered_by IS NOT NULL, o.item_num, o.id
+"""
 
-    if len(buys) == 1:
-        return format_buy_list(buys[0][0], show_label=False)
 
-    # 多個團購：每個用 format_buy_list 顯示
-    parts = []
-    for buy in buys:
-        parts.append(format_buy_list(buy[0], show_label=True))
-    return '\n\n'.join(parts)
+def format_my_order_rows(rows, label_for):
+    """把 MY_ORDERS_SQL 的結果依團購分段，回傳 (lines, 項數)"""
+    lines = []
+    current = None
+    in_proxy = False
+    for buy_id, title, buy_num, status, created_at, item_num, item_name, name, qty, registered_by in rows:
+        if buy_id != current:
+            if current is not None:
+                lines.append("")
+            current, in_proxy = buy_id, False
+            lines.append(label_for(title, buy_num, status, created_at))
+        item_name = item_name or f"品項{item_num}"
+        if registered_by is None:
+            lines.append(f"【{item_num}】{item_name} x{qty}")
+        else:
+            if not in_proxy:
+                lines.append("📦 代訂：")
+                in_proxy = True
+            lines.append(f"【{item_num}】{item_name} x{qty}（{name}）")
+    return lines, len(rows)
 
 
 def cmd_my_orders(group_id, user_id, user_name):
-    """我的訂單：查看自己的下單（含代訂），跨所有 active buys"""
+    """我的訂單：查看自己的下單（含代訂），跨所有 active buys（一次 JOIN 查詢）"""
     buys = get_active_buys(group_id)
     if not buys:
         return "目前沒有進行中的團購。"
 
-    my_name = user_name or "（未知）"
-    multi = len(buys) > 1
-    all_lines = [f"👤 {my_name} 的訂單", "────────────────"]
-    grand_total = 0
-    has_any = False
-
-    for buy in buys:
-        buy_id = buy[0]
-        title = buy[2]
-        buy_num = buy[8]
-
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        c.execute(
-            "SELECT item_num, user_name, quantity FROM orders WHERE group_buy_id=? AND user_id=? AND registered_by IS NULL ORDER BY item_num",
-            (buy_id, user_id),
-        )
-        own_orders = c.fetchall()
-
-        c.execute(
-            "SELECT item_num, user_name, quantity FROM orders WHERE group_buy_id=? AND user_id=? AND registered_by IS NOT NULL ORDER BY item_num",
-            (buy_id, user_id),
-        )
-        proxy_orders = c.fetchall()
-
-        conn.close()
-
-        if not own_orders and not proxy_orders:
-            continue
-
-        has_any = True
-        label = f"[團購{buy_num}] " if multi else "📋 "
-        all_lines.append(f"{label}{title}")
+    c = get_conn().cursor()
+    c.execute(
+        MY_ORDERS_SQL.format(where="gb.group_id = ? AND gb.status = 'open'", order="gb.buy_num"),
+        (user_id, group_id),
+    )
+    rows = c.fetchall()
+    if not rows:
+        return "你目前沒有下單。"
 
-        for item_num, name, qty in own_orders:
-            item_name = get_item_name(buy_id, item_num) or f"品項{item_num}"
-            all_lines.append(f"【{item_num}】{item_name} x{qty}")
+    multi = len(buys) > 1
+    lines, count = format_my_order_rows(
+        rows, lambda title, buy_num, *_: f"[團購{buy_num}] {title}" if multi else f"📋 {title}"
+    )
+    if multi:
+        lines.append("")
+    my_name = user_name or "（未知）"
+    return '\n'.join([f"👤 {my_name} 的訂單", "────────────────", *lines, "────────────────", f"共 {count} 項"])
 
-        if proxy_orders:
-            all_lines.append("📦 代訂：")
-            for item_num, name, qty in proxy_orders:
-                item_name = get_item_name(buy_id, item_num) or f"品項{item_num}"
-                all_lines.append(f"【{item_num}】{item_name} x{qty}（{name}）")
 
-        buy_total = len(own_orders) + len(proxy_orders)
-        grand_total += buy_total
-        if multi:
-            all_lines.append("")
+def cmd_my_orders_all(chat_id, user_id, user_name):
+    """我的訂單 全部：跨群組、含已結團，列出最近 MY_ORDERS_ALL_LIMIT 個有下單的團購
+    會列出其他群組的訂單，只在 1:1 聊天回覆（source_id 此時就是 user_id）。
+    先從 (user_id, group_buy_id) 索引取最近的團購編號，再只 JOIN 這些團購。
+    """
+    if chat_id != user_id:
+        return "🔒 「我的訂單 全部」會列出你在其他群組的訂單，請私訊我查詢。\n在群組中可用「我的訂單」查看本群的訂單。"
 
-    if not has_any:
-        return "你目前沒有下單。"
+    c = get_conn().cursor()
+    c.execute(
+        "SELECT DISTINCT group_buy_id FROM orders WHERE user_id=? ORDER BY group_buy_id DESC LIMIT ?",
+        (user_id, MY_ORDERS_ALL_LIMIT),
+    )
+    buy_ids = [row[0] for row in c.fetchall()]
+    if not buy_ids:
+        return "你目前沒有任何訂單紀錄。"
 
-    all_lines.append("────────────────")
-    all_lines.append(f"共 {grand_total} 項")
+    marks = ",".join("?" * len(buy_ids))
+    c.execute(
+        MY_ORDERS_SQL.format(where=f"gb.id IN ({marks})", order="gb.id DESC"),
+        (user_id, *buy_ids),
+    )
+    rows = c.fetchall()
 
-    return '\n'.join(all_lines)
+    def label_for(title, buy_num, status, created_at):
+        state = "進行中" if status == 'open' else "已結團"
+        date = str(created_at or "")[:10]
+        return f"📋 {title}（{state}{'，' + date if date else ''}）"
+
+    lines, count = format_my_order_rows(rows, label_for)
+    footer = f"共 {count} 項"
+    if len(buy_ids) == MY_ORDERS_ALL_LIMIT:
+        c.execute("SELECT COUNT(DISTINCT group_buy_id) FROM orders WHERE user_id=?", (user_id,))
+        n_buys = c.fetchone()[0]
+        if n_buys > len(buy_ids):
+            footer += f"（顯示最近 {len(buy_ids)} 團，共 {n_buys} 團）"
+    my_name = user_name or "（未知）"
+    return '\n'.join([f"👤 {my_name} 的全部訂單", "────────────────", *lines, "", "────────────────", footer])
 
 
 def cmd_close(group_id, user_id, buy_num=None):
@@ -1184,26 +2549,34 @@ def cmd_close(group_id, user_id, buy_num=None):
     if user_id != creator_id:
         return "⚠️ 只有團主可以結團。"
 
-    # 先產生最終列表
+    # 先結團再產生列表：結團與下單都在寫入交易內檢查狀態，結團後不會再有訂單插進來
+    job_id = None
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE group_buys SET status='closed' WHERE id=? AND status='open'", (buy_id,))
+        if c.rowcount == 0:
+            return "⚠️ 此團購已結團。"
+        record_order_event(c, buy_id, "close")
+        bump_catalog_generation(c, group_id)
+        bump_buy_version(c, buy_id)
+        # 沒有訂單就沒有點評，不留下 pending 工作
+        has_orders = c.execute(
+            "SELECT 1 FROM orders WHERE group_buy_id=? LIMIT 1", (buy_id,)
+        ).fetchone()
+        if claude_client and AI_SUMMARY_COMMENTARY and has_orders:
+            job_id = enqueue_report_job(c, group_id, buy_id)
+
+    # 最終列表與結單統計（本地計算，不需等待 AI）
     final_list = format_buy_list(buy_id, show_label=(len(buys) > 1))
+    stats = compute_buy_stats(buy_id)
+    report = f"\n\n{format_stats_report(title, bn, stats)}" if stats.people else ""
 
-    # AI 結單報告
-    ai_report = ""
-    try:
-        ai_summary = cmd_ai_summary(group_id, buy_num=bn)
-        if ai_summary and not ai_summary.startswith("⚠️"):
-            ai_report = f"\n\n{ai_summary}"
-    except Exception as e:
-        logger.error(f"[close] AI 報告生成失敗: {e}")
-
-    # 更新狀態
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE group_buys SET status='closed' WHERE id=?", (buy_id,))
-    conn.commit()
-    conn.close()
+    # AI 點評在背景產生，完成後另外推播到群組
+    if job_id:
+        schedule_report_job(job_id)
+        report += "\n\n🤖 AI 點評產生中，稍後送出"
 
-    return f"🔒 團購已結團！\n\n{final_list}{ai_report}"
+    return f"🔒 團購已結團！\n\n{final_list}{report}"
 
 
 def cmd_cancel_buy(group_id, user_id, buy_num=None):
@@ -1229,13 +2602,15 @@ def cmd_cancel_buy(group_id, user_id, buy_num=None):
     if user_id != creator_id:
         return "⚠️ 只有團主可以取消團購。"
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM orders WHERE group_buy_id=?", (buy_id,))
-    c.execute("DELETE FROM items WHERE group_buy_id=?", (buy_id,))
-    c.execute("DELETE FROM group_buys WHERE id=?", (buy_id,))
-    conn.commit()
-    conn.close()
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM orders WHERE group_buy_id=?", (buy_id,))
+        c.execute("DELETE FROM order_events WHERE group_buy_id=?", (buy_id,))
+        c.execute("DELETE FROM order_snapshots WHERE group_buy_id=?", (buy_id,))
+        c.execute("DELETE FROM items WHERE group_buy_id=?", (buy_id,))
+        c.execute("DELETE FROM group_buys WHERE id=?", (buy_id,))
+        bump_catalog_generation(c, group_id)
+        bump_buy_version(c, buy_id)
 
     return f"🗑️ 團購「{title}」已取消，所有資料已刪除。"
 
@@ -1244,55 +2619,317 @@ def cmd_cancel_buy(group_id, user_id, buy_num=None):
 # AI 功能（Claude API）
 # ══════════════════════════════════════════
 
-def call_claude(prompt_text):
-    """呼叫 Claude API 進行分析"""
-    if not claude_client:
-        return None
-    try:
-        message = claude_client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=2000,
-            system="你是團購統計助理，負責彙整訂單資料。回覆必須簡潔清楚，適合在 LINE 群組中顯示。使用繁體中文。不要使用 markdown 格式（不要用 ** 或 # 等符號）。用 emoji 和分隔線讓報告容易閱讀。",
-            messages=[
-                {"role": "user", "content": prompt_text}
-            ]
-        )
-        return message.content[0].text
-    except Exception as e:
-        logger.error(f"[claude] API 呼叫失敗: {e}")
-        return None
+# ── AI 呼叫斷路器：連續失敗達門檻就暫停呼叫（open），冷卻後只放一個探測請求（half_open），成功才恢復
+AI_MODEL = "claude-haiku-4-5-20251001"
+AI_NLU_TIMEOUT = float(os.environ.get("AI_NLU_TIMEOUT", "8"))            # 聊天訊息的 NLU 呼叫時限（秒）
+AI_BREAKER_THRESHOLD = int(os.environ.get("AI_BREAKER_THRESHOLD", "5"))   # 連續失敗幾次後斷路
+AI_BREAKER_COOLDOWN = float(os.environ.get("AI_BREAKER_COOLDOWN", "30"))  # 斷路多久後探測
 
+SUMMARY_SYSTEM_PROMPT = "你是團購統計助理，負責彙整訂單資料。回覆必須簡潔清楚，適合在 LINE 群組中顯示。使用繁體中文。不要使用 markdown 格式（不要用 ** 或 # 等符號）。用 emoji 和分隔線讓報告容易閱讀。"
+NLU_SYSTEM_PROMPT = "你是團購語意分析模組。只回覆 JSON，不要加其他文字。"
 
-def is_possibly_order_related(text, items):
-    """檢查訊息是否可能跟團購下單有關"""
-    # 包含品項名稱中的關鍵字
-    for item in items:
-        item_name = item[3]  # name field
-        if any(keyword in text for keyword in item_name.split() if len(keyword) >= 2):
-            return True
-    # 包含下單相關的詞彙
-    order_keywords = ['要', '買', '訂', '加', '來', '份', '個', '包', '組', '盒',
-                      '幫我', '我也', '一樣', '跟', '同上', '加一', '再來', '還要',
-                      '取消', '不要', '退', '改', '換']
-    return any(kw in text for kw in order_keywords)
 
+class AIClient:
+    """包住 claude_client：每次呼叫有時限，統計錯誤率 / 延遲，並以斷路器避免 API 故障時卡住 worker 執行緒
+    狀態：closed（正常）→ open（連續失敗，直接略過）→ half_open（冷卻後放一個探測請求）
+    """
 
-def build_nlu_prompt(title, items, orders, user_name, user_text):
-    """組合 NLU prompt"""
-    # 品項清單
-    items_text = ""
-    for item in items:
+    def __init__(self, threshold=AI_BREAKER_THRESHOLD, cooldown=AI_BREAKER_COOLDOWN, window=100):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probing = False
+        self._consecutive_failures = 0
+        self._recent = deque(maxlen=window)       # 最近呼叫是否成功
+        self._latencies = deque(maxlen=window)    # 最近呼叫的延遲（秒）
+        self.calls = 0
+        self.failures = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                return "half_open"
+            return self._state
+
+    def available(self):
+        """目前是否可以呼叫（open 時為 False；half_open 只有沒有探測中的請求時為 True）"""
+        with self._lock:
+            return self._allow(reserve=False)
+
+    def _allow(self, reserve):
+        if self._state == "closed":
+            return True
+        if self._state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._state = "half_open"
+        if self._probing:
+            return False
+        if reserve:
+            self._probing = True
+        return True
+
+    def _record(self, ok, latency):
+        with self._lock:
+            self.calls += 1
+            self._recent.append(ok)
+            self._latencies.append(latency)
+            if ok:
+                self._consecutive_failures = 0
+                if self._state != "closed":
+                    logger.info("[ai] 探測成功，斷路器恢復 closed")
+                self._state = "closed"
+            else:
+                self.failures += 1
+                self._consecutive_failures += 1
+                if self._state == "half_open" or self._consecutive_failures >= self.threshold:
+                    if self._state != "open":
+                        logger.warning(f"[ai] 連續失敗 {self._consecutive_failures} 次，斷路 {self.cooldown:.0f}s")
+                    self._state = "open"
+                    self._opened_at = time.monotonic()
+            self._probing = False
+
+    def complete(self, prompt, system, max_tokens, timeout):
+        """呼叫 Claude，回傳文字；未設定、斷路中或失敗回傳 None"""
+        if not claude_client:
+            return None
+        with self._lock:
+            if not self._allow(reserve=True):
+                self.short_circuited += 1
+                return None
+        t0 = time.monotonic()
+        try:
+            message = claude_client.messages.create(
+                model=AI_MODEL,
+                max_tokens=max_tokens,
+                timeout=timeout,
+                system=system,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            text = message.content[0].text
+        except Exception as e:
+            self._record(False, time.monotonic() - t0)
+            logger.error(f"[claude] API 呼叫失敗: {e}")
+            return None
+        self._record(True, time.monotonic() - t0)
+        return text
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            latencies = sorted(self._latencies)
+            recent = list(self._recent)
+            return {
+                "state": state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "short_circuited": self.short_circuited,
+                "consecutive_failures": self._consecutive_failures,
+                "error_rate": round(recent.count(False) / len(recent), 3) if recent else 0.0,
+                "latency_ms_avg": round(sum(latencies) * 1000 / len(latencies)) if latencies else 0,
+                "latency_ms_p95": round(latencies[int(len(latencies) * 0.95)] * 1000) if latencies else 0,
+            }
+
+
+ai_client = AIClient()
+
+
+def call_claude(prompt_text, timeout=None):
+    """呼叫 Claude API 進行分析（經 ai_client，timeout 秒內沒回應視為失敗）"""
+    return ai_client.complete(prompt_text, SUMMARY_SYSTEM_PROMPT, 2000, timeout or AI_SUMMARY_TIMEOUT)
+
+
+# ── 本地意圖判斷：只有「第一人稱 + 明確動詞 + 品項」才直接處理，閒聊直接略過，其餘都問 Claude
+# 訊息常提到品名但不是下單（「蛋餃來了」「誰要蛋餃」「蛋餃不要太鹹」），寧可多問 Claude 也不要自己寫入訂單
+INTENT_CANCEL_WORDS = ('取消', '不用了', '退掉', '退出', '刪掉', '刪除')
+INTENT_TAIL_CANCEL_RE = re.compile(r'(?:不要了?|不用了?)[\s。.!！~～]*$')   # 句尾的「不要」才算取消
+INTENT_UPDATE_WORDS = ('改成', '改為', '改')
+INTENT_SWITCH_WORDS = ('換成', '換')
+INTENT_CONTEXT_WORDS = ('我也要', '一樣', '同上', '跟他', '跟上面', '加一', '+1')   # 需要上下文才知道是哪個品項
+INTENT_STRONG_ORDER_WORDS = ('訂', '買', '下單', '登記')
+INTENT_WEAK_ORDER_WORDS = ('要', '來', '加', '給我', '還要', '再來') + INTENT_CONTEXT_WORDS
+# 出現這些字代表可能在聊天、轉述或描述別人，一律交給 Claude
+INTENT_DEFER_WORDS = ('要', '來', '誰', '大家', '他', '她', '們', '人', '說', '過', '了', '到')
+# 否定（「我不訂」「我沒買」）、時間與猶豫（「昨天訂」「忘記訂」「想買」）都不是現在要下單，交給 Claude
+INTENT_NEGATION_WORDS = ('不', '沒', '別', '未', '勿', '免')
+INTENT_HEDGE_WORDS = (
+    '昨天', '前天', '今早', '早上', '上次', '下次', '之前', '以前', '以後', '明天', '改天', '晚點', '等等',
+    '忘記', '忘了', '想', '打算', '考慮', '可能', '也許', '或許', '應該', '看看',
+)
+INTENT_QUESTION_WORDS = ('?', '？', '嗎', '呢', '多少', '幾', '什麼', '怎麼', '有沒有', '哪', '吧')
+
+CN_NUMERALS = {'一': 1, '二': 2, '兩': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+INTENT_FOR_NAME_RE = re.compile(r'幫\s*([^\s，,。!！?？]{1,6}?)\s*(?:訂|買|要|加|取消|退|改|下單|登記)')
+INTENT_NOT_NAMES = ('我', '忙', '大家')
+INTENT_REF_RE = re.compile(r'第\s*(\d+)\s*(?:個|項|號)?|(\d+)\s*號')
+INTENT_QTY_RE = re.compile(
+    r'[x×*]\s*(\d+)|(\d+|[一二兩三四五六七八九十]+)\s*(?:份|個|包|組|盒|袋|條|顆|碗|斤|盤|罐|瓶|箱)'
+)
+ITEM_CORE_RE = re.compile(r'[\u4e00-\u9fff\u3400-\u4dbfA-Za-z]+')
+
+
+def parse_cn_number(s):
+    """阿拉伯數字或一~九十九的中文數字 → int（無法解析回傳 None）"""
+    if s.isdigit():
+        return int(s)
+    if s == '十':
+        return 10
+    if '十' in s:
+        tens, _, ones = s.partition('十')
+        value = (CN_NUMERALS.get(tens, 0) if tens else 1) * 10
+        if ones:
+            if ones not in CN_NUMERALS:
+                return None
+            value += CN_NUMERALS[ones]
+        return value if not tens or tens in CN_NUMERALS else None
+    return CN_NUMERALS.get(s) if len(s) == 1 else None
+
+
+@lru_cache(maxsize=4096)
+def item_core_name(name):
+    """品名主體：第一段中英文字（去掉價格、規格括號等），如「韭菜鮮肉水餃（50顆）280元」→「韭菜鮮肉水餃」"""
+    m = ITEM_CORE_RE.search(name)
+    return m.group(0) if m else ""
+
+
+def match_intent_item(text, items):
+    """依品名找訊息提到的品項
+    候選品項：完整品名出現在訊息中，或品名與訊息有共同的雙字；完整品名優先，其次比雙字 + 單字重疊數。
+    回傳 (item, ambiguous)：分數並列、或其他候選品項重疊到最佳品項以外的字（還提到別的品項）時 ambiguous=True
+    """
+    text_bigrams = _char_bigrams(text)
+    text_chars = set(text)
+    scored = []  # [(score, index, item, overlap_chars)]
+    for index, item in enumerate(items):
+        core = item_core_name(item[3])
+        if not core:
+            continue
+        full = core in text
+        overlap = _char_bigrams(core) & text_bigrams
+        if not full and not overlap:
+            continue
+        chars = set(core) & text_chars
+        scored.append(((full, len(overlap) + len(chars)), index, item, chars))
+    if not scored:
+        return None, False
+    scored.sort(key=lambda s: (s[0][0], s[0][1], -s[1]), reverse=True)
+    best = scored[0]
+    for other in scored[1:]:
+        if other[0] == best[0] or not other[3] <= best[3]:
+            return None, True
+    return best[2], False
+
+
+def classify_intent(text, items, user_orders=()):
+    """本地意圖判斷，回傳 (kind, intent)
+    kind="local"：明確的意圖，intent 與 Claude 回傳的 JSON 格式相同
+    kind="ignore"：閒聊，直接略過
+    kind="claude"：模稜兩可，交給 Claude
+    只有第一人稱（我 / 幫某人 / 動詞開頭的祈使句）+ 明確動詞（訂、買、取消、改成、句尾不要）+ 品項時才在本地處理。
+    """
+    rest = text
+    for_name = None
+    m = INTENT_FOR_NAME_RE.search(rest)
+    if m and m.group(1) not in INTENT_NOT_NAMES:
+        for_name = m.group(1)
+        rest = rest[:m.start(1)] + ' ' + rest[m.end(1):]
+
+    item_ref = None
+    m = INTENT_REF_RE.search(rest)
+    if m:
+        item_ref = int(m.group(1) or m.group(2))
+        rest = rest[:m.start()] + ' ' + rest[m.end():]
+
+    quantity = None
+    m = INTENT_QTY_RE.search(rest)
+    if m:
+        quantity = parse_cn_number(m.group(1) or m.group(2))
+        if not quantity:
+            return "claude", None
+
+    # 句尾的「不要（了）」是取消；其他位置的「不要」（「不要太鹹」「要不要買」）留給 Claude
+    m = INTENT_TAIL_CANCEL_RE.search(rest)
+    tail_cancel = m is not None
+    body = rest[:m.start()] if m else rest
+
+    has_cancel = tail_cancel or any(w in body for w in INTENT_CANCEL_WORDS)
+    verbs = body
+    for w in INTENT_CANCEL_WORDS:
+        verbs = verbs.replace(w, ' ')
+    has_update = any(w in verbs for w in INTENT_UPDATE_WORDS)
+    has_switch = any(w in verbs for w in INTENT_SWITCH_WORDS)
+    has_strong = any(w in verbs for w in INTENT_STRONG_ORDER_WORDS)
+    has_weak = any(w in verbs for w in INTENT_WEAK_ORDER_WORDS)
+    has_question = any(w in rest for w in INTENT_QUESTION_WORDS)
+    has_defer = (
+        any(w in body for w in INTENT_DEFER_WORDS)
+        or any(w in verbs for w in INTENT_NEGATION_WORDS + INTENT_HEDGE_WORDS)
+    )
+    stripped = body.lstrip()
+    first_person = (
+        '我' in body or for_name is not None
+        or stripped.startswith(INTENT_STRONG_ORDER_WORDS + INTENT_CANCEL_WORDS + INTENT_UPDATE_WORDS)
+    )
+
+    item, ambiguous = match_intent_item(rest, items)
+    if ambiguous:
+        return "claude", None
+    if item_ref is not None:
+        ref_item = next((it for it in items if it[2] == item_ref), None)
+        if ref_item is None or (item is not None and item[2] != item_ref):
+            return "claude", None
+        item = ref_item
+
+    if item is None:
+        ordered = {num for num, _ in user_orders}
+        if ((has_cancel or has_update) and len(ordered) == 1 and not for_name
+                and first_person and not has_defer and not has_question):
+            # 只有一筆訂單時的「我要取消」「改成3份」
+            item_num = ordered.pop()
+        elif (has_cancel or has_update or has_switch or has_strong or (has_weak and quantity)
+              or any(w in rest for w in INTENT_CONTEXT_WORDS)):
+            return "claude", None
+        else:
+            return "ignore", None
+    else:
         item_num = item[2]
-        name = item[3]
-        price_info = item[4] or name
-        items_text += f"  {item_num}. {name} ({price_info})\n"
+        if not first_person or has_defer:
+            return "claude", None
+
+    if has_question or has_switch or (has_cancel and has_update):
+        return "claude", None
+    if has_cancel:
+        return "local", {"action": "cancel", "item_num": item_num, "for_name": for_name}
+    if has_update:
+        if not quantity:
+            return "claude", None
+        return "local", {"action": "update", "item_num": item_num, "quantity": quantity, "for_name": for_name}
+    if has_strong:
+        return "local", {"action": "order", "item_num": item_num, "quantity": quantity or 1, "for_name": for_name}
+    return "claude", None
+
+
+def format_nlu_item(item):
+    """NLU prompt 中的一行品項"""
+    return f"  {item[2]}. {item[3]} ({item[4] or item[3]})\n"
+
+
+def build_nlu_prompt(title, items, user_orders, user_name, user_text):
+    """組合 NLU prompt
+    user_orders: 用戶現有訂單 [(item_num, quantity), ...]
+    """
+    # 品項清單
+    items_text = "".join(format_nlu_item(item) for item in items)
 
     # 用戶現有訂單
     user_orders_text = "無"
-    user_order_list = [o for o in orders if o[4] == user_name]
-    if user_order_list:
+    if user_orders:
         user_orders_text = ", ".join(
-            f"品項{o[2]} x{o[5]}" for o in user_order_list
+            f"品項{item_num} x{qty}" for item_num, qty in user_orders
         )
 
     prompt = f"""你是團購接龍助理的語意分析模組。
@@ -1331,49 +2968,178 @@ def build_nlu_prompt(title, items, orders, user_name, user_text):
     return prompt
 
 
+# ── NLU prompt 大小上限（估計 token 數；品項依與訊息的相關度排序，超出預算的品項不放進 prompt）
+NLU_PROMPT_TOKEN_BUDGET = int(os.environ.get("NLU_PROMPT_TOKEN_BUDGET", "1500"))
+
+NLU_NUM_RE = re.compile(r'\d+')
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓文字約 1 字 1 token，其餘約 4 字元 1 token"""
+    wide = sum(1 for ch in text if ch >= '\u2e80')
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _char_bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def rank_nlu_items(items, text, ordered_nums=()):
+    """依與訊息的相關度排序品項
+    訊息提到的編號、用戶已訂的品項優先（取消 / 改數量用得到），其次是品名 + 規格的雙字、單字重疊數；
+    相同分數維持原本順序。
+    """
+    text_bigrams = _char_bigrams(text)
+    text_chars = {ch for ch in text if ch >= '\u2e80'}
+    mentioned = {int(n) for n in NLU_NUM_RE.findall(text)}
+
+    def key(pair):
+        index, item = pair
+        haystack = f"{item[3]} {item[4] or ''}"
+        pinned = item[2] in mentioned or item[2] in ordered_nums
+        return (not pinned,
+                -len(text_bigrams & _char_bigrams(haystack)),
+                -len(text_chars & set(haystack)),
+                index)
+
+    return [item for _, item in sorted(enumerate(items), key=key)]
+
+
+def get_user_orders(buy_ids, user_name):
+    """只查詢用戶自己的訂單 [(item_num, quantity), ...]"""
+    if not buy_ids:
+        return []
+    marks = ",".join("?" * len(buy_ids))
+    c = get_conn().cursor()
+    c.execute(
+        f"""SELECT item_num, quantity FROM orders
+            WHERE group_buy_id IN ({marks}) AND user_name=?
+            ORDER BY group_buy_id, item_num, id""",
+        (*buy_ids, user_name),
+    )
+    return c.fetchall()
+
+
+def build_nlu_context(buys, items, user_name, text, budget=None, user_orders=None):
+    """組合大小受限的 NLU prompt
+    只查用戶自己的訂單；品項依相關度挑選直到用完 token 預算（至少保留一項），再依原順序列出。
+    回傳 (prompt, 放進 prompt 的品項數)
+    """
+    budget = budget or NLU_PROMPT_TOKEN_BUDGET
+    title = ' / '.join(buy[2] for buy in buys)
+    if user_orders is None:
+        user_orders = get_user_orders([buy[0] for buy in buys], user_name)
+
+    remaining = budget - estimate_tokens(build_nlu_prompt(title, [], user_orders, user_name, text))
+    kept = set()
+    for item in rank_nlu_items(items, text, {num for num, _ in user_orders}):
+        cost = estimate_tokens(format_nlu_item(item))
+        if kept and cost > remaining:
+            break
+        kept.add(item[0])
+        remaining -= cost
+
+    selected = [item for item in items if item[0] in kept]
+    return build_nlu_prompt(title, selected, user_orders, user_name, text), len(selected)
+
+
+# ── NLU 結果快取：群組裡常有一連串相同的「我也要」「一樣」，同樣的情境只問 Claude 一次
+NLU_CACHE_SIZE = int(os.environ.get("NLU_CACHE_SIZE", "1024"))
+NLU_CACHE_TTL = float(os.environ.get("NLU_CACHE_TTL", "300"))
+
+# key = (DB_PATH, group_id, 目錄世代, 正規化訊息, 用戶現有訂單)；呼叫失敗不快取
+nlu_cache = TTLCache(NLU_CACHE_SIZE, NLU_CACHE_TTL)
+
+# 各層處理的訊息數：local（本地判斷）/ ignore（閒聊略過）/ claude（交給 Claude）/ skipped（AI 斷路中略過）
+nlu_stats = {"local": 0, "ignore": 0, "claude": 0, "skipped": 0}
+_nlu_stats_lock = threading.Lock()
+
+NLU_TRAILING_CHARS = "!！~～。.…、 "
+
+
+def normalize_nlu_text(text):
+    """快取用的訊息正規化：合併空白、去掉句尾語助符號、英文轉小寫"""
+    return re.sub(r'\s+', ' ', text).strip().rstrip(NLU_TRAILING_CHARS).lower() or text.strip()
+
+
 def cmd_nlu_order(group_id, user_id, user_name, text):
     """用 Claude 理解自然語言下單意圖"""
     if not claude_client:
         return None
 
-    buys = get_active_buys(group_id)
+    catalog = get_catalog(group_id)
+    buys = catalog.buys
     if not buys:
         return None
 
-    # 收集所有 active buys 的品項和訂單（供 NLU 使用）
-    all_items = []
-    all_orders = []
-    title_parts = []
-    for buy in buys:
-        bid = buy[0]
-        title_parts.append(buy[2])
-        all_items.extend(get_items(bid))
-        all_orders.extend(get_orders(bid))
+    # 所有 active buys 的品項（目錄快取，不需查 DB）
+    all_items = [item for buy in buys for item in catalog.items.get(buy[0], ())]
 
-    # 預先過濾
-    if not is_possibly_order_related(text, all_items):
+    # 先用本地規則判斷：明確的直接處理、閒聊直接略過
+    user_orders = get_user_orders([buy[0] for buy in buys], user_name)
+    kind, intent = classify_intent(text, all_items, user_orders)
+    with _nlu_stats_lock:
+        nlu_stats[kind] += 1
+    if kind == "ignore":
         return None
+    if kind == "local":
+        return apply_nlu_intent(group_id, user_id, user_name, intent, source="local")
 
-    combined_title = ' / '.join(title_parts)
-    prompt = build_nlu_prompt(combined_title, all_items, all_orders, user_name, text)
-    try:
-        message = claude_client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=500,
-            system="你是團購語意分析模組。只回覆 JSON，不要加其他文字。",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        result_text = message.content[0].text.strip()
+    # AI 斷路中：不排隊等 API，直接略過（本地判斷已處理明確的訊息）
+    if not ai_client.available():
+        with _nlu_stats_lock:
+            nlu_stats["skipped"] += 1
+        return None
+
+    # 意圖取決於品項、訊息、發話者與其訂單：Claude 依發話者名字判斷 for_name（「小明那份」是本人還是代訂），
+    # 所以 key 含 user_name；正規化後的文字只用來當 key，Claude 看到的是原始訊息
+    nlu_text = normalize_nlu_text(text)
+    key = (DB_PATH, group_id, catalog.generation, nlu_text, user_name, tuple(map(tuple, user_orders)))
+    result = nlu_cache.get_or_load(
+        key, lambda: request_nlu_intent(buys, all_items, user_name, text, user_orders)
+    )
+    if result is None:
+        return None
+    return apply_nlu_intent(group_id, user_id, user_name, result)
 
+
+def request_nlu_intent(buys, items, user_name, text, user_orders):
+    """呼叫 Claude 判斷意圖，回傳解析後的 JSON dict（失敗回傳 None）"""
+    prompt, n_items = build_nlu_context(buys, items, user_name, text, user_orders=user_orders)
+    t0 = time.monotonic()
+    result_text = ai_client.complete(prompt, NLU_SYSTEM_PROMPT, 500, AI_NLU_TIMEOUT)
+    logger.info(
+        f"[nlu] prompt 約 {estimate_tokens(prompt)} tokens（{len(prompt)} 字元，品項 {n_items}/{len(items)}），"
+        f"耗時 {(time.monotonic() - t0) * 1000:.0f} ms"
+    )
+    if result_text is None:
+        return None
+    try:
+        result_text = result_text.strip()
         if result_text.startswith("```"):
             result_text = result_text.split("\n", 1)[-1].rsplit("```", 1)[0].strip()
         result = json.loads(result_text)
-
     except Exception as e:
-        logger.error(f"[nlu] Claude 呼叫或解析失敗: {e}")
+        logger.error(f"[nlu] Claude 回覆解析失敗: {e}")
+        return None
+
+    if not isinstance(result, dict):
         return None
+    # 模型偶爾會把用戶本人的名字填進 for_name，統一成 null（本人下單）
+    if result.get("for_name") == user_name:
+        result["for_name"] = None
+    return result
+
+
+NLU_REPLY_LABELS = {"ai": "🤖 AI 理解", "local": "💬 依訊息判斷"}
 
+
+def apply_nlu_intent(group_id, user_id, user_name, result, source="ai"):
+    """依 NLU 判斷結果執行下單 / 取消 / 修改，回傳回覆文字
+    source="local" 表示由本地規則判斷（沒有呼叫 AI），回覆不標示為 AI
+    """
     action = result.get("action")
+    label = NLU_REPLY_LABELS[source]
 
     if action == "ignore":
         return None
@@ -1394,7 +3160,7 @@ def cmd_nlu_order(group_id, user_id, user_name, text):
         # cmd_order 內部會用 resolve_buy_for_item 找到正確的團購
         order_result = cmd_order(group_id, user_id, user_name, order_text)
         if order_result:
-            return f"🤖 AI 理解：{order_result}"
+            return f"{label}：{order_result}"
         return f"🤔 找不到品項【{item_num}】，請確認編號。\n輸入「列表」查看所有品項。"
 
     elif action == "cancel":
@@ -1407,7 +3173,7 @@ def cmd_nlu_order(group_id, user_id, user_name, text):
             cancel_text = f"退出 {item_num}"
 
         cancel_result = cmd_cancel_order(group_id, user_id, user_name, cancel_text)
-        return f"🤖 AI 理解：{cancel_result}"
+        return f"{label}：{cancel_result}"
 
     elif action == "update":
         item_num = result.get("item_num")
@@ -1421,17 +3187,46 @@ def cmd_nlu_order(group_id, user_id, user_name, text):
 
         order_result = cmd_order(group_id, user_id, user_name, order_text)
         if order_result:
-            return f"🤖 AI 理解（修改數量）：{order_result}"
+            return f"{label}（修改數量）：{order_result}"
         return f"🤔 找不到品項【{item_num}】，請確認編號。"
 
     return None
 
 
-def cmd_ai_summary(group_id, buy_num=None):
-    """AI 智能訂單統計"""
-    if not claude_client:
-        return "⚠️ AI 功能未啟用（ANTHROPIC_API_KEY 未設定）"
+# ── 統計數字一律本地計算；AI 只在報告後面加上點評（可關閉），各團購的 AI 呼叫同時送出並有時限
+AI_SUMMARY_COMMENTARY = os.environ.get("AI_SUMMARY_COMMENTARY", "1") == "1"
+AI_SUMMARY_WORKERS = int(os.environ.get("AI_SUMMARY_WORKERS", "4"))
+AI_SUMMARY_TIMEOUT = float(os.environ.get("AI_SUMMARY_TIMEOUT", "45"))
 
+_summary_pool = None
+_summary_pool_pid = None
+_summary_pool_lock = threading.Lock()
+
+
+def summary_pool():
+    """AI 點評用的執行緒池（fork 之後的 worker 會重新建立）"""
+    global _summary_pool, _summary_pool_pid
+    with _summary_pool_lock:
+        if _summary_pool is None or _summary_pool_pid != os.getpid():
+            _summary_pool = ThreadPoolExecutor(max_workers=AI_SUMMARY_WORKERS, thread_name_prefix="ai-summary")
+            _summary_pool_pid = os.getpid()
+        return _summary_pool
+
+
+def build_commentary_prompt(title, report):
+    """AI 點評 prompt：數字已算好，只請 AI 點出重點，不重新計算"""
+    return f"""以下是團購「{title}」已經計算好的訂單統計（數字正確，請勿重新計算或改寫）：
+
+{report}
+
+請用 2～4 行簡短點評，例如：最熱門的品項、尚無人訂購的品項、需要提醒團主注意的事項。
+不要重複列出統計數字，適合 LINE 群組顯示，可以用 emoji。"""
+
+
+def cmd_ai_summary(group_id, buy_num=None):
+    """訂單統計：本地計算品項 / 人員 / 總計，再視設定附上 AI 點評
+    AI 呼叫同時送出，失敗或超過 AI_SUMMARY_TIMEOUT 的團購只顯示本地統計。
+    """
     if buy_num is not None:
         active = get_active_buy(group_id, buy_num)
         if not active:
@@ -1443,50 +3238,533 @@ def cmd_ai_summary(group_id, buy_num=None):
             return "目前沒有進行中的團購。"
         targets = buys
 
-    all_results = []
-    for active in targets:
+    all_results = [None] * len(targets)
+    futures = {}  # index → Future
+    for i, active in enumerate(targets):
         bid = active[0]
         title = active[2]
-        bn = active[8]
-        items = get_items(bid)
-        orders = get_orders(bid)
+        stats = compute_buy_stats(bid)
 
-        if not orders:
-            all_results.append(f"📋 {title}\n目前還沒有人下單。")
+        if not stats.people:
+            all_results[i] = f"📋 {title}\n目前還沒有人下單。"
             continue
 
-        items_text = ""
-        for item in items:
-            price = extract_price(item[4])
-            price_str = f" - 單價 {price} 元" if price else ""
-            items_text += f"  {item[2]}. {item[3]}{price_str}\n"
+        all_results[i] = format_stats_report(title, active[8], stats, show_label=len(targets) > 1)
+        if claude_client and AI_SUMMARY_COMMENTARY:
+            prompt = build_commentary_prompt(title, all_results[i])
+            futures[i] = summary_pool().submit(call_claude, prompt, AI_SUMMARY_TIMEOUT)
+
+    deadline = time.monotonic() + AI_SUMMARY_TIMEOUT
+    for i, future in futures.items():
+        bn = targets[i][8]
+        try:
+            commentary = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning(f"[summary] 團購{bn} AI 點評逾時（{AI_SUMMARY_TIMEOUT:.0f}s），只顯示統計")
+            commentary = None
+        except Exception as e:
+            logger.error(f"[summary] 團購{bn} AI 點評失敗: {e}")
+            commentary = None
+        if commentary:
+            all_results[i] += f"\n\n🤖 AI 點評\n{commentary}"
 
-        orders_text = ""
-        for o in orders:
-            item_name = get_item_name(bid, o[2]) or f"品項{o[2]}"
-            orders_text += f"  - {o[4]}: {item_name}(品項{o[2]}) x{o[5]}\n"
+    return '\n\n'.join(all_results)
 
-        prompt = f"""以下是團購「{title}」的訂單資料，請做統計分析：
 
-【品項列表】
-{items_text}
-【訂單明細】
-{orders_text}
-請產出以下報告：
-1. 📊 品項統計：每個品項的總訂購數量和金額小計
-2. 👥 人員統計：每個人買了哪些品項、各多少份、應付總金額
-3. 💰 總計：總訂購份數和總金額
-
-格式要求：簡潔清楚，適合 LINE 群組顯示，用 emoji 和分隔線排版。"""
-
-        result = call_claude(prompt)
-        if result:
-            label = f"[團購{bn}] " if len(targets) > 1 else ""
-            all_results.append(f"🤖 AI 統計分析 {label}\n━━━━━━━━━━━━━━\n{result}")
+# ══════════════════════════════════════════
+# 結團 AI 點評背景工作（report_jobs，失敗重試，重啟後繼續）
+# ══════════════════════════════════════════
+
+REPORT_JOB_MAX_ATTEMPTS = int(os.environ.get("REPORT_JOB_MAX_ATTEMPTS", "3"))
+REPORT_JOB_RETRY_DELAY = float(os.environ.get("REPORT_JOB_RETRY_DELAY", "30"))   # 第 N 次失敗後等 N 倍
+REPORT_JOB_SWEEP_INTERVAL = float(os.environ.get("REPORT_JOB_SWEEP_INTERVAL", "30"))
+
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+
+def enqueue_report_job(c, group_id, buy_id):
+    """新增一筆待處理的點評工作（需在寫入交易中呼叫），回傳 job id"""
+    c.execute(
+        "INSERT INTO report_jobs (group_id, group_buy_id, updated_at) VALUES (?, ?, ?)",
+        (group_id, buy_id, time.time()),
+    )
+    return c.lastrowid
+
+
+def schedule_report_job(job_id, delay=0):
+    """交給背景執行緒執行（delay 秒後）"""
+    if delay > 0:
+        timer = threading.Timer(delay, schedule_report_job, args=(job_id,))
+        timer.daemon = True
+        timer.start()
+        return
+    summary_pool().submit(run_report_job, job_id)
+
+
+def _claim_report_job(job_id):
+    """把 pending 的工作標成 running（條件式更新，多個 worker 只會有一個拿到）"""
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute(
+            """UPDATE report_jobs SET status='running', attempts=attempts+1, updated_at=?
+               WHERE id=? AND status='pending'""",
+            (time.time(), job_id),
+        )
+        if c.rowcount == 0:
+            return None
+        c.execute("SELECT group_id, group_buy_id, attempts FROM report_jobs WHERE id=?", (job_id,))
+        return c.fetchone()
+
+
+def _finish_report_job(job_id, attempts, error=None):
+    """記錄結果：成功 → done；失敗且還能重試 → pending（回傳重試延遲秒數）；否則 failed"""
+    now = time.time()
+    retry_delay = None
+    if error is None:
+        status = 'done'
+    elif attempts < REPORT_JOB_MAX_ATTEMPTS:
+        status = 'pending'
+        retry_delay = REPORT_JOB_RETRY_DELAY * attempts
+    else:
+        status = 'failed'
+    with write_txn() as conn:
+        conn.execute(
+            """UPDATE report_jobs SET status=?, next_attempt_at=?, updated_at=?, last_error=?
+               WHERE id=?""",
+            (status, now + (retry_delay or 0), now, error, job_id),
+        )
+    return retry_delay
+
+
+def run_report_job(job_id):
+    """產生已結團團購的 AI 點評並推播到群組"""
+    claimed = _claim_report_job(job_id)
+    if claimed is None:
+        return
+    group_id, buy_id, attempts = claimed
+    try:
+        row = get_conn().execute(
+            "SELECT title, buy_num FROM group_buys WHERE id=?", (buy_id,)
+        ).fetchone()
+        if not row:
+            _finish_report_job(job_id, attempts)   # 團購已刪除，不需點評
+            return
+        title, buy_num = row
+        report = format_stats_report(title, buy_num, compute_buy_stats(buy_id))
+        commentary = call_claude(build_commentary_prompt(title, report), AI_SUMMARY_TIMEOUT)
+        if not commentary:
+            raise RuntimeError("AI 點評失敗")
+        line_bot_api.push_message(
+            group_id, TextSendMessage(text=f"🤖 [團購{buy_num}] {title} 結單點評\n━━━━━━━━━━━━━━\n{commentary}")
+        )
+    except Exception as e:
+        retry_delay = _finish_report_job(job_id, attempts, error=str(e) or type(e).__name__)
+        if retry_delay is None:
+            logger.error(f"[report] 工作 {job_id} 第 {attempts} 次失敗，不再重試: {e}")
         else:
-            all_results.append(cmd_list(group_id, buy_num=bn))
+            logger.warning(f"[report] 工作 {job_id} 第 {attempts} 次失敗，{retry_delay:.0f}s 後重試: {e}")
+            schedule_report_job(job_id, retry_delay)
+        return
+    _finish_report_job(job_id, attempts)
+    logger.info(f"[report] 工作 {job_id} 完成（團購 {buy_id}）")
+
+
+def resume_report_jobs():
+    """繼續已到期的未完成工作（由 worker 的巡查執行緒定期呼叫）
+    running 超過逾時兩倍仍未更新的工作視為中斷（worker 重啟），改回 pending 重新執行；
+    只排入 next_attempt_at 已到的 pending 工作，尚未到期的留給下一輪巡查。
+    重複排入無妨：_claim_report_job 只會讓一個執行緒拿到。回傳排入的工作數。
+    """
+    now = time.time()
+    with write_txn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE report_jobs SET status='pending' WHERE status='running' AND updated_at < ?",
+            (now - 2 * AI_SUMMARY_TIMEOUT,),
+        )
+        c.execute(
+            "SELECT id FROM report_jobs WHERE status='pending' AND next_attempt_at <= ? ORDER BY id",
+            (now,),
+        )
+        jobs = [row[0] for row in c.fetchall()]
+    for job_id in jobs:
+        schedule_report_job(job_id)
+    if jobs:
+        logger.info(f"[report] 繼續 {len(jobs)} 筆未完成的點評工作")
+    return len(jobs)
+
+
+def _sweep_report_jobs():
+    """巡查迴圈：每 REPORT_JOB_SWEEP_INTERVAL 秒繼續到期的工作"""
+    while True:
+        time.sleep(REPORT_JOB_SWEEP_INTERVAL)
+        try:
+            resume_report_jobs()
+        except Exception as e:
+            logger.error(f"[report] 巡查失敗: {e}")
+        finally:
+            close_conn()
 
-    return '\n\n'.join(all_results)
+
+def start_report_sweeper():
+    """在目前的 process 啟動巡查執行緒（每個 process 只啟動一次）
+    --preload 時模組在 arbiter 載入，執行緒不會跟著 fork，
+    所以由 gunicorn 的 post_fork 在每個 worker 裡呼叫。
+    """
+    global _sweeper_pid
+    if not claude_client:
+        return False
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return False
+        _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweep_report_jobs, name="report-sweeper", daemon=True).start()
+    logger.info("[report] 點評工作巡查執行緒已啟動")
+    return True
+
+
+# ══════════════════════════════════════════
+# 指令路由（預先編譯的正規表示式，依首字分派，一次解析出指令與參數）
+# ══════════════════════════════════════════
+
+class Command(namedtuple("Command", ["name", "args"])):
+    """解析後的指令：name 對應 COMMAND_ACTIONS，args 為傳給動作的參數"""
+    __slots__ = ()
+
+
+QTY_UNIT = r'[份個包組盒袋條]'
+CJK = r'\u4e00-\u9fff\u3400-\u4dbf'
+
+OPEN_CMD_RE = re.compile(r'^\s*#?開團')
+HASH_PLUS_QTY_RE = re.compile(rf'^[+#](\d+)\+(\d+)\s*{QTY_UNIT}?\s*$')
+MULTI_ITEM_RE = re.compile(r'(?:^|\s)[+#]\d+')
+ITEM_WITH_REST_RE = re.compile(r'^[+#]\d+\s+\S')
+ITEM_ONLY_RE = re.compile(r'^[+#](\d+)\s*$')
+DOT_WITH_REST_RE = re.compile(r'^(\d+)[\.．]\s+\S')
+DOT_PARTS_RE = re.compile(r'^(\d+)[\.．]\s*(.*)')
+DOT_ONLY_RE = re.compile(r'^(\d+)[\.．]\s*$')
+CANCEL_CMD_RE = re.compile(r'退出\s+\d+')
+LIST_CMD_RE = re.compile(r'^(?:列表|/列表|查看|清單)\s*(\d+)?\s*(?:頁\s*(\d+))?\s*$')
+CLOSE_CMD_RE = re.compile(r'^結團\s*(\d+)?\s*$')
+CANCEL_BUY_CMD_RE = re.compile(r'^取消團購\s*(\d+)?\s*$')
+STATS_CMD_RE = re.compile(r'^(?:統計|AI統計|智能統計)\s*(\d+)?\s*$')
+BATCH_TIMES_RE = re.compile(rf'[{CJK}）\)]\s*[×xX*+]\s*\d')
+BATCH_NAME_DIGIT_RE = re.compile(rf'[{CJK}]\d')
+BATCH_SINGLE_RE = re.compile(rf'^[{CJK}][{CJK}\s]*\d+\s*{QTY_UNIT}?\s*$')
+EMOJI_ONLY_RE = re.compile(r'^[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F1E0-\U0001F1FF\s]+$')
+
+MY_ORDERS_CMD_RE = re.compile(r'^我的(?:訂單|單)(\s*全部)?$')
+HELP_TEXTS = ("團購說明", "操作說明", "說明")
+
+
+def _optional_num(m):
+    return int(m.group(1)) if m.group(1) else None
+
+
+def _parse_item_prefix(text):
+    """+N / #N 開頭的指令"""
+    m = ITEM_WITH_REST_RE.match(text)
+    if m:
+        return Command("order", (text.replace('#', '+', 1),))
+    m = ITEM_ONLY_RE.match(text)
+    if m:
+        return Command("item_prompt", (int(m.group(1)),))
+    return None
+
+
+def _parse_dot_prefix(text):
+    """N. 開頭的指令（數字點格式）"""
+    if DOT_WITH_REST_RE.match(text):
+        m = DOT_PARTS_RE.match(text)
+        rest = m.group(2).strip() if m.group(2) else ""
+        return Command("order", (f"+{m.group(1)} {rest}".strip(),))
+    m = DOT_ONLY_RE.match(text)
+    if m:
+        return Command("item_prompt", (int(m.group(1)),))
+    return None
+
+
+def _keyword_parser(regex, name):
+    def parse(text):
+        m = regex.match(text)
+        return Command(name, (_optional_num(m),)) if m else None
+    return parse
+
+
+def _parse_list(text):
+    """列表 / 列表 N / 列表 N 頁M"""
+    m = LIST_CMD_RE.match(text)
+    if not m:
+        return None
+    return Command("list", (_optional_num(m), int(m.group(2)) if m.group(2) else None))
+
+
+def _exact_parser(texts, name):
+    def parse(text):
+        return Command(name, ()) if text in texts else None
+    return parse
+
+
+def _parse_my_orders(text):
+    """我的訂單 / 我的單 / 我的訂單 全部"""
+    m = MY_ORDERS_CMD_RE.match(text)
+    if not m:
+        return None
+    return Command("my_orders_all" if m.group(1) else "my_orders", ())
+
+
+def _parse_cancel(text):
+    return Command("cancel", (text,)) if CANCEL_CMD_RE.match(text) else None
+
+
+# 首字 → 可能的關鍵字指令（彼此首字不重疊，依序嘗試）
+KEYWORD_PARSERS = {}
+for _chars, _parser in [
+    ("退", _parse_cancel),
+    ("列查清/", _parse_list),
+    ("我", _parse_my_orders),
+    ("結", _keyword_parser(CLOSE_CMD_RE, "close")),
+    ("取", _keyword_parser(CANCEL_BUY_CMD_RE, "cancel_buy")),
+    ("統A智", _keyword_parser(STATS_CMD_RE, "stats")),
+    ("團操說", _exact_parser(HELP_TEXTS, "help")),
+]:
+    for _ch in _chars:
+        KEYWORD_PARSERS.setdefault(_ch, []).append(_parser)
+
+
+def is_batch_order_text(text):
+    """品名×數量、品名數量、Name 品名數量 或 Name|品名數量"""
+    return bool(
+        BATCH_TIMES_RE.search(text)
+        or (('|' in text or '、' in text) and BATCH_NAME_DIGIT_RE.search(text))
+        or BATCH_SINGLE_RE.match(text)
+    )
+
+
+def parse_command(text):
+    """把訊息解析成 Command；不是指令回傳 None（交給 AI 判斷）
+    判斷順序與優先權：開團 → #N+M → 多品項 → #N / N. → 關鍵字指令 → 批次下單
+    """
+    if not text:
+        return None
+    first = text[0]
+
+    # ── 開團（多行文字且含品項編號）
+    if '\n' in text and OPEN_CMD_RE.match(text):
+        return Command("open", (text,))
+
+    item_prefix = first in "+#"
+
+    # ── #N+M 格式（品項N，數量M，如 #1+2 = 品項1訂2份）
+    if item_prefix:
+        m = HASH_PLUS_QTY_RE.match(text)
+        if m:
+            return Command("order", (f"+{m.group(1)} {m.group(2)}",))
+
+    # ── 多品項下單（#1 #3 #5 名字，需有空格分隔；可出現在任何位置）
+    if ('+' in text or '#' in text) and len(MULTI_ITEM_RE.findall(text)) > 1:
+        # 統一 # 為 + 格式
+        return Command("order_multi", (text.replace('#', '+'),))
+
+    # ── 單品項 #N 數量 / #N 名字，或單獨 #N（提示補數量）
+    if item_prefix:
+        cmd = _parse_item_prefix(text)
+        if cmd:
+            return cmd
+    # ── 數字點格式 1. 2 / 1. 小明，或單獨 N.
+    elif first.isdigit():
+        cmd = _parse_dot_prefix(text)
+        if cmd:
+            return cmd
+    # ── 關鍵字指令（退出、列表、我的訂單、結團、取消團購、統計、說明）
+    else:
+        for parser in KEYWORD_PARSERS.get(first, ()):
+            cmd = parser(text)
+            if cmd:
+                return cmd
+
+    # ── 批次下單
+    if is_batch_order_text(text):
+        return Command("batch", (text,))
+    return None
+
+
+def _action_item_prompt(gid, uid, lazy_name, item_num):
+    """單獨 #N / N.（無數量無名字）→ 不動作，提示補充數量"""
+    buy, item_name, err = resolve_item(gid, item_num)
+    if err:
+        return err
+    if buy and item_name:
+        return f"📝【{item_num}】{item_name}\n請輸入數量，例如：#{item_num} 1份"
+    return None
+
+
+# Command.name → 動作（lazy_name 只在需要名字的指令才呼叫）
+COMMAND_ACTIONS = {
+    "open": lambda gid, uid, lazy_name, text: cmd_open(gid, uid, lazy_name(), text),
+    "order": lambda gid, uid, lazy_name, text: cmd_order(gid, uid, lazy_name(), text),
+    "order_multi": lambda gid, uid, lazy_name, text: cmd_order_multi(gid, uid, lazy_name(), text),
+    "item_prompt": _action_item_prompt,
+    "cancel": lambda gid, uid, lazy_name, text: cmd_cancel_order(gid, uid, lazy_name(), text),
+    "list": lambda gid, uid, lazy_name, bn, page: cmd_list(gid, bn, page),
+    "my_orders": lambda gid, uid, lazy_name: cmd_my_orders(gid, uid, lazy_name()),
+    "my_orders_all": lambda gid, uid, lazy_name: cmd_my_orders_all(gid, uid, lazy_name()),
+    "close": lambda gid, uid, lazy_name, bn: cmd_close(gid, uid, bn),
+    "cancel_buy": lambda gid, uid, lazy_name, bn: cmd_cancel_buy(gid, uid, bn),
+    "stats": lambda gid, uid, lazy_name, bn: cmd_ai_summary(gid, bn),
+    "help": lambda gid, uid, lazy_name: HELP_TEXT,
+    "batch": lambda gid, uid, lazy_name, text: cmd_batch_order(gid, uid, lazy_name(), text),
+}
+
+
+# ══════════════════════════════════════════
+# 背景事件處理（webhook 先回 200，事件交給 worker pool）
+# ══════════════════════════════════════════
+
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))          # 0 = 同步處理
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "200"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+
+
+def dispatch_event(event):
+    """依事件類型呼叫本模組的處理函式（EVENT_HANDLERS，不依賴 SDK 內部的註冊表）"""
+    message = getattr(event, "message", None) if isinstance(event, MessageEvent) else None
+    func = EVENT_HANDLERS.get((type(event), type(message) if message is not None else None))
+    if func is None:
+        logger.info(f"[webhook] 沒有 {event.__class__.__name__} 的處理函式")
+        return
+    func(event)
+
+
+class EventQueue:
+    """有上限的事件佇列：依群組分成多條循序處理的 lane，由共用的 worker 執行緒執行
+    - 同一個 lane（群組）的事件依到達順序一次只處理一個 → 開團編號、下單讀改寫、自動結團不互相競爭
+    - 不同群組的 lane 可同時由不同 worker 處理
+    - put_batch：一次放入整批事件，空間不足時最多等 timeout 秒，仍不足則整批拒收（回 503 讓 LINE 重送）
+    - worker 執行緒在第一次放入時才啟動（gunicorn --preload fork 之後才建立）
+    """
+
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._lanes = {}          # lane key → deque[func]
+        self._ready = deque()     # 有待處理事件、且目前沒有 worker 在處理的 lane
+        self._scheduled = set()   # 在 _ready 中或正在處理的 lane
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self._unfinished = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def _ensure_workers(self):
+        if self._pid == os.getpid() and self._threads:
+            return
+        self._pid = os.getpid()
+        self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def put_batch(self, items, timeout=None):
+        """放入一批 (lane_key, func)，成功回傳 True；佇列滿（背壓）回傳 False"""
+        items = list(items)
+        if timeout is None:
+            timeout = WEBHOOK_ENQUEUE_TIMEOUT
+        with self._cond:
+            self._ensure_workers()
+            if len(items) > self.maxsize:
+                self.rejected += len(items)
+                return False
+            if not self._cond.wait_for(lambda: self._depth + len(items) <= self.maxsize, timeout):
+                self.rejected += len(items)
+                return False
+            for key, func in items:
+                self._lanes.setdefault(key, deque()).append(func)
+                if key not in self._scheduled:
+                    self._scheduled.add(key)
+                    self._ready.append(key)
+            self._depth += len(items)
+            self._unfinished += len(items)
+            self.enqueued += len(items)
+            self.max_depth = max(self.max_depth, self._depth)
+            self._cond.notify_all()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready)
+                key = self._ready.popleft()
+                func = self._lanes[key].popleft()
+                self._depth -= 1
+                self._cond.notify_all()
+            try:
+                func()
+                ok = True
+            except Exception as e:
+                logger.error(f"[queue] 事件處理失敗 lane={key}: {e}")
+                ok = False
+            with self._cond:
+                # 這個 lane 還有事件 → 排到最後面，讓其他群組輪流
+                if self._lanes[key]:
+                    self._ready.append(key)
+                else:
+                    del self._lanes[key]
+                    self._scheduled.discard(key)
+                self._unfinished -= 1
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """等所有已放入的事件處理完（測試 / 關機用）"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": self._depth,
+                "max_depth": self.max_depth,
+                "capacity": self.maxsize,
+                "workers": self.workers,
+                "lanes": len(self._lanes),
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+
+event_queue = EventQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+
+def event_lane(event):
+    """事件所屬的 lane：同一個群組 / 聊天室 / 使用者的事件循序處理"""
+    try:
+        return source_id(event)
+    except AttributeError:
+        return ""
+
+
+def submit_events(events):
+    """把 webhook 事件依群組分 lane 交給背景 worker；回傳是否接受"""
+    jobs = [(event_lane(ev), lambda ev=ev: dispatch_event(ev)) for ev in events]
+    if event_queue.workers <= 0:
+        for _, job in jobs:
+            job()
+        return True
+    return event_queue.put_batch(jobs)
 
 
 # ══════════════════════════════════════════
@@ -1499,6 +3777,13 @@ def health():
         "status": "ok",
         "token_set": bool(LINE_CHANNEL_ACCESS_TOKEN),
         "secret_set": bool(LINE_CHANNEL_SECRET),
+        "queue": event_queue.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "render_cache": render_cache.stats(),
+        "nlu_cache": nlu_cache.stats(),
+        "nlu": dict(nlu_stats),
+        "ai": ai_client.stats(),
     }), 200
 
 
@@ -1514,13 +3799,19 @@ def webhook():
     except Exception:
         logger.info(f"[webhook] raw: {body[:200]}")
 
+    # 只在請求內驗證簽章與解析，實際處理交給背景 worker，立即回 200
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         logger.error("[webhook] Invalid signature")
         abort(400)
     except Exception as e:
-        logger.error(f"[webhook] 處理失敗: {e}")
+        logger.error(f"[webhook] 解析失敗: {e}")
+        return "OK"
+
+    if not submit_events(events):
+        logger.warning(f"[webhook] 佇列已滿，拒收 {len(events)} 個事件: {event_queue.stats()}")
+        return "Busy", 503
     return "OK"
 
 
@@ -1537,112 +3828,27 @@ def handle_message(event):
 
     reply = None
 
-    # ── 開團（多行文字且含品項編號）
-    if re.match(r'^\s*#?開團', text) and '\n' in text:
-        reply = cmd_open(gid, uid, lazy_name(), text)
-
-    # ── #N+M 格式（品項N，數量M，如 #1+2 = 品項1訂2份）
-    elif re.match(r'^[+#]\d+\+\d+\s*[份個包組盒袋條]?\s*$', text):
-        m = re.match(r'^[+#](\d+)\+(\d+)', text)
-        reply = cmd_order(gid, uid, lazy_name(), f"+{m.group(1)} {m.group(2)}")
-
-    # ── 多品項下單（#1 #3 #5 名字，需有空格分隔）
-    elif len(re.findall(r'(?:^|\s)[+#]\d+', text)) > 1:
-        # 統一 # 為 + 格式
-        reply = cmd_order_multi(gid, uid, lazy_name(), text.replace('#', '+'))
-
-    # ── 單品項下單（#N 數量 / #N 名字 等，#N 後面必須有內容）
-    elif re.match(r'^[+#]\d+\s+\S', text):
-        reply = cmd_order(gid, uid, lazy_name(), text.replace('#', '+', 1))
-
-    # ── 單獨 #N（無數量無名字）→ 不動作，提示補充數量
-    elif re.match(r'^[+#]\d+\s*$', text):
-        m = re.match(r'^[+#](\d+)', text)
-        item_num = int(m.group(1))
-        buy, err = resolve_buy_for_item(gid, item_num)
-        if err:
-            reply = err
-        elif buy:
-            item_name = get_item_name(buy[0], item_num)
-            if item_name:
-                reply = f"📝【{item_num}】{item_name}\n請輸入數量，例如：#{item_num} 1份"
-
-    # ── 數字點格式下單（1. 2 / 1. 小明，1. 後面必須有內容）
-    elif re.match(r'^\d+[\.．]\s+\S', text):
-        m_dot = re.match(r'^(\d+)[\.．]\s*(.*)', text)
-        rest = m_dot.group(2).strip() if m_dot.group(2) else ""
-        reply = cmd_order(gid, uid, lazy_name(), f"+{m_dot.group(1)} {rest}".strip())
-
-    # ── 單獨 N.（無內容）→ 不動作，提示補充數量
-    elif re.match(r'^\d+[\.．]\s*$', text):
-        m = re.match(r'^(\d+)', text)
-        item_num = int(m.group(1))
-        buy, err = resolve_buy_for_item(gid, item_num)
-        if err:
-            reply = err
-        elif buy:
-            item_name = get_item_name(buy[0], item_num)
-            if item_name:
-                reply = f"📝【{item_num}】{item_name}\n請輸入數量，例如：#{item_num} 1份"
-
-    # ── 退出
-    elif re.match(r'退出\s+\d+', text):
-        reply = cmd_cancel_order(gid, uid, lazy_name(), text)
-
-    # ── 列表（支援「列表N」或「列表 N」指定團購）
-    elif re.match(r'^(?:列表|/列表|查看|清單)\s*(\d+)?\s*$', text):
-        m_list = re.match(r'^(?:列表|/列表|查看|清單)\s*(\d+)?', text)
-        bn = int(m_list.group(1)) if m_list.group(1) else None
-        reply = cmd_list(gid, bn)
-
-    # ── 我的訂單
-    elif text in ("我的訂單", "我的單"):
-        reply = cmd_my_orders(gid, uid, lazy_name())
-
-    # ── 結團（團主專用，支援「結團N」或「結團 N」）
-    elif re.match(r'^結團\s*(\d+)?\s*$', text):
-        m_close = re.match(r'^結團\s*(\d+)?', text)
-        bn = int(m_close.group(1)) if m_close.group(1) else None
-        reply = cmd_close(gid, uid, bn)
-
-    # ── 取消團購（團主專用，支援「取消團購N」或「取消團購 N」）
-    elif re.match(r'^取消團購\s*(\d+)?\s*$', text):
-        m_cancel = re.match(r'^取消團購\s*(\d+)?', text)
-        bn = int(m_cancel.group(1)) if m_cancel.group(1) else None
-        reply = cmd_cancel_buy(gid, uid, bn)
-
-    # ── AI 統計（支援「統計N」或「統計 N」）
-    elif re.match(r'^(?:統計|AI統計|智能統計)\s*(\d+)?\s*$', text):
-        m_stat = re.match(r'^(?:統計|AI統計|智能統計)\s*(\d+)?', text)
-        bn = int(m_stat.group(1)) if m_stat.group(1) else None
-        reply = cmd_ai_summary(gid, bn)
-
-    # ── 團購說明（所有人可用）
-    elif text in ("團購說明", "操作說明", "說明"):
-        reply = HELP_TEXT
-
-    # ── 批次下單（品名×數量、品名數量、Name 品名數量 或 Name|品名數量）
-    elif re.search(r'[\u4e00-\u9fff\u3400-\u4dbf）\)]\s*[×xX*+]\s*\d', text) or \
-         (('|' in text or '、' in text) and re.search(r'[\u4e00-\u9fff\u3400-\u4dbf]\d', text)) or \
-         re.match(r'^[\u4e00-\u9fff\u3400-\u4dbf][\u4e00-\u9fff\u3400-\u4dbf\s]*\d+\s*[份個包組盒袋條]?\s*$', text):
-        reply = cmd_batch_order(gid, uid, lazy_name(), text)
+    cmd = parse_command(text)
+    if cmd is not None:
+        reply = COMMAND_ACTIONS[cmd.name](gid, uid, lazy_name, *cmd.args)
 
     # ── AI 自然語言理解（放在所有指令判斷的最後）
     if reply is None and len(text) >= 2 and len(text) <= 200:
-        if not re.match(r'^[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F1E0-\U0001F1FF\s]+$', text):
+        if not EMOJI_ONLY_RE.match(text):
             nlu_reply = cmd_nlu_order(gid, uid, lazy_name(), text)
             if nlu_reply:
                 reply = nlu_reply
 
-    logger.info(f"[msg] reply={'（無）' if reply is None else repr(reply[:40])}")
-
-    if reply:
-        if len(reply) > 5000:
-            reply = reply[:4950] + "\n\n⋯（訊息過長已截斷，請輸入「列表」查看完整內容）"
-        try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
-        except Exception as e:
-            logger.error(f"[reply] 失敗: {e}")
+    if not reply:
+        logger.info("[msg] reply=（無）")
+        return
+    chunks = reply_messages(reply)
+    logger.info(f"[msg] reply={repr(chunks[0][:40])} ({len(chunks)} 則)")
+    messages = [TextSendMessage(text=chunk) for chunk in chunks]
+    try:
+        line_bot_api.reply_message(event.reply_token, messages[0] if len(messages) == 1 else messages)
+    except Exception as e:
+        logger.error(f"[reply] 失敗: {e}")
 
 
 @handler.add(JoinEvent)
@@ -1660,6 +3866,14 @@ def handle_join(event):
         logger.error(f"[Join] 失敗: {e}")
 
 
+# webhook 事件 → 處理函式，key = (事件類別, 訊息類別或 None)
+# webhook 由 dispatch_event 依這張表分派（不經 handler.handle），新增事件類型時要登記在這裡
+EVENT_HANDLERS = {
+    (MessageEvent, TextMessage): handle_message,
+    (JoinEvent, None): handle_join,
+}
+
+
 # ══════════════════════════════════════════
 # 啟動初始化（模組層級）
 # ══════════════════════════════════════════
@@ -1668,13 +3882,14 @@ def _startup():
     """模組載入時：在背景執行緒初始化 DB（避免阻塞 port 綁定）"""
 
     def _delayed_init():
-        import time
         time.sleep(3)
         try:
             init_db()
             logger.info("[startup] 資料庫初始化完成")
         except Exception as e:
             logger.error(f"[startup] 資料庫初始化失敗: {e}")
+        finally:
+            close_conn()
 
     t = threading.Thread(target=_delayed_init, daemon=True)
     t.start()
@@ -1685,5 +3900,6 @@ _startup()
 
 
 if __name__ == "__main__":
+    start_report_sweeper()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,78 @@
+"""
+批次下單品項比對效能測試：逐一子字串比對 vs 目錄快取中的雙字倒排索引（ItemMatcher）
+模擬多個同時進行的團購，每團多個品項，比對一則長的多品項批次訊息。
+
+用法：python bench_batch.py [團購數] [每團品項數] [回合數]
+"""
+
+import os
+import sys
+import time
+import logging
+import tempfile
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+GID = "bench_group"
+
+
+def setup(n_buys, n_items):
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_batch.db")
+    app.close_conn()
+    app.init_db()
+    for b in range(1, n_buys + 1):
+        lines = ["#開團", f"第{b}團"]
+        for i in range(1, n_items + 1):
+            lines.append(f"{i}) 第{b}團特製品項{i}號（冷凍宅配）{100 + i}元／2包{190 + i}元")
+        app.cmd_open(GID, "owner", "團主", "\n".join(lines))
+
+
+def linear_find(entries, search):
+    """舊版 find_match：逐一子字串比對"""
+    for buy, item in entries:
+        if search in item[3] or search in (item[4] or ""):
+            return (buy, item)
+    return None
+
+
+def bench(label, fn, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    ms = (time.perf_counter() - t0) * 1000 / rounds
+    print(f"  {label:<30} {ms:8.3f} ms / 則")
+    return ms
+
+
+if __name__ == "__main__":
+    n_buys = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    n_items = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    setup(n_buys, n_items)
+    catalog = app.get_catalog(GID)
+    entries = catalog.matcher.entries
+
+    # 一則長訊息：多數命中最後一團的品項，部分找不到且帶前導代訂人名（觸發字尾重試）
+    searches = []
+    for i in range(1, 31):
+        searches.append(f"第{n_buys}團特製品項{n_items - i}號")
+        searches.append(f"小明 阿華 找不到的東西{i}")
+    attempts = []
+    for search in searches:
+        words = search.split()
+        attempts.append(search)
+        for i in range(1, len(words)):
+            attempts.extend((''.join(words[i:]), ' '.join(words[i:])))
+
+    for search in attempts:
+        assert catalog.matcher.find(search) == linear_find(entries, search)
+
+    print(f"[{n_buys} 團 × {n_items} 品項，每則 {len(searches)} 個品項 / {len(attempts)} 次比對]")
+    before = bench("逐一子字串比對", lambda: [linear_find(entries, s) for s in attempts], rounds)
+    after = bench("ItemMatcher 倒排索引", lambda: [catalog.matcher.find(s) for s in attempts], rounds)
+    print(f"  → 加速 {before / after:.1f}x")
+    t0 = time.perf_counter()
+    app.ItemMatcher(entries)
+    print(f"  建立索引（每次目錄重新載入一次）：{(time.perf_counter() - t0) * 1000:.3f} ms")
@@ -0,0 +1,109 @@
+"""
+連線層效能測試：比較「每次呼叫都 sqlite3.connect」與「執行緒共用連線」
+量測每則訊息開啟的連線數與處理延遲。
+
+用法：python bench_db.py [訊息數]
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import logging
+import statistics
+from unittest.mock import MagicMock, patch
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+GID = "bench_group"
+OPEN_TEXT = "#開團 限量100000份\n壓測團\n" + "\n".join(
+    f"{i}) 品項{i} {50 + i}元／2包{90 + i * 2}元" for i in range(1, 21)
+)
+
+
+class ConnectCounter:
+    """包住 sqlite3.connect，計算實際開啟的連線數"""
+
+    def __init__(self):
+        self.count = 0
+        self._real = sqlite3.connect
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self._real(*args, **kwargs)
+
+
+def per_call_conn():
+    """模擬舊版行為：每個輔助函式都開一條新連線"""
+    return sqlite3.connect(app.DB_PATH)
+
+
+def make_event(text, user_id):
+    event = MagicMock()
+    event.message.text = text
+    event.source.type = "group"
+    event.source.group_id = GID
+    event.source.user_id = user_id
+    event.reply_token = "bench"
+    return event
+
+
+def run(label, n_messages, pooled):
+    db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app.DB_PATH = db_file
+    app.close_conn()
+    app.init_db()
+    app.claude_client = None
+    app.cmd_open(GID, "owner", "團主", OPEN_TEXT)
+
+    messages = []
+    for i in range(n_messages):
+        item = i % 20 + 1
+        kind = i % 4
+        if kind == 0:
+            messages.append((f"+{item}", f"u{i % 30}"))
+        elif kind == 1:
+            messages.append((f"#{item} 2", f"u{i % 30}"))
+        elif kind == 2:
+            messages.append((f"品項{item}×1", f"u{i % 30}"))
+        else:
+            messages.append(("我的訂單", f"u{i % 30}"))
+
+    counter = ConnectCounter()
+    latencies = []
+    patches = [
+        patch.object(app.line_bot_api, "reply_message"),
+        patch.object(app.line_bot_api, "get_group_member_profile",
+                     return_value=MagicMock(display_name="壓測者")),
+        patch("sqlite3.connect", counter),
+    ]
+    if not pooled:
+        patches.append(patch.object(app, "get_conn", per_call_conn))
+    for p in patches:
+        p.start()
+    try:
+        for text, uid in messages:
+            t0 = time.perf_counter()
+            app.handle_message(make_event(text, uid))
+            latencies.append((time.perf_counter() - t0) * 1000)
+    finally:
+        for p in reversed(patches):
+            p.stop()
+        app.close_conn()
+
+    latencies.sort()
+    print(f"[{label}]")
+    print(f"  訊息數          : {n_messages}")
+    print(f"  連線數 / 訊息   : {counter.count / n_messages:.2f}")
+    print(f"  平均延遲 (ms)   : {statistics.mean(latencies):.3f}")
+    print(f"  p50 / p95 (ms)  : {latencies[len(latencies) // 2]:.3f} / "
+          f"{latencies[int(len(latencies) * 0.95)]:.3f}")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    run("before：每次呼叫開新連線", n, pooled=False)
+    run("after ：執行緒共用連線", n, pooled=True)
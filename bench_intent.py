@@ -0,0 +1,96 @@
+"""
+本地意圖判斷評估：在標註語料上量測 classify_intent 的準確率與省下的 Claude 呼叫
+語料：fixtures/intent_corpus.jsonl（每行 text、intent 與正確的 item_num / quantity / for_name）
+品項：fixtures/intent_catalog.txt（開團貼文）
+
+判斷結果：
+  local  → 本地直接處理，必須與標註完全相同
+  ignore → 直接略過，標註必須是 ignore
+  claude → 交給 Claude（不算錯，但沒有省下呼叫）
+舊版 is_possibly_order_related 關鍵字過濾的結果一併列出比較。
+
+用法：python bench_intent.py [回合數]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixtures():
+    with open(os.path.join(FIXTURES, "intent_catalog.txt"), encoding="utf-8") as f:
+        _, items = app.parse_group_buy(f.read())
+    # 與 items 表相同的欄位：id, group_buy_id, item_num, name, price_info, max_quantity
+    rows = [(i, 1, num, name, info, None) for i, (num, name, info) in enumerate(items, 1)]
+    with open(os.path.join(FIXTURES, "intent_corpus.jsonl"), encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    return rows, cases
+
+
+def legacy_is_possibly_order_related(text, items):
+    """舊版預先過濾：品名關鍵字或下單相關詞彙"""
+    for item in items:
+        if any(keyword in text for keyword in item[3].split() if len(keyword) >= 2):
+            return True
+    order_keywords = ['要', '買', '訂', '加', '來', '份', '個', '包', '組', '盒',
+                      '幫我', '我也', '一樣', '跟', '同上', '加一', '再來', '還要',
+                      '取消', '不要', '退', '改', '換']
+    return any(kw in text for kw in order_keywords)
+
+
+def judge(case, kind, intent):
+    """回傳 (是否正確, 說明)"""
+    if kind == "claude":
+        return True, "claude"
+    if kind == "ignore":
+        return case["intent"] == "ignore", "ignore"
+    expected = {k: case.get(k) for k in ("item_num", "quantity", "for_name") if k in case}
+    got = {k: intent.get(k) for k in expected}
+    return intent["action"] == case["intent"] and got == expected, intent
+
+
+def evaluate(items, cases):
+    results = []
+    for case in cases:
+        orders = [tuple(o) for o in case.get("user_orders", [])]
+        kind, intent = app.classify_intent(case["text"], items, orders)
+        ok, detail = judge(case, kind, intent)
+        results.append((case, kind, ok, detail))
+    return results
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    items, cases = load_fixtures()
+    results = evaluate(items, cases)
+
+    decided = [r for r in results if r[1] != "claude"]
+    wrong = [r for r in results if not r[2]]
+    legacy_calls = sum(legacy_is_possibly_order_related(c["text"], items) for c in cases)
+    new_calls = len(results) - len(decided)
+
+    print(f"[語料 {len(cases)} 則，品項 {len(items)} 項]")
+    for kind in ("local", "ignore", "claude"):
+        print(f"  {kind:<7} {sum(r[1] == kind for r in results):4d} 則")
+    print(f"  本地判斷準確率：{len(decided) - len(wrong)}/{len(decided)}"
+          f"（{(len(decided) - len(wrong)) / max(len(decided), 1):.1%}）")
+    print(f"  Claude 呼叫：舊版關鍵字過濾 {legacy_calls} 次 → {new_calls} 次"
+          f"（省下 {1 - new_calls / max(legacy_calls, 1):.1%}）")
+    for case, kind, _, detail in wrong:
+        print(f"  ❌ {case['text']!r}：標註 {case['intent']}，判斷 {detail}")
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for case in cases:
+            app.classify_intent(case["text"], items)
+    us = (time.perf_counter() - t0) * 1e6 / (rounds * len(cases))
+    print(f"  classify_intent 平均 {us:.1f} µs / 則")
+    sys.exit(1 if wrong else 0)
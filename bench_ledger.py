@@ -0,0 +1,89 @@
+"""
+訂單事件帳本重播效能測試：單一團購 1,000,000 筆事件（add / set / cancel）
+量測完整重播的吞吐量，以及從最近快照（之後只剩不到 ORDER_SNAPSHOT_INTERVAL 筆事件）重播的時間。
+
+用法：python bench_ledger.py [事件數] [品項數] [買家數]
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+GID = "bench_group"
+
+
+def setup(n_events, n_items, n_users):
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_ledger.db")
+    app.close_conn()
+    app.init_db()
+    lines = ["#開團", "帳本壓測"] + [f"{i}) 品項{i} {50 + i}元" for i in range(1, n_items + 1)]
+    app.cmd_open(GID, "owner", "團主", "\n".join(lines))
+    buy_id = app.get_active_buys(GID)[0][0]
+
+    rnd = random.Random(11)
+
+    def events(n):
+        for _ in range(n):
+            u = rnd.randrange(n_users)
+            num = rnd.randrange(1, n_items + 1)
+            r = rnd.random()
+            kind = "add" if r < 0.6 else "set" if r < 0.85 else "cancel"
+            qty = None if kind == "cancel" else rnd.randrange(1, 5)
+            yield (buy_id, kind, num, f"u{u}", f"買家{u}", qty)
+
+    # 快照停在最後 ORDER_SNAPSHOT_INTERVAL / 2 筆事件之前，模擬正常運作時的最壞情況
+    tail = app.ORDER_SNAPSHOT_INTERVAL // 2
+    conn = app.get_conn()
+    sql = "INSERT INTO order_events (group_buy_id, kind, item_num, user_id, user_name, quantity) VALUES (?, ?, ?, ?, ?, ?)"
+    conn.executemany(sql, events(n_events - tail))
+    conn.commit()
+    with app.write_txn() as conn:
+        app.take_order_snapshot(conn.cursor(), buy_id)
+    conn.executemany(sql, events(tail))
+    conn.commit()
+    return buy_id
+
+
+def bench(label, fn, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    sec = (time.perf_counter() - t0) / rounds
+    print(f"  {label:<32} {sec * 1000:10.2f} ms / 次")
+    return sec, result
+
+
+if __name__ == "__main__":
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_items = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    n_users = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    t0 = time.perf_counter()
+    buy_id = setup(n_events, n_items, n_users)
+    print(f"建立 {n_events} 筆事件（{n_items} 品項 / {n_users} 買家）：{time.perf_counter() - t0:.1f}s")
+
+    conn = app.get_conn()
+    c = conn.cursor()
+    print(f"[重播：快照間隔 {app.ORDER_SNAPSHOT_INTERVAL} 筆]")
+    snap_sec, snap_state = bench("從最近快照重播", lambda: app.replay_order_events(c, buy_id), 20)
+
+    with app.write_txn():
+        conn.execute("DELETE FROM order_snapshots WHERE group_buy_id=?", (buy_id,))
+        full_sec, full_state = bench("完整重播（無快照）", lambda: app.replay_order_events(c, buy_id), 1)
+        conn.rollback()
+
+    assert full_state == snap_state, "快照重播結果與完整重播不一致"
+    print(f"  完整重播吞吐量 {n_events / full_sec:,.0f} 筆事件 / 秒，投影 {len(full_state.orders)} 筆訂單")
+    print(f"  → 快照加速 {full_sec / snap_sec:.0f}x")
+
+    with app.write_txn() as conn:
+        t0 = time.perf_counter()
+        app.rebuild_orders(conn.cursor(), buy_id, snap_state)
+        print(f"  由帳本重建 orders 投影               {(time.perf_counter() - t0) * 1000:10.2f} ms")
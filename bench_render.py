@@ -0,0 +1,99 @@
+"""
+列表渲染效能測試：50 品項 / 500 筆訂單的 format_buy_list
+比較「每筆訂單重新解析價格文字」與「每個品項只解析一次（依 price_info 快取）」，
+以及兩次寫入之間重複「列表」時的渲染快取命中（依團購版本號）。
+
+用法：python bench_render.py [品項數] [訂單數] [回合數]
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+from unittest.mock import patch
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+GID = "bench_group"
+
+
+def setup(n_items, n_orders):
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_render.db")
+    app.close_conn()
+    app.init_db()
+    lines = ["#開團", "渲染壓測"]
+    for i in range(1, n_items + 1):
+        lines.append(f"{i}) 品項{i}（50顆裝）{200 + i}元／2包{380 + i}元 3包{550 + i}元")
+        lines.append("冷凍宅配，數量有限")
+    app.cmd_open(GID, "owner", "團主", "\n".join(lines))
+    buy_id = app.get_active_buys(GID)[0][0]
+
+    rnd = random.Random(7)
+    conn = app.get_conn()
+    conn.executemany(
+        "INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity) VALUES (?, ?, ?, ?, ?)",
+        ((buy_id, rnd.randrange(1, n_items + 1), f"u{i}", f"買家{i}", rnd.randrange(1, 6))
+         for i in range(n_orders)),
+    )
+    conn.commit()
+    return buy_id
+
+
+_parse_tiers = app._price_tiers.__wrapped__
+
+
+def uncached_tiers(price_info):
+    """舊版行為：每次都重新跑 regex 解析"""
+    return _parse_tiers(price_info)
+
+
+def bench(label, fn, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    ms = (time.perf_counter() - t0) * 1000 / rounds
+    print(f"  {label:<36} {ms:8.3f} ms / 次")
+    return ms
+
+
+if __name__ == "__main__":
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n_orders = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    buy_id = setup(n_items, n_orders)
+    items = app.get_items(buy_id)
+    orders = app.get_orders(buy_id)
+    info_by_item = {it[2]: it[4] or it[3] for it in items}
+
+    print(f"[format_buy_list：{n_items} 品項 / {n_orders} 筆訂單]")
+
+    # 價格計算本身：每筆訂單重新解析 vs 預先解析
+    def amounts_reparse():
+        for o in orders:
+            tiers = uncached_tiers(info_by_item[o[2]])
+            app.amount_for_tiers(tiers, o[5])
+
+    def amounts_precompiled():
+        tiers_by_item = {num: app._price_tiers(info) for num, info in info_by_item.items()}
+        for o in orders:
+            app.amount_for_tiers(tiers_by_item[o[2]], o[5])
+
+    before = bench("金額計算：每筆訂單重新解析", amounts_reparse, rounds)
+    after = bench("金額計算：每品項解析一次", amounts_precompiled, rounds)
+    print(f"  → 加速 {before / after:.1f}x")
+
+    # 完整列表渲染（不經渲染快取）
+    with patch.object(app, "_price_tiers", uncached_tiers):
+        before = bench("渲染：無 price_info 快取", lambda: app._render_buy_list(buy_id), rounds)
+    app._price_tiers.cache_clear()
+    after = bench("渲染：price_info 快取", lambda: app._render_buy_list(buy_id), rounds)
+    print(f"  → 加速 {before / after:.1f}x")
+
+    # 渲染快取：版本號沒變時只查一次版本號
+    app.format_buy_list(buy_id)
+    cached = bench("format_buy_list：渲染快取命中", lambda: app.format_buy_list(buy_id), rounds)
+    print(f"  → 比重新渲染快 {after / cached:.1f}x")
@@ -0,0 +1,114 @@
+"""
+指令路由效能測試：舊版逐條 re.match 判斷 vs 預先編譯、依首字分派的 parse_command
+語料模擬群組對話：下單、閒聊、列表、批次下單等。也會確認兩者的路由結果完全一致。
+
+用法：python bench_router.py [回合數]
+"""
+
+import re
+import sys
+import time
+import logging
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+CORPUS = [
+    # 下單
+    "#1", "#1 2", "#3 2份", "+2", "+1 小明", "+1 小明 3", "#1+2", "#1 #3 #5 小美", "+1 +2",
+    "1. 2", "2.", "3．小華", "#12 1包",
+    # 批次下單
+    "水餃×2", "水餃×2、蛋餃×3", "小明|水餃×2", "蛋餃2", "小明 魚餃 2", "水餃+1\n蛋餃+2",
+    # 指令
+    "列表", "列表 2", "列表2", "查看", "我的訂單", "我的單", "退出 1", "退出 2 小明",
+    "結團", "結團 1", "取消團購", "取消團購2", "統計", "AI統計 1", "團購說明", "說明",
+    # 閒聊（落到 AI 判斷或忽略）
+    "好喔", "謝謝團主～", "今天幾點取貨？", "哈哈哈哈", "我也要", "一樣", "收到", "👍",
+    "請問水餃是冷凍的嗎", "明天下午三點在社區大門口", "+1的人記得匯款喔", "晚安",
+    "這個上次買過很好吃", "有人要一起合買嗎", "OK", "已匯款 520 元",
+    "#開團\n今日美食\n1) 水餃 50元\n2) 蛋餃 60元",
+]
+
+
+def legacy_route(text):
+    """舊版 handle_message 的判斷順序（未編譯、逐條比對），回傳 (name, args)"""
+    if re.match(r'^\s*#?開團', text) and '\n' in text:
+        return ("open", (text,))
+    elif re.match(r'^[+#]\d+\+\d+\s*[份個包組盒袋條]?\s*$', text):
+        m = re.match(r'^[+#](\d+)\+(\d+)', text)
+        return ("order", (f"+{m.group(1)} {m.group(2)}",))
+    elif len(re.findall(r'(?:^|\s)[+#]\d+', text)) > 1:
+        return ("order_multi", (text.replace('#', '+'),))
+    elif re.match(r'^[+#]\d+\s+\S', text):
+        return ("order", (text.replace('#', '+', 1),))
+    elif re.match(r'^[+#]\d+\s*$', text):
+        m = re.match(r'^[+#](\d+)', text)
+        return ("item_prompt", (int(m.group(1)),))
+    elif re.match(r'^\d+[\.．]\s+\S', text):
+        m_dot = re.match(r'^(\d+)[\.．]\s*(.*)', text)
+        rest = m_dot.group(2).strip() if m_dot.group(2) else ""
+        return ("order", (f"+{m_dot.group(1)} {rest}".strip(),))
+    elif re.match(r'^\d+[\.．]\s*$', text):
+        m = re.match(r'^(\d+)', text)
+        return ("item_prompt", (int(m.group(1)),))
+    elif re.match(r'退出\s+\d+', text):
+        return ("cancel", (text,))
+    elif re.match(r'^(?:列表|/列表|查看|清單)\s*(\d+)?\s*$', text):
+        m_list = re.match(r'^(?:列表|/列表|查看|清單)\s*(\d+)?', text)
+        # 舊版沒有「頁M」參數，分頁固定為 None
+        return ("list", (int(m_list.group(1)) if m_list.group(1) else None, None))
+    elif text in ("我的訂單", "我的單"):
+        return ("my_orders", ())
+    elif re.match(r'^結團\s*(\d+)?\s*$', text):
+        m_close = re.match(r'^結團\s*(\d+)?', text)
+        return ("close", (int(m_close.group(1)) if m_close.group(1) else None,))
+    elif re.match(r'^取消團購\s*(\d+)?\s*$', text):
+        m_cancel = re.match(r'^取消團購\s*(\d+)?', text)
+        return ("cancel_buy", (int(m_cancel.group(1)) if m_cancel.group(1) else None,))
+    elif re.match(r'^(?:統計|AI統計|智能統計)\s*(\d+)?\s*$', text):
+        m_stat = re.match(r'^(?:統計|AI統計|智能統計)\s*(\d+)?', text)
+        return ("stats", (int(m_stat.group(1)) if m_stat.group(1) else None,))
+    elif text in ("團購說明", "操作說明", "說明"):
+        return ("help", ())
+    elif re.search(r'[一-鿿㐀-䶿）\)]\s*[×xX*+]\s*\d', text) or \
+            (('|' in text or '、' in text) and re.search(r'[一-鿿㐀-䶿]\d', text)) or \
+            re.match(r'^[一-鿿㐀-䶿][一-鿿㐀-䶿\s]*\d+\s*[份個包組盒袋條]?\s*$', text):
+        return ("batch", (text,))
+    return None
+
+
+def new_route(text):
+    cmd = app.parse_command(text)
+    return (cmd.name, cmd.args) if cmd else None
+
+
+def bench(label, fn, corpus, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for text in corpus:
+            fn(text)
+    us = (time.perf_counter() - t0) * 1e6 / (rounds * len(corpus))
+    print(f"  {label:<28} {us:7.2f} µs / 則")
+    return us
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    corpus = [app.normalize(t) for t in CORPUS]
+
+    mismatches = [t for t in corpus if legacy_route(t) != new_route(t)]
+    if mismatches:
+        print("⚠️ 路由結果不一致：", mismatches)
+        sys.exit(1)
+    print(f"路由結果一致（{len(corpus)} 則語料）")
+
+    chit_chat = [t for t in corpus if legacy_route(t) is None]
+    print(f"[全部語料 {len(corpus)} 則]")
+    before = bench("舊版逐條 re.match", legacy_route, corpus, rounds)
+    after = bench("parse_command", new_route, corpus, rounds)
+    print(f"  → 加速 {before / after:.1f}x")
+    print(f"[閒聊（沒有符合任何指令）{len(chit_chat)} 則]")
+    before = bench("舊版逐條 re.match", legacy_route, chit_chat, rounds)
+    after = bench("parse_command", new_route, chit_chat, rounds)
+    print(f"  → 加速 {before / after:.1f}x")
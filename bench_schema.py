@@ -0,0 +1,140 @@
+"""
+索引效能測試：在大量歷史資料（已結團團購 + 訂單）上量測熱門查詢
+先用無索引的舊版 schema 量測，再執行 init_db() 套用遷移（建立索引）後再量一次。
+
+用法：python bench_schema.py [已結團團購數] [訂單數]
+預設 100000 團 / 5000000 筆訂單（建立資料約需數十秒）
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+
+import app
+
+app.logger.setLevel(logging.WARNING)
+
+GROUPS = 500
+ITEMS_PER_BUY = 10
+HOT_GROUP = "hot_group"
+
+# 與遷移前（v0）相同、沒有任何次要索引的 schema
+LEGACY_SCHEMA = """
+CREATE TABLE group_buys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, group_id TEXT NOT NULL, title TEXT NOT NULL,
+    description TEXT, creator_id TEXT NOT NULL, creator_name TEXT, status TEXT DEFAULT 'open',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, buy_num INTEGER DEFAULT 1, max_quantity INTEGER
+);
+CREATE TABLE items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, group_buy_id INTEGER NOT NULL, item_num INTEGER NOT NULL,
+    name TEXT NOT NULL, price_info TEXT, max_quantity INTEGER
+);
+CREATE TABLE orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, group_buy_id INTEGER NOT NULL, item_num INTEGER NOT NULL,
+    user_id TEXT NOT NULL, user_name TEXT, quantity INTEGER DEFAULT 1, registered_by TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def build_db(path, n_buys, n_orders):
+    conn = app._open_conn(path)
+    conn.executescript(LEGACY_SCHEMA)
+    rnd = random.Random(42)
+    orders_per_buy = max(1, n_orders // n_buys)
+
+    def buys():
+        for i in range(1, n_buys + 1):
+            yield (i, f"g{i % GROUPS}", f"團購{i}", "u0", "closed", i // GROUPS + 1)
+
+    conn.executemany(
+        "INSERT INTO group_buys (id, group_id, title, creator_id, status, buy_num) VALUES (?, ?, ?, ?, ?, ?)",
+        buys(),
+    )
+    conn.executemany(
+        "INSERT INTO items (group_buy_id, item_num, name, price_info) VALUES (?, ?, ?, ?)",
+        ((b, n, f"品項{n}", f"品項{n} {50 + n}元")
+         for b in range(1, n_buys + 1) for n in range(1, ITEMS_PER_BUY + 1)),
+    )
+
+    def orders():
+        for b in range(1, n_buys + 1):
+            for _ in range(orders_per_buy):
+                u = rnd.randrange(200)
+                yield (b, rnd.randrange(1, ITEMS_PER_BUY + 1), f"u{u}", f"用戶{u}", rnd.randrange(1, 4))
+
+    conn.executemany(
+        "INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity) VALUES (?, ?, ?, ?, ?)",
+        orders(),
+    )
+
+    # 熱門群組：兩個進行中的團購
+    for buy_num in (1, 2):
+        cur = conn.execute(
+            "INSERT INTO group_buys (group_id, title, creator_id, status, buy_num) VALUES (?, ?, 'u0', 'open', ?)",
+            (HOT_GROUP, f"進行中{buy_num}", buy_num),
+        )
+        bid = cur.lastrowid
+        conn.executemany(
+            "INSERT INTO items (group_buy_id, item_num, name, price_info) VALUES (?, ?, ?, ?)",
+            ((bid, n, f"熱門{n}", f"熱門{n} 80元") for n in range(1, ITEMS_PER_BUY + 1)),
+        )
+        conn.executemany(
+            "INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity) VALUES (?, ?, ?, ?, 1)",
+            ((bid, rnd.randrange(1, ITEMS_PER_BUY + 1), f"u{u}", f"用戶{u}") for u in range(100)),
+        )
+    conn.commit()
+    conn.close()
+
+
+def time_queries(label, rounds=200):
+    conn = app._open_conn(app.DB_PATH)
+    bid = conn.execute(
+        "SELECT id FROM group_buys WHERE group_id=? AND buy_num=1", (HOT_GROUP,)
+    ).fetchone()[0]
+    queries = [
+        ("進行中團購 (group_id, status)",
+         'SELECT * FROM group_buys WHERE group_id=? AND status="open" ORDER BY buy_num', (HOT_GROUP,)),
+        ("品項名稱 (group_buy_id, item_num)",
+         "SELECT name FROM items WHERE group_buy_id=? AND item_num=?", (bid, 3)),
+        ("既有訂單 (group_buy_id, item_num, user_name)",
+         "SELECT id, quantity FROM orders WHERE group_buy_id=? AND item_num=? AND user_name=?", (bid, 3, "用戶7")),
+        ("品項數量加總 SUM(quantity)",
+         "SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE group_buy_id=? AND item_num=?", (bid, 3)),
+        ("我的訂單 JOIN (user_id, group_buy_id)",
+         app.MY_ORDERS_SQL.format(where="gb.group_id = ? AND gb.status = 'open'", order="gb.buy_num"),
+         ("u7", HOT_GROUP)),
+        ("我的訂單 全部：最近團購 (user_id)",
+         "SELECT DISTINCT group_buy_id FROM orders WHERE user_id=? ORDER BY group_buy_id DESC LIMIT 20", ("u7",)),
+    ]
+    n = rounds
+    print(f"[{label}]")
+    for name, sql, args in queries:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            conn.execute(sql, args).fetchall()
+        ms = (time.perf_counter() - t0) * 1000 / n
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", args).fetchall()
+        print(f"  {name:<44} {ms:9.3f} ms   {plan[0][3]}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    n_buys = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_orders = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000_000
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_schema.db")
+
+    t0 = time.perf_counter()
+    build_db(app.DB_PATH, n_buys, n_orders)
+    print(f"建立測試資料：{n_buys} 團 / {n_orders} 筆訂單，{time.perf_counter() - t0:.1f}s")
+
+    time_queries("before：無索引 (schema v0)", rounds=5)
+
+    t0 = time.perf_counter()
+    app.init_db()
+    print(f"套用遷移至 v{app.SCHEMA_VERSION}：{time.perf_counter() - t0:.1f}s")
+
+    time_queries(f"after ：schema v{app.SCHEMA_VERSION}")
@@ -1,6 +1,7 @@
 """
 Gunicorn 設定檔
-標記 worker process，讓 _startup 知道自己在 worker 裡
+標記 worker process，讓 _startup 知道自己在 worker 裡，
+並在每個 worker 啟動點評工作巡查執行緒（--preload 時 arbiter 的執行緒不會跟著 fork）
 """
 import os
 
@@ -8,3 +9,5 @@ import os
 def post_fork(server, worker):
     """每個 worker process fork 後設定標記"""
     os.environ["GUNICORN_WORKER"] = "1"
+    import app
+    app.start_report_sweeper()
@@ -5,7 +5,9 @@ LINE 團購接龍機器人 — 單元測試
 
 import os
 import re
+import json
 import sqlite3
+import logging
 import tempfile
 from unittest.mock import MagicMock, patch
 
@@ -25,6 +27,10 @@ def setup_db(tmp_path):
     app.DB_PATH = db_file
     app.init_db()
     app.claude_client = None  # 預設關閉 AI
+    app.profile_cache.clear()
+    app.nlu_cache.clear()
+    app.render_cache.clear()
+    app.ai_client = app.AIClient()
     yield
     # cleanup
     try:
@@ -554,6 +560,37 @@ class TestAutoClose:
         assert "已訂 2/5" in result
         assert "剩餘 3 份" in result
 
+    def test_auto_close_announced_once(self):
+        """已結團後再檢查 → 條件式更新不成立，不重複公告、不重複記錄事件"""
+        open_buy_limited(limit=5)
+        buy_id = app.get_active_buys(GID)[0][0]
+        app.cmd_order(GID, UID, UNAME, "+1 5")
+        app.cmd_order(GID, UID, UNAME, "+2 5")
+        version = app.get_buy_version(buy_id)
+
+        assert app.check_auto_close(buy_id, GID) is None
+        assert app.get_buy_version(buy_id) == version
+        n_events = app.get_conn().execute(
+            "SELECT COUNT(*) FROM order_events WHERE group_buy_id=? AND kind='auto_close'", (buy_id,)
+        ).fetchone()[0]
+        assert n_events == 1
+
+    def test_auto_close_rechecks_inside_txn(self):
+        """交易外看到額滿、交易內已有人取消 → 不結團"""
+        open_buy_limited(limit=5)
+        buy_id = app.get_active_buys(GID)[0][0]
+        app.cmd_order(GID, UID, UNAME, "+1 5")
+        app.cmd_order(GID, UID, UNAME, "+2 4")
+        real = app._all_items_full
+        answers = iter([True])   # 第一次（交易外）假裝已額滿，之後照實檢查
+
+        def stale_then_real(c, bid):
+            return next(answers, None) or real(c, bid)
+
+        with patch.object(app, "_all_items_full", side_effect=stale_then_real):
+            assert app.check_auto_close(buy_id, GID) is None
+        assert len(app.get_active_buys(GID)) == 1
+
 
 # ══════════════════════════════════════════
 # 11. 多團購解析 (resolve_buy_for_item)
@@ -978,3 +1015,1950 @@ class TestPerItemLimit:
         assert items[0][5] == 5
         assert items[1][5] == 5
         assert items[2][5] == 5
+
+
+# ══════════════════════════════════════════
+# 16. 資料庫連線層 (get_conn)
+# ══════════════════════════════════════════
+
+class TestDbConnection:
+
+    def test_same_thread_reuses_connection(self):
+        assert app.get_conn() is app.get_conn()
+
+    def test_reopen_on_db_path_change(self, tmp_path):
+        first = app.get_conn()
+        app.DB_PATH = str(tmp_path / "other.db")
+        second = app.get_conn()
+        assert first is not second
+
+    def test_wal_mode(self):
+        mode = app.get_conn().execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode.lower() == "wal"
+
+    def test_other_thread_gets_own_connection(self):
+        import threading
+        main_conn = app.get_conn()
+        seen = []
+        t = threading.Thread(target=lambda: (seen.append(app.get_conn()), app.close_conn()))
+        t.start()
+        t.join()
+        assert seen and seen[0] is not main_conn
+
+    def test_order_message_opens_no_new_connection(self):
+        open_buy()
+        app.get_conn()
+        before = app.db_stats["connects"]
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_list(GID)
+        assert app.db_stats["connects"] == before
+
+
+# ══════════════════════════════════════════
+# 17. 資料庫遷移 (run_migrations)
+# ══════════════════════════════════════════
+
+class TestMigrations:
+
+    def test_fresh_db_at_latest_version(self):
+        assert app.get_schema_version(app.get_conn()) == app.SCHEMA_VERSION
+
+    def test_init_db_idempotent(self):
+        app.init_db()
+        app.init_db()
+        assert app.get_schema_version(app.get_conn()) == app.SCHEMA_VERSION
+
+    def test_legacy_db_upgrade(self, tmp_path):
+        """舊版 DB（無 buy_num / items.max_quantity）→ 補欄位並複製限量"""
+        db_file = str(tmp_path / "legacy.db")
+        conn = sqlite3.connect(db_file)
+        conn.executescript("""
+            CREATE TABLE group_buys (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id TEXT NOT NULL,
+                title TEXT NOT NULL, description TEXT, creator_id TEXT NOT NULL, creator_name TEXT,
+                status TEXT DEFAULT 'open', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, group_buy_id INTEGER NOT NULL,
+                item_num INTEGER NOT NULL, name TEXT NOT NULL, price_info TEXT);
+            CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, group_buy_id INTEGER NOT NULL,
+                item_num INTEGER NOT NULL, user_id TEXT NOT NULL, user_name TEXT,
+                quantity INTEGER DEFAULT 1, registered_by TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            INSERT INTO group_buys (group_id, title, creator_id) VALUES ('legacy', '舊團', 'u');
+            INSERT INTO items (group_buy_id, item_num, name) VALUES (1, 1, '水餃');
+        """)
+        conn.execute("ALTER TABLE group_buys ADD COLUMN max_quantity INTEGER")
+        conn.execute("UPDATE group_buys SET max_quantity=7")
+        conn.commit()
+        conn.close()
+
+        app.DB_PATH = db_file
+        app.init_db()
+        assert app.get_schema_version(app.get_conn()) == app.SCHEMA_VERSION
+        row = app.get_conn().execute("SELECT id, buy_num FROM group_buys").fetchone()
+        assert row[1] == 1  # buy_num 預設值
+        assert app.get_items(row[0])[0][5] == 7
+
+    def test_hot_queries_use_indexes(self):
+        c = app.get_conn().cursor()
+        plans = [
+            ('SELECT * FROM group_buys WHERE group_id=? AND status="open" ORDER BY buy_num', (GID,)),
+            ("SELECT name FROM items WHERE group_buy_id=? AND item_num=?", (1, 1)),
+            ("SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE group_buy_id=? AND item_num=?", (1, 1)),
+        ]
+        for sql, args in plans:
+            detail = c.execute(f"EXPLAIN QUERY PLAN {sql}", args).fetchall()[0][3]
+            assert "USING" in detail and "INDEX" in detail, detail
+
+
+# ══════════════════════════════════════════
+# 18. 併發下單不超賣 (reserve_order)
+# ══════════════════════════════════════════
+
+class _SlowCursor:
+    """讀寫 ordered_total（限量檢查）後停一下，放大「檢查 → 寫入」之間的競態視窗"""
+
+    delays = 0
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, *args):
+        result = self._cursor.execute(sql, *args)
+        if "ordered_total" in sql:
+            import time
+            _SlowCursor.delays += 1
+            time.sleep(0.002)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _SlowConn:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return _SlowCursor(self._conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class TestConcurrentOrders:
+
+    @pytest.fixture(autouse=True)
+    def slow_reads(self):
+        real_get_conn = app.get_conn
+        _SlowCursor.delays = 0
+        with patch.object(app, "get_conn", lambda: _SlowConn(real_get_conn())):
+            yield
+
+    def _hammer(self, n_threads, orders_per_thread, text_for):
+        import threading
+        results = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(n_threads)
+
+        def worker(idx):
+            try:
+                barrier.wait()
+                for j in range(orders_per_thread):
+                    r = app.cmd_order(GID, f"u{idx}", f"買家{idx}", text_for(idx, j))
+                    with lock:
+                        results.append(r)
+            finally:
+                app.close_conn()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 確認延遲真的落在下單路徑上，否則這組測試測不到競態
+        assert _SlowCursor.delays > 0
+        return results
+
+    def _item_total(self, item_num):
+        conn = sqlite3.connect(app.DB_PATH)
+        total = conn.execute(
+            "SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE item_num=?", (item_num,)
+        ).fetchone()[0]
+        conn.close()
+        return total
+
+    def test_limited_item_never_oversold(self):
+        """16 執行緒搶限量 5 份的品項1 → 剛好 5 份成功"""
+        app.cmd_open(GID, UID, UNAME, "#開團\n搶購\n1) 水餃 50元 限量5組\n2) 蛋餃 60元")
+        results = self._hammer(16, 3, lambda i, j: "+1")
+        assert self._item_total(1) == 5
+        assert sum(1 for r in results if r and r.startswith("✅")) == 5
+
+    def test_multi_unit_orders_never_oversold(self):
+        """每次 +2 份搶限量 7 份 → 總量不超過 7"""
+        app.cmd_open(GID, UID, UNAME, "#開團\n搶購\n1) 水餃 50元 限量7組\n2) 蛋餃 60元")
+        self._hammer(12, 4, lambda i, j: "+1 2" if j == 0 else "+1")
+        assert self._item_total(1) <= 7
+
+    def test_order_rejected_after_close(self):
+        open_buy()
+        buy = app.get_active_buys(GID)[0]
+        app.cmd_close(GID, UID)
+        result = app.cmd_order(GID, UID, UNAME, "+1 2", target_buy=buy)
+        assert "已結團" in result
+        assert self._item_total(1) == 0
+
+
+# ══════════════════════════════════════════
+# 19. 品項已訂數量彙總 (ordered_total)
+# ══════════════════════════════════════════
+
+class TestItemTotals:
+
+    def _stored_total(self, item_num):
+        buy_id = app.get_active_buys(GID)[0][0]
+        return app.get_conn().execute(
+            "SELECT ordered_total FROM items WHERE group_buy_id=? AND item_num=?", (buy_id, item_num)
+        ).fetchone()[0]
+
+    def test_total_tracks_add_update_cancel(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+1")
+        assert self._stored_total(1) == 3
+        app.cmd_order(GID, UID, UNAME, "+1 5")  # 明確數量 → 2 改為 5
+        assert self._stored_total(1) == 6
+        app.cmd_cancel_order(GID, UID2, UNAME2, "退出 1")
+        assert self._stored_total(1) == 5
+        assert app.check_item_totals() == []
+
+    def test_rejected_order_does_not_change_total(self):
+        open_buy_limited(limit=3)
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        result = app.cmd_order(GID, UID2, UNAME2, "+1 2")
+        assert "剩餘 1 份" in result
+        assert self._stored_total(1) == 2
+
+    def test_drift_detected_and_repaired(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        conn = app.get_conn()
+        conn.execute("UPDATE items SET ordered_total = 99 WHERE item_num = 1")
+        conn.commit()
+        drift = app.check_item_totals()
+        assert len(drift) == 1
+        assert drift[0][1:] == (1, 99, 2)
+        app.check_item_totals(repair=True)
+        assert app.check_item_totals() == []
+        assert self._stored_total(1) == 2
+
+    def test_backfill_on_migration(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+2 4")
+        conn = app.get_conn()
+        conn.execute("UPDATE items SET ordered_total = 0")
+        conn.execute("PRAGMA user_version = 3")
+        conn.commit()
+        app.init_db()
+        assert self._stored_total(2) == 4
+
+
+# ══════════════════════════════════════════
+# 20. 單一查詢解析品項 (resolve_item)
+# ══════════════════════════════════════════
+
+def count_queries(func, *args, **kwargs):
+    """執行 func 並回傳 (結果, 在目前連線上執行的 SQL 數)"""
+    statements = []
+    conn = app.get_conn()
+    conn.set_trace_callback(statements.append)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        conn.set_trace_callback(None)
+    return result, len(statements)
+
+
+class TestResolveItem:
+
+    def test_returns_item_name(self):
+        open_buy()
+        buy, name, err = app.resolve_item(GID, 2)
+        assert err is None
+        assert buy[8] == 1
+        assert name == "蛋餃 60元"
+
+    def test_ambiguous_lists_each_name(self):
+        open_buy()
+        app.cmd_open(GID, UID, UNAME, "#開團\n第二團\n1) 滷肉飯 80元")
+        buy, name, err = app.resolve_item(GID, 1)
+        assert buy is None and name is None
+        assert "團購1：水餃 50元" in err
+        assert "團購2：滷肉飯 80元" in err
+
+    def test_single_query(self):
+        open_buy()
+        app.cmd_open(GID, UID, UNAME, "#開團\n第二團\n4) 滷肉飯 80元")
+        app.cmd_open(GID, UID, UNAME, "#開團\n第三團\n7) 排骨飯 90元")
+        (buy, name, err), n = count_queries(app.resolve_item, GID, 4)
+        assert name == "滷肉飯 80元"
+        assert n == 1
+
+
+# ══════════════════════════════════════════
+# 21. 團購目錄快取 (catalog_cache)
+# ══════════════════════════════════════════
+
+class TestCatalogCache:
+
+    def test_repeated_reads_hit_cache(self):
+        open_buy()
+        app.get_active_buys(GID)
+        hits = app.catalog_cache.hits
+        buys, n = count_queries(app.get_active_buys, GID)
+        assert len(buys) == 1
+        assert app.catalog_cache.hits == hits + 1
+        assert n == 1  # 只查世代號
+
+    def test_items_served_from_cache(self):
+        open_buy()
+        buy_id = app.get_active_buys(GID)[0][0]
+        items, n = count_queries(app.get_items, buy_id)
+        assert len(items) == 3
+        assert n == 0
+        assert app.get_item_name(buy_id, 2) == "蛋餃 60元"
+
+    def test_parsed_tiers_and_limits(self):
+        app.cmd_open(GID, UID, UNAME, "#開團\n冰品\n1) 水餃 220元／2包420元 限量9組")
+        catalog = app.get_catalog(GID)
+        buy_id = catalog.buys[0][0]
+        assert catalog.tiers[buy_id][1] == ((1, 220), (2, 420))
+        assert catalog.limits[buy_id][1] == 9
+
+    def test_render_and_stats_use_cached_tiers(self):
+        """列表與統計直接使用目錄快取中的價格階梯，不重新解析"""
+        app.cmd_open(GID, UID, UNAME, "#開團\n冰品\n1) 水餃 220元／2包420元 限量9組")
+        app.cmd_order(GID, UID, UNAME, "+1 3")
+        buy_id = app.get_catalog(GID).buys[0][0]
+        with patch.object(app, "_price_tiers", side_effect=AssertionError("不應重新解析")):
+            assert "💰640元" in app.format_buy_list(buy_id)
+            assert app.compute_buy_stats(buy_id).amount == 640
+
+    def test_unlimited_items_skip_limit_queries(self):
+        """目錄快取知道品項不限量 → 進度與自動結團檢查不查 DB"""
+        open_buy()
+        buy_id = app.get_active_buys(GID)[0][0]
+        assert count_queries(app.check_item_progress, buy_id, 1) == (None, 0)
+        assert count_queries(app.check_auto_close, buy_id, GID) == (None, 0)
+
+    def test_invalidated_on_open_close_cancel(self):
+        open_buy()
+        assert len(app.get_active_buys(GID)) == 1
+        open_buy()
+        assert len(app.get_active_buys(GID)) == 2
+        app.cmd_close(GID, UID, buy_num=1)
+        assert [b[8] for b in app.get_active_buys(GID)] == [2]
+        app.cmd_cancel_buy(GID, UID, buy_num=2)
+        assert app.get_active_buys(GID) == []
+
+    def test_invalidated_on_auto_close(self):
+        open_buy_limited(limit=1)
+        app.get_active_buys(GID)
+        app.cmd_order(GID, UID, UNAME, "+1")
+        app.cmd_order(GID, UID, UNAME, "+2")
+        assert app.get_active_buys(GID) == []
+
+    def test_other_worker_change_detected(self):
+        """其他 worker 直接改 DB 並遞增世代號 → 本 worker 重新載入"""
+        open_buy()
+        app.get_active_buys(GID)
+        other = sqlite3.connect(app.DB_PATH)
+        other.execute("UPDATE group_buys SET status='closed'")
+        other.execute("UPDATE catalog_generations SET generation = generation + 1 WHERE group_id=?", (GID,))
+        other.commit()
+        other.close()
+        assert app.get_active_buys(GID) == []
+
+    def test_lru_eviction(self):
+        cache = app.CatalogCache(max_groups=2)
+        for gid in ("g1", "g2", "g3"):
+            open_buy(group_id=gid)
+            cache.get(gid)
+        assert cache.stats()["groups"] == 2
+        misses = cache.misses
+        cache.get("g1")  # 已被淘汰 → 重新載入
+        assert cache.misses == misses + 1
+
+
+# ══════════════════════════════════════════
+# 22. 價格階梯預先解析 (_price_tiers)
+# ══════════════════════════════════════════
+
+class TestPriceTierCache:
+
+    def test_same_text_parsed_once(self):
+        app._price_tiers.cache_clear()
+        for qty in range(1, 20):
+            app.calculate_amount("220元／2包420元", qty)
+        info = app._price_tiers.cache_info()
+        assert info.misses == 1
+        assert info.hits == 18
+
+    def test_amount_for_tiers_matches_calculate_amount(self):
+        for text in ("50元", "220元／2包420元", "一組2條150元", "3包100元 2包70元 40元"):
+            tiers = app._price_tiers(text)
+            for qty in range(1, 12):
+                assert app.amount_for_tiers(tiers, qty) == app.calculate_amount(text, qty)
+
+    def test_format_buy_list_parses_per_item(self):
+        open_buy()
+        for i in range(10):
+            app.cmd_order(GID, f"u{i}", f"買家{i}", "+1 2")
+        buy_id = app.get_active_buys(GID)[0][0]
+        app._price_tiers.cache_clear()
+        app.catalog_cache.clear()   # 沒有目錄快取時才自行解析
+        result = app.format_buy_list(buy_id)
+        assert "💰100元" in result
+        assert app._price_tiers.cache_info().misses == 3  # 3 個品項
+
+
+# ══════════════════════════════════════════
+# 23. 最低金額計價 (PriceTable)
+# ══════════════════════════════════════════
+
+def brute_force_amount(tiers, qty):
+    """窮舉所有包裝組合（零頭依原規則計價）"""
+    unit = next((p for q, p in tiers if q == 1), None)
+    small_qty, small_price = tiers[0]
+    best = None
+
+    def walk(idx, remaining, cost):
+        nonlocal best
+        if idx == len(tiers):
+            if unit is not None:
+                total = cost + remaining * unit
+            elif remaining < small_qty:
+                total = cost + int(remaining * small_price / small_qty)
+            else:
+                return
+            if best is None or total < best:
+                best = total
+            return
+        tier_qty, tier_price = tiers[idx]
+        for n in range(remaining // tier_qty + 1):
+            walk(idx + 1, remaining - n * tier_qty, cost + n * tier_price)
+
+    walk(0, qty, 0)
+    return best
+
+
+class TestPriceTable:
+
+    def test_greedy_counterexample(self):
+        """單價100、2包150、3包240，買4份：貪心 240+100=340，最佳 150×2=300"""
+        text = "100元 2包150元 3包240元"
+        assert app.calculate_amount(text, 4) == 300
+        assert app.calculate_amount(text, 6) == 450
+
+    def test_existing_tier_results_unchanged(self):
+        assert app.calculate_amount("220元／2包420元", 2) == 420
+        assert app.calculate_amount("220元／2包420元", 3) == 640
+        assert app.calculate_amount("50元", 3) == 150
+
+    def test_no_unit_price(self):
+        """只有「2包150元」→ 零頭用平均價"""
+        assert app.calculate_amount("2包150元", 1) == 75
+        assert app.calculate_amount("2包150元", 3) == 225
+
+    def test_matches_brute_force(self):
+        import random
+        rnd = random.Random(0)
+        units = "包份組盒袋"
+        for _ in range(150):
+            parts = []
+            if rnd.random() < 0.7:
+                parts.append(f"{rnd.randrange(20, 300)}元")
+            for qty in rnd.sample(range(2, 7), rnd.randrange(1, 4)):
+                parts.append(f"{qty}{rnd.choice(units)}{rnd.randrange(30, 1500)}元")
+            text = " ".join(parts)
+            tiers = app.extract_price_tiers(text)
+            if not tiers:
+                continue
+            for qty in range(0, 16):
+                assert app.calculate_amount(text, qty) == brute_force_amount(tiers, qty), (text, qty)
+
+    def test_table_shared_per_tier_signature(self):
+        app._price_table.cache_clear()
+        app.calculate_amount("水餃 220元／2包420元", 5)
+        app.calculate_amount("餃子 220元 2包420元", 3)
+        info = app._price_table.cache_info()
+        assert info.misses == 1 and info.hits == 1
+
+    def test_huge_quantity_falls_back(self):
+        qty = app.PRICE_TABLE_MAX_QTY + 1
+        assert app.calculate_amount("50元", qty) == 50 * qty
+
+
+# ══════════════════════════════════════════
+# 24. Webhook 背景處理 (event_queue)
+# ══════════════════════════════════════════
+
+def make_webhook_body(text, group_id=GID, user_id=UID, reply_token="tok"):
+    import json
+    return json.dumps({
+        "destination": "bot",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": 1700000000000,
+            "source": {"type": "group", "groupId": group_id, "userId": user_id},
+            "replyToken": reply_token,
+            "message": {"id": "1", "type": "text", "text": text},
+            "webhookEventId": "ev",
+            "deliveryContext": {"isRedelivery": False},
+        }],
+    }, ensure_ascii=False)
+
+
+def sign(body):
+    import base64
+    import hashlib
+    import hmac
+    digest = hmac.new(app.LINE_CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+class TestWebhookQueue:
+
+    def _post(self, body, signature=None):
+        client = app.app.test_client()
+        return client.post(
+            "/webhook",
+            data=body.encode(),
+            headers={"X-Line-Signature": signature if signature is not None else sign(body)},
+            content_type="application/json",
+        )
+
+    def test_returns_before_processing_then_replies(self):
+        open_buy()
+        with patch.object(app.line_bot_api, 'reply_message') as mock_reply, \
+             patch.object(app.line_bot_api, 'get_group_member_profile') as mock_profile:
+            mock_profile.return_value = MagicMock(display_name=UNAME)
+            resp = self._post(make_webhook_body("#1 2"))
+            assert resp.status_code == 200
+            assert app.event_queue.join(timeout=5)
+            assert mock_reply.called
+            assert "水餃" in mock_reply.call_args[0][1].text
+
+    def test_invalid_signature_rejected(self):
+        resp = self._post(make_webhook_body("#1 2"), signature="bad")
+        assert resp.status_code == 400
+
+    def test_backpressure_returns_503(self):
+        import threading
+        gate = threading.Event()
+        queue = app.EventQueue(workers=1, maxsize=2)
+        with patch.object(app, "event_queue", queue), \
+             patch.object(app, "WEBHOOK_ENQUEUE_TIMEOUT", 0.05), \
+             patch.object(app, "dispatch_event", lambda ev: gate.wait(5)):
+            assert queue.put_batch([("busy", lambda: gate.wait(5))])  # 佔住唯一的 worker
+            statuses = [self._post(make_webhook_body(f"#{i}")).status_code for i in range(4)]
+            stats = queue.stats()
+            gate.set()
+            assert queue.join(timeout=5)
+        assert 503 in statuses
+        assert stats["rejected"] >= 1
+        assert stats["depth"] <= 2
+
+    def test_failed_handler_counted(self):
+        queue = app.EventQueue(workers=1, maxsize=5)
+
+        def boom():
+            raise RuntimeError("boom")
+
+        assert queue.put_batch([("g", boom), ("g", lambda: None)])
+        assert queue.join(timeout=5)
+        stats = queue.stats()
+        assert stats["failed"] == 1
+        assert stats["processed"] == 1
+
+    def test_dispatch_uses_module_handlers(self):
+        """依 EVENT_HANDLERS 分派，不讀 SDK 內部的 handler._handlers"""
+        from linebot.models import JoinEvent, MessageEvent, StickerMessage, TextMessage
+        text_event = MessageEvent(message=TextMessage(id="1", text="列表"))
+        sticker_event = MessageEvent(message=StickerMessage(id="2", package_id="1", sticker_id="1"))
+        join_event = JoinEvent(reply_token="tok")
+        on_text, on_join = MagicMock(), MagicMock()
+        with patch.dict(app.EVENT_HANDLERS, {(MessageEvent, TextMessage): on_text, (JoinEvent, None): on_join}), \
+                patch.object(app, "handler", MagicMock(_handlers=None, _default=None)):
+            for event in (text_event, sticker_event, join_event):
+                app.dispatch_event(event)
+        on_text.assert_called_once_with(text_event)
+        on_join.assert_called_once_with(join_event)
+
+    def test_health_shows_queue_metrics(self):
+        resp = app.app.test_client().get("/")
+        assert resp.status_code == 200
+        assert "'queue'" in resp.get_data(as_text=True)
+        assert "'depth'" in resp.get_data(as_text=True)
+
+
+# ══════════════════════════════════════════
+# 25. 依群組循序處理 (event_lane)
+# ══════════════════════════════════════════
+
+class TestGroupLanes:
+
+    def test_interleaved_groups_keep_order_and_run_in_parallel(self):
+        import random
+        import threading
+        import time
+        rnd = random.Random(1)
+        queue = app.EventQueue(workers=6, maxsize=1000)
+        lock = threading.Lock()
+        seen = {}
+        running = {}
+        overlaps_same_group = []
+        max_parallel = [0]
+
+        def job(group, seq, delay):
+            def run():
+                with lock:
+                    running[group] = running.get(group, 0) + 1
+                    if running[group] > 1:
+                        overlaps_same_group.append(group)
+                    max_parallel[0] = max(max_parallel[0], sum(running.values()))
+                time.sleep(delay)
+                with lock:
+                    seen.setdefault(group, []).append(seq)
+                    running[group] -= 1
+            return run
+
+        groups = [f"g{i}" for i in range(12)]
+        counters = {g: 0 for g in groups}
+        batch = []
+        for _ in range(240):
+            g = rnd.choice(groups)
+            batch.append((g, job(g, counters[g], rnd.random() * 0.002)))
+            counters[g] += 1
+            if len(batch) == 5:
+                assert queue.put_batch(batch)
+                batch = []
+        assert queue.put_batch(batch)
+        assert queue.join(timeout=10)
+
+        for g in groups:
+            assert seen.get(g, []) == list(range(counters[g]))
+        assert overlaps_same_group == []
+        assert max_parallel[0] > 1
+
+    def test_webhook_replay_orders_per_group(self):
+        """多個群組的開團 / 下單事件交錯送入，同群組依序處理"""
+        import threading
+        groups = [f"grp{i}" for i in range(6)]
+        events = []
+        for g in groups:
+            events.append((g, "#開團\n團購\n1) 水餃 50元 限量4組\n2) 蛋餃 60元"))
+        for n in range(6):
+            for g in groups:
+                events.append((g, "+1 小明"))
+        for g in groups:
+            events.append((g, "列表"))
+
+        replies = {}
+        lock = threading.Lock()
+
+        def record(token, message):
+            g, seq = token.rsplit("-", 1)
+            with lock:
+                replies.setdefault(g, []).append((int(seq), message.text))
+
+        queue = app.EventQueue(workers=4, maxsize=500)
+        with patch.object(app, "event_queue", queue), \
+             patch.object(app.line_bot_api, "reply_message", side_effect=record), \
+             patch.object(app.line_bot_api, "get_group_member_profile",
+                          return_value=MagicMock(display_name=UNAME)):
+            for seq, (g, text) in enumerate(events):
+                body = make_webhook_body(text, group_id=g, reply_token=f"{g}-{seq}")
+                parsed = app.handler.parser.parse(body, sign(body))
+                assert app.submit_events(parsed)
+            assert queue.join(timeout=10)
+
+        for g in groups:
+            seqs = [s for s, _ in replies[g]]
+            assert seqs == sorted(seqs)
+            texts = [t for _, t in replies[g]]
+            assert "開團成功" in texts[0]
+            assert sum(1 for t in texts if t.startswith("✅")) == 4  # 限量 4 份
+            assert "共 4 份" in texts[-1]
+
+
+# ══════════════════════════════════════════
+# 26. 顯示名稱快取 (profile_cache)
+# ══════════════════════════════════════════
+
+class TestProfileCache:
+
+    def _event(self):
+        event = MagicMock()
+        event.source.type = "group"
+        return event
+
+    def test_repeated_lookups_hit_cache(self):
+        hits = app.profile_cache.stats()["hits"]
+        with patch.object(app.line_bot_api, 'get_group_member_profile') as mock_profile:
+            mock_profile.return_value = MagicMock(display_name=UNAME)
+            for _ in range(5):
+                assert app.get_user_name(self._event(), GID, UID) == UNAME
+            assert mock_profile.call_count == 1
+        assert app.profile_cache.stats()["hits"] == hits + 4
+
+    def test_keyed_by_group_and_user(self):
+        with patch.object(app.line_bot_api, 'get_group_member_profile') as mock_profile:
+            mock_profile.side_effect = lambda g, u: MagicMock(display_name=f"{g}:{u}")
+            assert app.get_user_name(self._event(), "g1", "u1") == "g1:u1"
+            assert app.get_user_name(self._event(), "g2", "u1") == "g2:u1"
+            assert mock_profile.call_count == 2
+
+    def test_failure_negative_cached(self):
+        with patch.object(app.line_bot_api, 'get_group_member_profile') as mock_profile:
+            mock_profile.side_effect = RuntimeError("LINE down")
+            assert app.get_user_name(self._event(), GID, UID) is None
+            assert app.get_user_name(self._event(), GID, UID) is None
+            assert mock_profile.call_count == 1
+
+    def test_ttl_expiry(self):
+        cache = app.TTLCache(maxsize=10, ttl=0.01)
+        calls = []
+        cache.get_or_load("k", lambda: calls.append(1) or "v")
+        import time
+        time.sleep(0.02)
+        cache.get_or_load("k", lambda: calls.append(1) or "v")
+        assert len(calls) == 2
+
+    def test_lru_bound(self):
+        cache = app.TTLCache(maxsize=2, ttl=60)
+        for k in ("a", "b", "c"):
+            cache.get_or_load(k, lambda k=k: k)
+        assert cache.stats()["size"] == 2
+        calls = []
+        cache.get_or_load("a", lambda: calls.append(1) or "a")
+        assert calls == [1]
+
+    def test_single_flight(self):
+        import threading
+        cache = app.TTLCache(maxsize=10, ttl=60)
+        gate = threading.Event()
+        calls = []
+
+        def slow_loader():
+            calls.append(1)
+            gate.wait(5)
+            return "name"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("k", slow_loader)))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        import time
+        deadline = time.time() + 5
+        while cache.coalesced < 7 and time.time() < deadline:
+            time.sleep(0.001)
+        gate.set()
+        for t in threads:
+            t.join()
+        assert calls == [1]
+        assert results == ["name"] * 8
+        assert cache.stats()["coalesced"] == 7
+
+
+# ══════════════════════════════════════════
+# 27. 指令路由 (parse_command)
+# ══════════════════════════════════════════
+
+class TestCommandRouter:
+
+    @pytest.mark.parametrize("text,expected", [
+        ("#1", ("item_prompt", (1,))),
+        ("2.", ("item_prompt", (2,))),
+        ("#1 2", ("order", ("+1 2",))),
+        ("#1+2", ("order", ("+1 2",))),
+        ("3． 小華", ("order", ("+3 小華",))),
+        ("#1 #3 小美", ("order_multi", ("+1 +3 小美",))),
+        ("退出 2 小明", ("cancel", ("退出 2 小明",))),
+        ("列表", ("list", (None, None))),
+        ("列表 2", ("list", (2, None))),
+        ("列表 2 頁3", ("list", (2, 3))),
+        ("列表頁2", ("list", (None, 2))),
+        ("我的單", ("my_orders", ())),
+        ("我的訂單 全部", ("my_orders_all", ())),
+        ("結團 1", ("close", (1,))),
+        ("取消團購2", ("cancel_buy", (2,))),
+        ("AI統計 1", ("stats", (1,))),
+        ("說明", ("help", ())),
+        ("水餃×2、蛋餃×3", ("batch", ("水餃×2、蛋餃×3",))),
+        ("蛋餃2", ("batch", ("蛋餃2",))),
+    ])
+    def test_routes(self, text, expected):
+        cmd = app.parse_command(text)
+        assert (cmd.name, cmd.args) == expected
+
+    @pytest.mark.parametrize("text", [
+        "好喔", "今天幾點取貨？", "+1的人記得匯款喔", "列表好長", "👍", "開團囉",
+    ])
+    def test_chit_chat_not_routed(self, text):
+        assert app.parse_command(text) is None
+
+    def test_open_requires_newline(self):
+        assert app.parse_command("#開團\n水餃團\n1) 水餃 50元").name == "open"
+        assert app.parse_command("#開團") is None
+
+    def test_every_route_has_action(self):
+        for text in ("#1", "#1 2", "#1 #2", "退出 1", "列表", "我的訂單", "結團",
+                     "取消團購", "統計", "說明", "水餃×2", "#開團\n團\n1) a 1元"):
+            assert app.parse_command(text).name in app.COMMAND_ACTIONS
+
+
+# ══════════════════════════════════════════
+# 28. 批次下單品項比對索引 (ItemMatcher)
+# ══════════════════════════════════════════
+
+def linear_match(entries, search):
+    """舊版 find_match：逐一子字串比對"""
+    for buy, item in entries:
+        if search in item[3] or search in (item[4] or ""):
+            return (buy, item)
+    return None
+
+
+class TestItemMatcher:
+
+    def _entries(self):
+        open_buy()
+        open_buy(text="#開團\n冷凍團\n1) 鮮蝦水餃 90元\n2) 韭菜蛋餃（20顆）120元\n3) 魚丸 2包150元")
+        return app.get_catalog(GID).matcher.entries
+
+    def test_matches_linear_scan(self):
+        entries = self._entries()
+        matcher = app.ItemMatcher(entries)
+        searches = ["", "水", "水餃", "蛋餃", "鮮蝦", "20顆", "韭菜蛋", "2包", "魚", "元",
+                    "不存在", "餃子", "蝦水餃", "150元", "x"]
+        for search in searches:
+            assert matcher.find(search) == linear_match(entries, search), search
+
+    def test_first_match_in_buy_order(self):
+        entries = self._entries()
+        buy, item = app.ItemMatcher(entries).find("水餃")
+        assert buy[8] == 1 and item[2] == 1
+
+    def test_cached_with_catalog(self):
+        open_buy()
+        matcher = app.get_catalog(GID).matcher
+        assert app.get_catalog(GID).matcher is matcher
+        open_buy(text="#開團\n第二團\n1) 湯圓 80元")
+        assert app.get_catalog(GID).matcher is not matcher
+        assert app.get_catalog(GID).matcher.find("湯圓")[0][8] == 2
+
+    def test_batch_order_uses_index(self):
+        open_buy(text="#開團\n冷凍團\n1) 鮮蝦水餃 90元\n2) 韭菜蛋餃 120元")
+        result = app.cmd_batch_order(GID, UID, UNAME, "小明 蛋餃×2")
+        assert "韭菜蛋餃" in result and "小明" in result
+
+
+# ══════════════════════════════════════════
+# 29. 批次下單引擎 (apply_order_lines)
+# ══════════════════════════════════════════
+
+def trace_statements(func, *args, **kwargs):
+    """執行 func 並回傳 (結果, 在目前連線上執行的 SQL list)"""
+    statements = []
+    conn = app.get_conn()
+    conn.set_trace_callback(statements.append)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        conn.set_trace_callback(None)
+    return result, statements
+
+
+def order_rows():
+    conn = app.get_conn()
+    return conn.execute("SELECT item_num, user_name, quantity FROM orders ORDER BY item_num").fetchall()
+
+
+class TestBatchOrderEngine:
+
+    def test_single_transaction(self):
+        open_buy()
+        result, statements = trace_statements(app.cmd_order_multi, GID, UID, UNAME, "+1 +2 +3")
+        assert result.count("✅") == 3
+        assert sum(s.startswith("BEGIN") for s in statements) == 1
+
+    def test_batch_single_transaction(self):
+        open_buy()
+        result, statements = trace_statements(app.cmd_batch_order, GID, UID, UNAME, "水餃×2、蛋餃×3、魚餃×1")
+        assert result.count("✅") == 3
+        assert sum(s.startswith("BEGIN") for s in statements) == 1
+
+    def test_partial_mode_applies_valid_entries(self):
+        open_buy_limited(limit=3)
+        with patch.object(app, "BATCH_ORDER_MODE", "partial"):
+            result = app.cmd_batch_order(GID, UID, UNAME, "水餃×2、蛋餃×5")
+        assert result.count("✅") == 1
+        assert "剩餘 3 份" in result
+        assert order_rows() == [(1, UNAME, 2)]
+
+    def test_all_mode_rolls_back(self):
+        open_buy_limited(limit=3)
+        with patch.object(app, "BATCH_ORDER_MODE", "all"):
+            result = app.cmd_batch_order(GID, UID, UNAME, "水餃×2、蛋餃×5")
+        assert "✅" not in result
+        assert "全部沒有下單" in result
+        assert order_rows() == []
+        items = app.get_conn().execute("SELECT ordered_total FROM items").fetchall()
+        assert items == [(0,), (0,)]
+
+    def test_all_mode_unknown_item(self):
+        open_buy()
+        result = app.cmd_batch_order(GID, UID, UNAME, "水餃×2、滷肉飯×1")
+        assert "找不到品項「滷肉飯」" in result and result.count("✅") == 1
+        with patch.object(app, "BATCH_ORDER_MODE", "all"):
+            app.cmd_batch_order(GID, UID2, UNAME2, "蛋餃×2、滷肉飯×1")
+        assert [r[1] for r in order_rows()] == [UNAME]
+
+    def test_quota_sees_earlier_lines(self):
+        open_buy_limited(limit=3)
+        result = app.cmd_order_multi(GID, UID, UNAME, "+1 +1 +1 +1")
+        assert result.count("✅") == 3
+        assert "已額滿" in result
+        assert order_rows() == [(1, UNAME, 3)]
+
+    def test_progress_once_per_item(self):
+        open_buy_limited(limit=5)
+        result = app.cmd_order_multi(GID, UID, UNAME, "+1 +1 +2")
+        assert result.count("📊 【1】") == 1
+        assert result.count("📊 【2】") == 1
+
+    def test_multi_ambiguous_item_reported(self):
+        open_buy()
+        app.cmd_open(GID, UID, UNAME, "#開團\n第二團\n1) 滷肉飯 80元\n2) 排骨飯 90元\n3) 雞腿飯 100元\n4) 魚排飯 110元")
+        result = app.cmd_order_multi(GID, UID, UNAME, "+1 +4")
+        assert "多個團購都有品項【1】" in result
+        assert "✅ [團購2]" in result and "魚排飯" in result
+
+    def test_auto_close_once(self):
+        open_buy_limited(limit=2)
+        result = app.cmd_order_multi(GID, UID, UNAME, "+1 +2 2")
+        assert result.count("✅") == 2
+        assert result.count("自動結團") == 1
+        assert app.get_active_buys(GID) == []
+
+
+# ══════════════════════════════════════════
+# 30. NLU prompt 組合 (build_nlu_context)
+# ══════════════════════════════════════════
+
+def open_big_buy(n_items=60):
+    lines = ["#開團", "大團"]
+    for i in range(1, n_items + 1):
+        lines.append(f"{i}) 冷凍品項{i}號（每包500克，宅配到府）{100 + i}元")
+    lines.append(f"{n_items + 1}) 韭菜鮮肉水餃 150元")
+    return app.cmd_open(GID, UID, UNAME, "\n".join(lines))
+
+
+def claude_reply(text):
+    client = MagicMock()
+    client.messages.create.return_value = MagicMock(content=[MagicMock(text=text)])
+    return client
+
+
+class TestNluContext:
+
+    def _catalog(self):
+        catalog = app.get_catalog(GID)
+        return catalog.buys, [it for b in catalog.buys for it in catalog.items[b[0]]]
+
+    def test_only_caller_orders(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+2 3")
+        buys, items = self._catalog()
+        assert app.get_user_orders([buys[0][0]], UNAME) == [(1, 2)]
+        prompt, _ = app.build_nlu_context(buys, items, UNAME, "我要再加一包")
+        assert "目前已下單：品項1 x2" in prompt
+        assert "品項2 x3" not in prompt
+
+    def test_budget_trims_to_relevant_items(self):
+        open_big_buy()
+        buys, items = self._catalog()
+        prompt, kept = app.build_nlu_context(buys, items, UNAME, "我要水餃兩包", budget=600)
+        assert kept < len(items)
+        assert "韭菜鮮肉水餃" in prompt
+        assert app.estimate_tokens(prompt) <= 600
+
+    def test_full_list_within_budget(self):
+        open_buy()
+        buys, items = self._catalog()
+        prompt, kept = app.build_nlu_context(buys, items, UNAME, "我也要")
+        assert kept == 3
+        assert prompt.index("1. 水餃") < prompt.index("2. 蛋餃") < prompt.index("3. 魚餃")
+
+    def test_ordered_and_mentioned_items_pinned(self):
+        open_big_buy()
+        app.cmd_order(GID, UID, UNAME, "+7 1")
+        buys, items = self._catalog()
+        prompt, _ = app.build_nlu_context(buys, items, UNAME, "第42個不要了", budget=500)
+        assert "冷凍品項7號" in prompt
+        assert "冷凍品項42號" in prompt
+
+    def test_nlu_order_logs_prompt_size(self, caplog):
+        open_big_buy()
+        client = claude_reply('{"action": "order", "item_num": 61, "quantity": 2, "for_name": null}')
+        with patch.object(app, "claude_client", client), caplog.at_level(logging.INFO, logger=app.logger.name):
+            result = app.cmd_nlu_order(GID, UID, UNAME, "水餃還有嗎？我要兩包")
+        assert "韭菜鮮肉水餃" in result and "+2份" in result
+        prompt = client.messages.create.call_args.kwargs["messages"][0]["content"]
+        assert app.estimate_tokens(prompt) <= app.NLU_PROMPT_TOKEN_BUDGET
+        assert any("[nlu] prompt" in r.getMessage() for r in caplog.records)
+
+
+# ══════════════════════════════════════════
+# 31. NLU 結果快取 (nlu_cache)
+# ══════════════════════════════════════════
+
+class TestNluCache:
+
+    ORDER_1 = '{"action": "order", "item_num": 1, "quantity": 1, "for_name": null}'
+
+    def test_same_message_from_same_user_is_hit(self):
+        open_buy()
+        client = claude_reply('{"action": "ignore"}')
+        with patch.object(app, "claude_client", client):
+            app.cmd_nlu_order(GID, UID, UNAME, "水餃好吃嗎")
+            app.cmd_nlu_order(GID, UID, UNAME, "  水餃好吃嗎～～ ")
+        assert client.messages.create.call_count == 1
+        stats = app.nlu_cache.stats()
+        assert stats["hits"] == 1 and stats["saved"] == 1
+
+    def test_sender_in_key(self):
+        """「小明那份」由小明說是本人下單、由別人說是代訂，結果不能跨用戶共用"""
+        open_buy()
+        client = claude_reply(f'{{"action": "order", "item_num": 1, "quantity": 2, "for_name": "{UNAME2}"}}')
+        with patch.object(app, "claude_client", client):
+            app.cmd_nlu_order(GID, UID2, UNAME2, f"{UNAME2}那份水餃兩盒喔")
+            app.cmd_nlu_order(GID, UID, UNAME, f"{UNAME2}那份水餃兩盒喔")
+        assert client.messages.create.call_count == 2
+        # 第二次是代小明訂，不會變成測試者本人的訂單
+        assert order_rows() == [(1, UNAME2, 2)]
+
+    def test_claude_sees_original_text(self):
+        open_buy()
+        client = claude_reply('{"action": "ignore"}')
+        with patch.object(app, "claude_client", client):
+            app.cmd_nlu_order(GID, UID, UNAME, "OK 水餃ＸＬ～～好吃嗎")
+        prompt = client.messages.create.call_args.kwargs["messages"][0]["content"]
+        assert "OK 水餃" in prompt
+
+    def test_user_order_state_in_key(self):
+        open_buy()
+        client = claude_reply(self.ORDER_1)
+        with patch.object(app, "claude_client", client):
+            app.cmd_nlu_order(GID, UID, UNAME, "我也要")
+            app.cmd_nlu_order(GID, UID, UNAME, "我也要")
+        assert client.messages.create.call_count == 2
+
+    def test_catalog_change_invalidates(self):
+        open_buy()
+        client = claude_reply('{"action": "ignore"}')
+        with patch.object(app, "claude_client", client):
+            app.cmd_nlu_order(GID, UID, UNAME, "水餃好吃嗎")
+            app.cmd_nlu_order(GID, UID, UNAME, "水餃好吃嗎")
+            open_buy(text="#開團\n第二團\n1) 湯圓 80元")
+            app.cmd_nlu_order(GID, UID, UNAME, "水餃好吃嗎")
+        assert client.messages.create.call_count == 2
+
+    def test_failures_not_cached(self):
+        open_buy()
+        client = claude_reply("not json")
+        with patch.object(app, "claude_client", client):
+            assert app.cmd_nlu_order(GID, UID, UNAME, "我也要") is None
+            assert app.cmd_nlu_order(GID, UID, UNAME, "我也要") is None
+        assert client.messages.create.call_count == 2
+
+    def test_own_name_normalized(self):
+        open_buy()
+        client = claude_reply(f'{{"action": "order", "item_num": 1, "quantity": 1, "for_name": "{UNAME}"}}')
+        with patch.object(app, "claude_client", client):
+            result = app.cmd_nlu_order(GID, UID, UNAME, "我也要")
+        assert "代訂" not in result
+        assert order_rows() == [(1, UNAME, 1)]
+
+    def test_normalize_nlu_text(self):
+        assert app.normalize_nlu_text("  我也要  水餃～～ ") == "我也要 水餃"
+        assert app.normalize_nlu_text("OK!") == "ok"
+        assert app.normalize_nlu_text("...") == "..."
+
+
+# ══════════════════════════════════════════
+# 32. 本地意圖判斷 (classify_intent)
+# ══════════════════════════════════════════
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_intent_fixtures():
+    with open(os.path.join(FIXTURES, "intent_catalog.txt"), encoding="utf-8") as f:
+        _, items = app.parse_group_buy(f.read())
+    rows = [(i, 1, num, name, info, None) for i, (num, name, info) in enumerate(items, 1)]
+    with open(os.path.join(FIXTURES, "intent_corpus.jsonl"), encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    return rows, cases
+
+
+class TestIntentClassifier:
+
+    def test_corpus_no_wrong_local_decisions(self):
+        items, cases = load_intent_fixtures()
+        decided = 0
+        for case in cases:
+            orders = [tuple(o) for o in case.get("user_orders", [])]
+            kind, intent = app.classify_intent(case["text"], items, orders)
+            if kind == "claude":
+                continue
+            decided += 1
+            if kind == "ignore":
+                assert case["intent"] == "ignore", case["text"]
+                continue
+            assert intent["action"] == case["intent"], case["text"]
+            for key in ("item_num", "quantity", "for_name"):
+                if key in case:
+                    assert intent[key] == case[key], (case["text"], key)
+        assert decided / len(cases) >= 0.25
+
+    def test_hard_negatives_never_local(self):
+        """提到品名的閒聊（「蛋餃來了」「蛋餃不要太鹹」）不能在本地寫入訂單"""
+        items, cases = load_intent_fixtures()
+        negatives = [case for case in cases if case.get("hard_negative")]
+        assert len(negatives) >= 10
+        for case in negatives:
+            kind, _ = app.classify_intent(case["text"], items, [(3, 1)])
+            assert kind != "local", case["text"]
+
+    def test_hard_negatives_reach_claude_end_to_end(self):
+        open_buy()
+        client = claude_reply('{"action": "ignore"}')
+        with patch.object(app, "claude_client", client):
+            for text in ("蛋餃來了", "誰要蛋餃", "要不要買水餃", "蛋餃不要太鹹", "我老公說他不要蛋餃"):
+                assert app.cmd_nlu_order(GID, UID, UNAME, text) is None
+        assert client.messages.create.call_count == 5
+        assert order_rows() == []
+
+    @pytest.mark.parametrize("text,expected", [
+        ("兩", 2), ("十", 10), ("十二", 12), ("二十", 20), ("三十五", 35), ("12", 12), ("十十", None),
+    ])
+    def test_parse_cn_number(self, text, expected):
+        assert app.parse_cn_number(text) == expected
+
+    def test_item_core_name(self):
+        assert app.item_core_name("韭菜鮮肉水餃（50顆）280元") == "韭菜鮮肉水餃"
+        assert app.item_core_name("🔥麻油猴頭菇 220元") == "麻油猴頭菇"
+
+    def test_local_order_skips_claude(self):
+        open_buy()
+        client = claude_reply('{"action": "ignore"}')
+        with patch.object(app, "claude_client", client):
+            result = app.cmd_nlu_order(GID, UID, UNAME, "我訂蛋餃兩包")
+        assert client.messages.create.call_count == 0
+        assert "蛋餃" in result and "2 份" in result
+        assert result.startswith("💬 依訊息判斷") and "AI" not in result
+        assert app.nlu_stats["local"] >= 1
+
+    def test_chit_chat_dropped(self):
+        open_buy()
+        client = claude_reply('{"action": "ignore"}')
+        with patch.object(app, "claude_client", client):
+            assert app.cmd_nlu_order(GID, UID, UNAME, "我要去上班了") is None
+        assert client.messages.create.call_count == 0
+
+    def test_ambiguous_goes_to_claude(self):
+        open_buy()
+        client = claude_reply('{"action": "clarify", "message": "請問是哪一個？"}')
+        with patch.object(app, "claude_client", client):
+            result = app.cmd_nlu_order(GID, UID, UNAME, "餃子我要一包")
+        assert client.messages.create.call_count == 1
+        assert result.startswith("🤔")
+
+
+# ══════════════════════════════════════════
+# 33. 多團購 AI 點評並行 (cmd_ai_summary)
+# ══════════════════════════════════════════
+
+class TestParallelSummary:
+
+    def _three_buys(self):
+        for n in range(3):
+            open_buy(text=f"#開團\n第{n + 1}團\n1) 水餃 50元\n2) 蛋餃 60元")
+            app.cmd_order(GID, UID, UNAME, "+1 2", target_buy=app.get_active_buy(GID, n + 1))
+
+    def test_calls_run_concurrently(self):
+        import time
+        self._three_buys()
+
+        def slow_claude(prompt, timeout=None):
+            time.sleep(0.2)
+            return "點評"
+
+        with patch.object(app, "claude_client", MagicMock()), patch.object(app, "call_claude", slow_claude):
+            t0 = time.monotonic()
+            result = app.cmd_ai_summary(GID)
+            elapsed = time.monotonic() - t0
+        assert result.count("🤖 AI 點評") == 3
+        assert result.index("[團購1]") < result.index("[團購2]") < result.index("[團購3]")
+        assert elapsed < 0.5
+
+    def test_timeout_keeps_local_report(self):
+        import time
+        self._three_buys()
+
+        def claude(prompt, timeout=None):
+            if "第2團" in prompt:
+                time.sleep(0.5)
+            return "點評"
+
+        with patch.object(app, "claude_client", MagicMock()), patch.object(app, "call_claude", claude), \
+                patch.object(app, "AI_SUMMARY_TIMEOUT", 0.1):
+            result = app.cmd_ai_summary(GID)
+        assert result.count("🤖 AI 點評") == 2
+        assert result.count("訂單統計") == 3
+
+    def test_failure_keeps_local_report(self):
+        self._three_buys()
+        with patch.object(app, "claude_client", MagicMock()), patch.object(app, "call_claude", return_value=None):
+            result = app.cmd_ai_summary(GID)
+        assert "🤖" not in result
+        assert all(f"第{n}團 訂單統計" in result for n in (1, 2, 3))
+
+    def test_prompt_built_without_per_order_lookups(self):
+        open_buy()
+        for name in ("甲", "乙", "丙"):
+            app.cmd_order(GID, UID, UNAME, f"+1 {name} 1")
+        prompts = []
+        with patch.object(app, "claude_client", MagicMock()), \
+                patch.object(app, "call_claude", lambda p, timeout=None: prompts.append(p) or "ok"), \
+                patch.object(app, "get_item_name", side_effect=AssertionError("per-order lookup")):
+            app.cmd_ai_summary(GID)
+        assert "👤 甲：【1】x1　💰50元" in prompts[0]
+
+
+# ══════════════════════════════════════════
+# 34. 本地訂單統計 (compute_buy_stats)
+# ══════════════════════════════════════════
+
+class TestLocalStats:
+
+    def _orders(self):
+        open_buy(text="#開團\n今日美食\n1) 水餃 50元／3包140元\n2) 蛋餃 60元\n3) 魚餃 70元")
+        app.cmd_order(GID, UID, UNAME, "+1 3")
+        app.cmd_order(GID, UID, UNAME, "+2 1")
+        app.cmd_order(GID, UID2, UNAME2, "+1 1")
+        app.cmd_order(GID, UID, UNAME, "+1 阿姨 2")
+
+    def test_totals_match_price_tiers(self):
+        self._orders()
+        stats = app.compute_buy_stats(app.get_active_buys(GID)[0][0])
+        by_item = {it.item_num: it for it in stats.items}
+        assert by_item[1] == (1, "水餃 50元／3包140元", 6, 140 + 50 + 100, 3)
+        assert by_item[2].quantity == 1 and by_item[2].amount == 60
+        assert by_item[3].quantity == 0
+        people = {p.name: p for p in stats.people}
+        assert people[UNAME].lines == [(1, 3, 140), (2, 1, 60)]
+        assert people[UNAME].amount == 200
+        assert [p.name for p in stats.people] == [UNAME, UNAME2, "阿姨"]
+        assert stats.quantity == 7
+        assert stats.amount == sum(p.amount for p in stats.people) == 350
+
+    def test_matches_format_buy_list_total(self):
+        self._orders()
+        bid = app.get_active_buys(GID)[0][0]
+        assert f"總金額：{app.compute_buy_stats(bid).amount} 元" in app.format_buy_list(bid)
+
+    def test_summary_without_ai(self):
+        self._orders()
+        with patch.object(app, "claude_client", None):
+            result = app.cmd_ai_summary(GID)
+        assert "訂單統計" in result and "總金額：350 元" in result
+        assert "🤖" not in result
+
+    def test_commentary_can_be_disabled(self):
+        self._orders()
+        with patch.object(app, "claude_client", MagicMock()), patch.object(app, "AI_SUMMARY_COMMENTARY", False), \
+                patch.object(app, "call_claude", side_effect=AssertionError("AI called")):
+            assert "總金額：350 元" in app.cmd_ai_summary(GID)
+
+    def test_close_uses_local_report(self):
+        self._orders()
+        with patch.object(app, "claude_client", MagicMock()), patch.object(app, "schedule_report_job"), \
+                patch.object(app, "call_claude", side_effect=AssertionError("AI called")):
+            result = app.cmd_close(GID, UID)
+        assert "🔒 團購已結團" in result
+        assert "訂單統計" in result and "總金額：350 元" in result
+
+
+# ══════════════════════════════════════════
+# 35. 結團 AI 點評背景工作 (report_jobs)
+# ══════════════════════════════════════════
+
+def report_job(job_id):
+    return app.get_conn().execute(
+        "SELECT status, attempts, last_error FROM report_jobs WHERE id=?", (job_id,)
+    ).fetchone()
+
+
+class TestReportJobs:
+
+    def _close_with_job(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        with patch.object(app, "claude_client", MagicMock()), \
+                patch.object(app, "schedule_report_job") as schedule:
+            result = app.cmd_close(GID, UID)
+        assert schedule.call_count == 1
+        return result, schedule.call_args.args[0]
+
+    def test_close_is_immediate_and_persists_job(self):
+        result, job_id = self._close_with_job()
+        assert "🔒 團購已結團" in result and "AI 點評產生中" in result
+        assert report_job(job_id) == ("pending", 0, None)
+        assert app.get_active_buys(GID) == []
+
+    def test_no_job_without_ai(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        with patch.object(app, "schedule_report_job") as schedule:
+            app.cmd_close(GID, UID)
+        assert schedule.call_count == 0
+        assert app.get_conn().execute("SELECT COUNT(*) FROM report_jobs").fetchone()[0] == 0
+
+    def test_no_job_for_empty_buy(self):
+        """沒有訂單的團購結團 → 不建立點評工作（否則會留下永遠 pending 的工作）"""
+        open_buy()
+        with patch.object(app, "claude_client", MagicMock()), \
+                patch.object(app, "schedule_report_job") as schedule:
+            result = app.cmd_close(GID, UID)
+        assert "🔒 團購已結團" in result and "AI 點評" not in result
+        assert schedule.call_count == 0
+        assert app.get_conn().execute("SELECT COUNT(*) FROM report_jobs").fetchone()[0] == 0
+
+    def test_orders_rejected_after_close(self):
+        open_buy()
+        buy = app.get_active_buys(GID)[0]
+        app.cmd_close(GID, UID)
+        assert "已結團" in app.cmd_order(GID, UID, UNAME, "+1 2", target_buy=buy)
+
+    def test_job_pushes_commentary(self):
+        _, job_id = self._close_with_job()
+        with patch.object(app, "call_claude", return_value="水餃最熱門"), \
+                patch.object(app.line_bot_api, "push_message") as push:
+            app.run_report_job(job_id)
+        to, message = push.call_args.args
+        assert to == GID and "水餃最熱門" in message.text
+        assert report_job(job_id) == ("done", 1, None)
+
+    def test_job_runs_once(self):
+        _, job_id = self._close_with_job()
+        with patch.object(app, "call_claude", return_value="ok"), \
+                patch.object(app.line_bot_api, "push_message") as push:
+            app.run_report_job(job_id)
+            app.run_report_job(job_id)
+        assert push.call_count == 1
+
+    def test_failure_retries_then_gives_up(self):
+        _, job_id = self._close_with_job()
+        with patch.object(app, "call_claude", return_value="ok"), \
+                patch.object(app.line_bot_api, "push_message", side_effect=RuntimeError("LINE down")), \
+                patch.object(app, "schedule_report_job") as schedule:
+            app.run_report_job(job_id)
+            assert report_job(job_id) == ("pending", 1, "LINE down")
+            assert schedule.call_args.args == (job_id, app.REPORT_JOB_RETRY_DELAY)
+            for _ in range(app.REPORT_JOB_MAX_ATTEMPTS - 1):
+                app.run_report_job(job_id)
+        assert report_job(job_id) == ("failed", app.REPORT_JOB_MAX_ATTEMPTS, "LINE down")
+        assert schedule.call_count == app.REPORT_JOB_MAX_ATTEMPTS - 1
+
+    def test_resume_on_startup(self):
+        _, job_id = self._close_with_job()
+        _, stale_id = self._close_with_job()
+        app.get_conn().execute("UPDATE report_jobs SET status='running', updated_at=0 WHERE id=?", (stale_id,))
+        app.get_conn().commit()
+        with patch.object(app, "schedule_report_job") as schedule:
+            assert app.resume_report_jobs() == 2
+        assert sorted(call.args[0] for call in schedule.call_args_list) == [job_id, stale_id]
+
+    def test_resume_waits_for_next_attempt(self):
+        """重試時間未到的工作留給下一輪巡查"""
+        _, due_id = self._close_with_job()
+        _, later_id = self._close_with_job()
+        app.get_conn().execute(
+            "UPDATE report_jobs SET next_attempt_at=? WHERE id=?", (app.time.time() + 600, later_id)
+        )
+        app.get_conn().commit()
+        with patch.object(app, "schedule_report_job") as schedule:
+            assert app.resume_report_jobs() == 1
+        assert schedule.call_args.args == (due_id,)
+
+    def test_sweeper_starts_once_per_process(self):
+        """post_fork 在每個 worker 呼叫；同一個 process 只會有一條巡查執行緒"""
+        with patch.object(app, "claude_client", MagicMock()), \
+                patch.object(app, "_sweeper_pid", None), \
+                patch.object(app.threading, "Thread") as thread:
+            assert app.start_report_sweeper() is True
+            assert app.start_report_sweeper() is False
+        assert thread.call_count == 1
+        assert thread.call_args.kwargs["target"] is app._sweep_report_jobs
+
+    def test_post_fork_starts_sweeper(self):
+        """gunicorn_config.post_fork 會在 worker 裡啟動巡查"""
+        import gunicorn_config
+        with patch.object(app, "start_report_sweeper") as start, \
+                patch.dict(os.environ):
+            gunicorn_config.post_fork(None, None)
+        assert start.call_count == 1
+
+
+# ══════════════════════════════════════════
+# 36. AI 呼叫斷路器 (AIClient)
+# ══════════════════════════════════════════
+
+def failing_client(error=TimeoutError("deadline")):
+    client = MagicMock()
+    client.messages.create.side_effect = error
+    return client
+
+
+class TestAIClient:
+
+    def test_deadline_passed_to_sdk(self):
+        client = claude_reply("ok")
+        with patch.object(app, "claude_client", client):
+            assert app.ai_client.complete("hi", "sys", 100, 3.5) == "ok"
+        assert client.messages.create.call_args.kwargs["timeout"] == 3.5
+        stats = app.ai_client.stats()
+        assert stats["calls"] == 1 and stats["state"] == "closed" and stats["error_rate"] == 0.0
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = app.AIClient(threshold=3, cooldown=60)
+        client = failing_client()
+        with patch.object(app, "claude_client", client):
+            for _ in range(5):
+                assert breaker.complete("hi", "sys", 100, 1) is None
+        assert client.messages.create.call_count == 3
+        stats = breaker.stats()
+        assert stats["state"] == "open"
+        assert stats["short_circuited"] == 2
+        assert stats["error_rate"] == 1.0
+        assert not breaker.available()
+
+    def test_success_resets_failure_count(self):
+        breaker = app.AIClient(threshold=2, cooldown=60)
+        client = MagicMock()
+        client.messages.create.side_effect = [
+            TimeoutError(), MagicMock(content=[MagicMock(text="ok")]), TimeoutError(),
+        ]
+        with patch.object(app, "claude_client", client):
+            for _ in range(3):
+                breaker.complete("hi", "sys", 100, 1)
+        assert breaker.state == "closed"
+
+    def test_half_open_probe(self):
+        import time
+        breaker = app.AIClient(threshold=1, cooldown=0.05)
+        with patch.object(app, "claude_client", failing_client()):
+            breaker.complete("hi", "sys", 100, 1)
+        assert breaker.state == "open"
+        time.sleep(0.06)
+        assert breaker.state == "half_open" and breaker.available()
+        with patch.object(app, "claude_client", failing_client()):
+            breaker.complete("hi", "sys", 100, 1)
+        assert breaker.state == "open"
+        time.sleep(0.06)
+        with patch.object(app, "claude_client", claude_reply("ok")):
+            assert breaker.complete("hi", "sys", 100, 1) == "ok"
+        assert breaker.state == "closed"
+
+    def test_half_open_allows_single_probe(self):
+        import time
+        import threading
+        breaker = app.AIClient(threshold=1, cooldown=0.01)
+        with patch.object(app, "claude_client", failing_client()):
+            breaker.complete("hi", "sys", 100, 1)
+        time.sleep(0.02)
+        gate = threading.Event()
+        client = MagicMock()
+        client.messages.create.side_effect = lambda **kw: gate.wait(5) and MagicMock(content=[MagicMock(text="ok")])
+        with patch.object(app, "claude_client", client):
+            probe = threading.Thread(target=breaker.complete, args=("hi", "sys", 100, 1))
+            probe.start()
+            while client.messages.create.call_count == 0:
+                time.sleep(0.001)
+            assert breaker.complete("hi", "sys", 100, 1) is None
+            gate.set()
+            probe.join()
+        assert client.messages.create.call_count == 1
+        assert breaker.state == "closed"
+
+    def test_nlu_skipped_while_open(self):
+        open_buy()
+        app.ai_client = app.AIClient(threshold=1, cooldown=60)
+        client = failing_client()
+        with patch.object(app, "claude_client", client):
+            assert app.cmd_nlu_order(GID, UID, UNAME, "我也要") is None
+            assert app.cmd_nlu_order(GID, UID2, UNAME2, "一樣") is None
+            # 明確的訊息仍由本地判斷處理
+            assert "蛋餃" in app.cmd_nlu_order(GID, UID, UNAME, "我訂蛋餃兩包")
+        assert client.messages.create.call_count == 1
+        assert app.nlu_stats["skipped"] >= 1
+
+    def test_parse_error_does_not_trip_breaker(self):
+        open_buy()
+        app.ai_client = app.AIClient(threshold=1, cooldown=60)
+        with patch.object(app, "claude_client", claude_reply("not json")):
+            app.cmd_nlu_order(GID, UID, UNAME, "我也要")
+        assert app.ai_client.state == "closed"
+
+    def test_health_reports_ai_state(self):
+        body, status = app.health()
+        assert status == 200 and "'ai': {'state': 'closed'" in body
+
+
+# ══════════════════════════════════════════
+# 37. 列表分頁 (render_list_page / reply_messages)
+# ══════════════════════════════════════════
+
+def fill_orders(buy_id, n_items, per_item):
+    conn = app.get_conn()
+    conn.executemany(
+        "INSERT INTO orders (group_buy_id, item_num, user_id, user_name, quantity) VALUES (?, ?, ?, ?, ?)",
+        ((buy_id, num, f"u{num}_{k}", f"買家第{k}號（住在{num}樓）", 1 + k % 3)
+         for num in range(1, n_items + 1) for k in range(per_item)),
+    )
+    conn.commit()
+
+
+class TestListPaging:
+
+    def test_single_page_unchanged(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+3 1")
+        buy_id = app.get_active_buys(GID)[0][0]
+        assert app.cmd_list(GID) == app.format_buy_list(buy_id)
+        assert app.cmd_list(GID, 1) == app.format_buy_list(buy_id, show_label=True)
+
+    def test_pages_cover_every_item_with_same_total(self):
+        open_big_buy()
+        buy = app.get_active_buys(GID)[0]
+        fill_orders(buy[0], 61, 3)
+        pages = app.list_page_count(buy[0])
+        assert pages == 7
+        texts = [app.cmd_list(GID, None, p) for p in range(1, pages + 1)]
+        joined = "\n".join(texts)
+        for num in range(1, 62):
+            assert f"【{num}】" in joined
+        assert "「列表 1 頁2」" in texts[0]
+        assert "（第 7/7 頁）" in texts[-1]
+        full_summary = app.format_buy_list(buy[0]).split("\n")[-1]
+        assert texts[-1].split("\n")[-1] == full_summary
+
+    def test_page_only_queries_its_slice(self):
+        open_big_buy()
+        buy = app.get_active_buys(GID)[0]
+        fill_orders(buy[0], 61, 3)
+        app.catalog_cache.invalidate(GID)
+        text, statements = trace_statements(app.render_list_page, buy, 2, 7)
+        assert "【11】" in text and "【20】" in text and "【21】" not in text
+        order_sql = [s for s in statements if "FROM orders" in s]
+        assert order_sql and all("BETWEEN" in s for s in order_sql)
+        assert any("LIMIT" in s for s in statements if "FROM items" in s)
+
+    def test_last_page_totals_from_one_aggregate(self):
+        """最後一頁：只查本頁範圍的訂單，總計用一次 GROUP BY 彙總，不渲染其他頁"""
+        open_big_buy()
+        buy = app.get_active_buys(GID)[0]
+        fill_orders(buy[0], 61, 3)
+        app.cmd_order(GID, UID, UNAME, "+1 2")   # 寫入後版本號改變，快取全部失效
+        text, statements = trace_statements(app.render_list_page, buy, 7, 7)
+        order_sql = [s for s in statements if "FROM orders" in s]
+        assert len(order_sql) == 2
+        assert "BETWEEN" in order_sql[0] and "GROUP BY item_num, quantity" in order_sql[1]
+        assert text.split("\n")[-1] == app.format_buy_list(buy[0]).split("\n")[-1]
+
+    def test_list_totals_cached_by_version(self):
+        open_big_buy()
+        buy_id = app.get_active_buys(GID)[0][0]
+        fill_orders(buy_id, 61, 3)
+        first = app.list_totals(buy_id)
+        again, statements = trace_statements(app.list_totals, buy_id)
+        assert again == first
+        assert not any("FROM orders" in s for s in statements)
+        app.cmd_order(GID, UID, UNAME, "+3 2")
+        assert app.list_totals(buy_id)[0] == first[0] + 2
+
+    def test_page_errors(self):
+        open_buy()
+        assert "只有 1 頁" in app.cmd_list(GID, None, 3)
+        open_buy(text="#開團\n第二團\n1) 蛋餃 60元")
+        assert "請指定團購編號" in app.cmd_list(GID, None, 1)
+        assert "第二團" in app.cmd_list(GID, 2, 1)
+
+    def test_long_list_split_into_messages(self):
+        open_big_buy()
+        buy_id = app.get_active_buys(GID)[0][0]
+        fill_orders(buy_id, 61, 40)
+        messages = app.cmd_list(GID)
+        assert isinstance(messages, list)
+        assert len(messages) == app.LINE_MAX_MESSAGES
+        assert all(len(m) <= app.LINE_MESSAGE_LIMIT for m in messages)
+        assert "繼續查看" in messages[-1]
+        assert "截斷" not in "".join(messages)
+
+    def test_split_message_on_line_boundaries(self):
+        text = "\n".join(f"第{i}行" + "字" * 30 for i in range(400))
+        chunks = app.split_message(text, limit=1000)
+        assert all(len(c) <= 1000 for c in chunks)
+        assert "\n".join(chunks) == text
+        assert len(app.reply_messages("x" * 40000)) == app.LINE_MAX_MESSAGES
+
+    def test_reply_sends_multiple_messages(self):
+        open_big_buy()
+        buy_id = app.get_active_buys(GID)[0][0]
+        fill_orders(buy_id, 61, 40)
+        client = app.app.test_client()
+        body = make_webhook_body("列表")
+        with patch.object(app.line_bot_api, 'reply_message') as mock_reply, \
+             patch.object(app.line_bot_api, 'get_group_member_profile') as mock_profile:
+            mock_profile.return_value = MagicMock(display_name=UNAME)
+            resp = client.post("/webhook", data=body.encode(),
+                               headers={"X-Line-Signature": sign(body)}, content_type="application/json")
+            assert resp.status_code == 200
+            assert app.event_queue.join(timeout=5)
+        sent = mock_reply.call_args[0][1]
+        assert isinstance(sent, list) and len(sent) == app.LINE_MAX_MESSAGES
+        assert all(len(m.text) <= app.LINE_MESSAGE_LIMIT for m in sent)
+
+
+# ══════════════════════════════════════════
+# 38. 列表渲染快取 (buy_versions / render_cache)
+# ══════════════════════════════════════════
+
+class TestRenderCache:
+
+    def _buy_id(self):
+        return app.get_active_buys(GID)[0][0]
+
+    def test_repeated_list_is_cache_hit(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        first = app.cmd_list(GID)
+        second, statements = trace_statements(app.cmd_list, GID)
+        assert second == first
+        assert not any("FROM orders" in s for s in statements)
+        assert any("buy_versions" in s for s in statements)
+        assert app.render_cache.stats()["hits"] >= 1
+
+    def test_order_cancel_close_bump_version(self):
+        open_buy()
+        buy_id = self._buy_id()
+        v0 = app.get_buy_version(buy_id)
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        v1 = app.get_buy_version(buy_id)
+        assert v1 > v0 and f"{UNAME} x2" in app.cmd_list(GID)
+        app.cmd_cancel_order(GID, UID, UNAME, "退出 1")
+        v2 = app.get_buy_version(buy_id)
+        assert v2 > v1 and UNAME not in app.cmd_list(GID)
+        app.cmd_close(GID, UID)
+        assert app.get_buy_version(buy_id) > v2
+
+    def test_failed_order_keeps_version(self):
+        open_buy_limited(limit=1)
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 1")
+        version = app.get_buy_version(buy_id)
+        assert "額滿" in app.cmd_order(GID, UID2, UNAME2, "+1 1")
+        assert app.get_buy_version(buy_id) == version
+
+    def test_write_from_other_worker_invalidates(self):
+        open_buy()
+        buy_id = self._buy_id()
+        before = app.cmd_list(GID)
+        # 另一個 worker：獨立連線寫入並提交
+        other = app._open_conn(app.DB_PATH)
+        try:
+            other.execute("BEGIN IMMEDIATE")
+            app.reserve_order(other.cursor(), buy_id, 2, "蛋餃", UID2, UNAME2, 3, True, None)
+            other.commit()
+        finally:
+            other.close()
+        after = app.cmd_list(GID)
+        assert after != before and f"{UNAME2} x3" in after
+
+    def test_health_reports_render_cache(self):
+        body, status = app.health()
+        assert status == 200 and "'render_cache'" in body
+
+
+# ══════════════════════════════════════════
+# 39. 我的訂單單次查詢 / 我的訂單 全部
+# ══════════════════════════════════════════
+
+class TestMyOrdersQuery:
+
+    def test_single_query_across_buys(self):
+        open_buy()
+        app.cmd_open(GID, UID, UNAME, "#開團\n第二團\n4) 滷肉飯 80元")
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID, UNAME, "+3 小明 1")
+        app.get_catalog(GID)
+        result, statements = trace_statements(app.cmd_my_orders, GID, UID, UNAME)
+        # 目錄世代號檢查 + 一次 JOIN
+        assert len(statements) == 2
+        assert "JOIN orders" in statements[1] and "JOIN items" in statements[1]
+        assert result.split("\n")[2:] == [
+            "[團購1] 今日美食", "【1】水餃 50元 x2", "📦 代訂：", "【3】魚餃 70元 x1（小明）", "",
+            "────────────────", "共 2 項",
+        ]
+
+    def test_lookup_uses_user_index(self):
+        sql = app.MY_ORDERS_SQL.format(where="gb.group_id = ? AND gb.status = 'open'", order="gb.buy_num")
+        plan = " ".join(r[3] for r in app.get_conn().execute(f"EXPLAIN QUERY PLAN {sql}", (UID, GID)))
+        assert "idx_group_buys_group_status" in plan and "idx_orders_user_buy" in plan
+
+    def test_all_mode_spans_groups_and_closed_buys(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+2 1")
+        app.cmd_close(GID, UID)
+        open_buy(group_id="other_group", text="#開團\n隔壁團\n1) 鳳梨酥 300元")
+        app.cmd_order("other_group", UID, UNAME, "+1 1")
+        result = app.cmd_my_orders_all(UID, UID, UNAME)
+        assert result.index("隔壁團（進行中") < result.index("今日美食（已結團")
+        assert "【1】水餃 50元 x2" in result and "【1】鳳梨酥 300元 x1" in result
+        assert "蛋餃" not in result
+        assert "共 2 項" in result
+
+    def test_all_mode_limits_buys(self):
+        for n in range(3):
+            open_buy(group_id=f"g{n}", text=f"#開團\n第{n}團\n1) 水餃 50元")
+            app.cmd_order(f"g{n}", UID, UNAME, "+1 1")
+        with patch.object(app, "MY_ORDERS_ALL_LIMIT", 2):
+            result = app.cmd_my_orders_all(UID, UID, UNAME)
+        assert "第0團" not in result and "第2團" in result
+        assert "顯示最近 2 團，共 3 團" in result
+
+    def test_all_mode_private_chat_only(self):
+        """群組裡不列出其他群組的訂單，提示改用私訊"""
+        open_buy(group_id="other_group", text="#開團\n隔壁團\n1) 鳳梨酥 300元")
+        app.cmd_order("other_group", UID, UNAME, "+1 1")
+        with patch.object(app, "get_conn", side_effect=AssertionError("不應查詢")):
+            result = app.cmd_my_orders_all(GID, UID, UNAME)
+        assert "請私訊" in result and "鳳梨酥" not in result
+
+    def test_all_mode_routed_with_chat_id(self):
+        """1:1 聊天時 source_id 即 user_id → 指令路由照常回覆"""
+        open_buy(group_id="other_group", text="#開團\n隔壁團\n1) 鳳梨酥 300元")
+        app.cmd_order("other_group", UID, UNAME, "+1 1")
+        action = app.COMMAND_ACTIONS["my_orders_all"]
+        assert "鳳梨酥" in action(UID, UID, lambda: UNAME)
+        assert "請私訊" in action(GID, UID, lambda: UNAME)
+        assert "沒有任何訂單" in app.cmd_my_orders_all(UID2, UID2, UNAME2)
+
+
+# ══════════════════════════════════════════
+# 40. 訂單事件帳本 (order_events / 快照 / 還原)
+# ══════════════════════════════════════════
+
+def ledger_events(buy_id):
+    conn = app.get_conn()
+    return conn.execute(
+        "SELECT kind, item_num, user_name, quantity FROM order_events WHERE group_buy_id=? ORDER BY id",
+        (buy_id,),
+    ).fetchall()
+
+
+class TestOrderLedger:
+
+    def _buy_id(self):
+        return app.get_active_buys(GID)[0][0]
+
+    def test_writes_append_events(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID, UNAME, "+1")
+        app.cmd_order(GID, UID, UNAME, "+2 小明 3")
+        app.cmd_cancel_order(GID, UID, UNAME, "退出 1")
+        app.cmd_close(GID, UID)
+        assert ledger_events(buy_id) == [
+            ("set", 1, UNAME, 2),
+            ("add", 1, UNAME, 1),
+            ("set", 2, "小明", 3),
+            ("cancel", 1, UNAME, None),
+            ("close", None, None, None),
+        ]
+
+    def test_auto_close_event(self):
+        open_buy_limited(limit=1)
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 1")
+        app.cmd_order(GID, UID2, UNAME2, "+2 1")
+        assert ledger_events(buy_id)[-1][0] == "auto_close"
+        conn = app.get_conn()
+        assert app.replay_order_events(conn.cursor(), buy_id).closed
+
+    def test_replay_matches_projection(self):
+        open_buy()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+1 3")
+        app.cmd_order(GID, UID, UNAME, "+1 5")
+        app.cmd_order(GID, UID, UNAME, "+3 小美 1")
+        app.cmd_cancel_order(GID, UID2, UNAME2, "退出 1")
+        assert app.check_order_projection() == []
+
+    def test_failed_batch_leaves_no_events(self):
+        open_buy_limited(limit=2)
+        buy_id = self._buy_id()
+        entries = [
+            app.OrderLine(app.get_active_buys(GID)[0], 1, "水餃", UNAME, 1, True, None),
+            app.OrderLine(app.get_active_buys(GID)[0], 2, "蛋餃", UNAME, 9, True, None),
+        ]
+        app.apply_order_lines(UID, entries, multi=False, mode="all")
+        assert ledger_events(buy_id) == []
+
+    def test_repair_rebuilds_projection(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+2 1")
+        expected = app.format_buy_list(buy_id)
+        conn = app.get_conn()
+        conn.execute("DELETE FROM orders WHERE item_num = 1")
+        conn.execute("UPDATE orders SET quantity = 7 WHERE item_num = 2")
+        conn.commit()
+        assert app.check_order_projection() == [buy_id]
+        app.check_order_projection(repair=True)
+        assert app.check_order_projection() == []
+        assert app.format_buy_list(buy_id) == expected
+        assert app.check_item_totals() == []
+
+    def test_snapshots_bound_replay(self):
+        open_buy()
+        buy_id = self._buy_id()
+        with patch.object(app, "ORDER_SNAPSHOT_INTERVAL", 3):
+            for i in range(8):
+                app.cmd_order(GID, f"u{i}", f"買家{i}", f"+{1 + i % 3} {1 + i}")
+            app.cmd_cancel_order(GID, "u0", "買家0", "退出 1")
+        conn = app.get_conn()
+        snapshots = conn.execute(
+            "SELECT last_event_id FROM order_snapshots WHERE group_buy_id=?", (buy_id,)
+        ).fetchall()
+        # 只保留最近 ORDER_SNAPSHOT_KEEP 份
+        assert len(snapshots) == app.ORDER_SNAPSHOT_KEEP
+        state, statements = trace_statements(app.replay_order_events, conn.cursor(), buy_id)
+        assert state.last_event_id == conn.execute("SELECT MAX(id) FROM order_events").fetchone()[0]
+        assert any("order_snapshots" in s for s in statements)
+        # 與不使用快照的完整重播結果相同
+        conn.execute("DELETE FROM order_snapshots")
+        assert app.replay_order_events(conn.cursor(), buy_id) == state
+        assert app.check_order_projection() == []
+
+    def _last_event_id(self):
+        return app.get_conn().execute("SELECT MAX(id) FROM order_events").fetchone()[0]
+
+    def test_revert_only_touches_reverted_events(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        # 一次錯誤的 AI 操作：把自己的水餃改成 9 份、幫小美亂下單
+        app.cmd_order(GID, UID, UNAME, "+1 9")
+        bad = [self._last_event_id()]
+        app.cmd_order(GID, UID, UNAME, "+3 小美 4")
+        bad.append(self._last_event_id())
+        # 之後其他人的正常下單
+        app.cmd_order(GID, UID2, UNAME2, "+2 1")
+        app.cmd_order(GID, "u3", "丙", "+1 3")
+        n_events = len(ledger_events(buy_id))
+        assert app.revert_order_events(buy_id, bad) == (None, 2, None)
+        assert len(ledger_events(buy_id)) == n_events + 2
+        rows = order_rows()
+        assert (1, UNAME, 2) in rows and (2, UNAME2, 1) in rows and (1, "丙", 3) in rows
+        assert not any(name == "小美" for _, name, _ in rows)
+        assert app.check_order_projection() == []
+        assert app.check_item_totals() == []
+
+    def test_revert_cancel_restores_order(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID2, UNAME2, "+2 3")
+        app.cmd_cancel_order(GID, UID2, UNAME2, "退出 2")
+        cancel = self._last_event_id()
+        assert app.revert_order_events(buy_id, [cancel]) == (None, 1, None)
+        assert order_rows() == [(2, UNAME2, 3)]
+
+    def test_revert_respects_item_limit(self):
+        """還原取消時，份數要重新佔用限量；額度被別人用掉就整批不還原"""
+        open_buy_limited(limit=5)
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID2, UNAME2, "+1 3")
+        app.cmd_cancel_order(GID, UID2, UNAME2, "退出 1")
+        cancel = self._last_event_id()
+        app.cmd_order(GID, UID, UNAME, "+1 4")
+        n_events = len(ledger_events(buy_id))
+        err, changes, _ = app.revert_order_events(buy_id, [cancel])
+        assert "剩餘 1 份" in err and changes == 0
+        assert len(ledger_events(buy_id)) == n_events
+        assert order_rows() == [(1, UNAME, 4)]
+        assert app.check_item_totals() == []
+
+    def test_revert_can_trigger_auto_close(self):
+        """還原後所有限量品項都額滿 → 與下單一樣自動結團"""
+        open_buy_limited(limit=5)
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID2, UNAME2, "+2 5")
+        app.cmd_cancel_order(GID, UID2, UNAME2, "退出 2")
+        cancel = self._last_event_id()
+        app.cmd_order(GID, UID, UNAME, "+1 5")
+        err, changes, auto_close = app.revert_order_events(buy_id, [cancel])
+        assert err is None and changes == 1
+        assert "自動結團" in auto_close
+        assert app.get_active_buys(GID) == []
+
+    def test_revert_refused_on_closed_buy(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        event_id = self._last_event_id()
+        app.cmd_close(GID, UID)
+        n_events = len(ledger_events(buy_id))
+        err, changes, _ = app.revert_order_events(buy_id, [event_id])
+        assert "已結團" in err and changes == 0
+        assert len(ledger_events(buy_id)) == n_events
+        assert order_rows() == [(1, UNAME, 2)]
+
+    def test_migration_backfills_existing_orders(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_order(GID, UID2, UNAME2, "+2 小美 1")
+        conn = app.get_conn()
+        conn.execute("DROP TABLE order_events")
+        conn.execute("DROP TABLE order_snapshots")
+        conn.execute("PRAGMA user_version = 8")
+        conn.commit()
+        app.init_db()
+        assert ledger_events(buy_id) == [("add", 1, UNAME, 2), ("add", 2, "小美", 1)]
+        assert app.check_order_projection() == []
+
+    def test_cancel_buy_removes_ledger(self):
+        open_buy()
+        buy_id = self._buy_id()
+        app.cmd_order(GID, UID, UNAME, "+1 2")
+        app.cmd_cancel_buy(GID, UID)
+        assert ledger_events(buy_id) == []